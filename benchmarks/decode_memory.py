@@ -0,0 +1,112 @@
+"""
+Peak memory (RSS) of decoding a large zstandard compressed netcdf results chunk with utils.decode_results, compared with the previous pipeline that read the whole body, copied it into a BytesIO, decompressed it into another BytesIO and read that again.
+
+Each decode runs in a new process and the compressed chunk is streamed from a file, like a response body. Run with:
+
+    python benchmarks/decode_memory.py [n_times] [n_heights]
+"""
+import concurrent.futures
+import io
+import multiprocessing
+import pathlib
+import resource
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import s3tethys
+import xarray as xr
+import zstandard as zstd
+from hdf5tools import H5
+
+from tethysts import utils
+
+##############################################
+### Functions
+
+
+def make_chunk(path: pathlib.Path, n_times: int, n_heights: int):
+    """
+    Write a zstandard compressed netcdf3 results chunk of n_times hourly time steps and n_heights heights.
+    """
+    rng = np.random.default_rng(0)
+    times = pd.date_range("1980-01-01", periods=n_times, freq="h").values
+    data = xr.Dataset(
+        {
+            "precipitation": (
+                ("geometry", "time", "height"),
+                rng.random((1, n_times, n_heights)).round(3),
+            ),
+        },
+        coords={
+            "geometry": ["172.00000,-43.00000"],
+            "time": times,
+            "height": np.arange(n_heights),
+        },
+    )
+    path.write_bytes(zstd.ZstdCompressor().compress(data.to_netcdf(engine="scipy")))
+
+
+def previous_decode(file_obj):
+    """
+    The decode pipeline before streaming.
+    """
+    file_obj = s3tethys.decompress_stream_to_object(io.BytesIO(file_obj.read()), "zstd")
+    data = xr.load_dataset(file_obj.read(), engine="scipy")
+    data_obj = io.BytesIO()
+    utils.result_filters(H5(data)).to_hdf5(data_obj, compression="zstd")
+
+    return data_obj
+
+
+def streaming_decode(file_obj):
+    """
+    The current decode pipeline.
+    """
+    chunk = {"key": "chunk.results.nc.zst"}
+
+    return utils.decode_results(chunk, file_obj)
+
+
+def peak_rss(name: str, path: pathlib.Path):
+    """
+    The increase of the peak RSS of the process in MB over the decode.
+    """
+    func = {"previous": previous_decode, "streaming": streaming_decode}[name]
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(path, "rb") as f:
+        data_obj = func(f)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    size = len(data_obj.getbuffer())
+
+    ## ru_maxrss is in bytes on macOS and in KB elsewhere
+    scale = 2**20 if sys.platform == "darwin" else 2**10
+
+    return (after - before) / scale, size
+
+
+def run(n_times: int = 200000, n_heights: int = 40):
+    """
+    Print the peak RSS increase of both pipelines. The chunk is also made in another process, as the peak RSS of a process is inherited by the processes it starts.
+    """
+    ctx = multiprocessing.get_context("spawn")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = pathlib.Path(tmp_dir).joinpath("chunk.results.nc.zst")
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=ctx) as executor:
+            executor.submit(make_chunk, path, n_times, n_heights).result()
+        print(
+            "compressed chunk: {:.1f} MB, netcdf: {:.1f} MB".format(
+                path.stat().st_size / 2**20, n_times * (n_heights + 1) * 8 / 2**20
+            )
+        )
+
+        for name in ("previous", "streaming"):
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=ctx) as executor:
+                rss, size = executor.submit(peak_rss, name, path).result()
+            print("{:>10}: peak RSS +{:.1f} MB".format(name, rss))
+
+
+if __name__ == "__main__":
+    run(*[int(a) for a in sys.argv[1:]])
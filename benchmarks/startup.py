@@ -0,0 +1,178 @@
+"""
+A benchmark of the startup of tethysts: the time to import the package and the latency of the first query of a new process. Several synthetic remotes are served by local http servers (see suite.py) and each run is a new python process, so nothing has been imported or cached yet. The first query is timed with the datasets of all of the remotes loaded when the Tethys object is created (eager) and with the deferred mode, where only the remote of the queried dataset is loaded.
+
+Run from the root of the repository (with tethysts installed):
+
+    python -m benchmarks.startup --remotes 5 --output startup.json
+
+and compare with the timings of a previous run (the exit code is 1 if any phase is slower than the tolerance allows):
+
+    python -m benchmarks.startup --remotes 5 --baseline startup.json
+"""
+import argparse
+import contextlib
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+
+import orjson
+
+import tethysts
+from benchmarks.suite import Timer, compare
+from benchmarks.synthetic import make_remote, serve_remote
+
+##############################################
+### Parameters
+
+## The script of a run. The timings are printed as json.
+run_script = """
+import sys
+import time
+
+import orjson
+
+start = time.perf_counter()
+from tethysts import Tethys
+durations = {"import": time.perf_counter() - start}
+
+remotes = orjson.loads(sys.argv[1])
+dataset_id = sys.argv[2]
+deferred = sys.argv[3] == "deferred"
+
+if remotes:
+    start = time.perf_counter()
+    t1 = Tethys(remotes, deferred=deferred)
+    durations["init"] = time.perf_counter() - start
+
+    stn_id = t1.get_stations(dataset_id)[0]["station_id"]
+    r1 = t1.get_results(dataset_id, stn_id)
+    durations["first_query"] = time.perf_counter() - start
+
+print(orjson.dumps(durations).decode())
+"""
+
+##############################################
+### Helper functions
+
+
+def run_process(remotes: list = None, dataset_id: str = "", mode: str = "eager"):
+    """
+    Time the import (and the first query if remotes are passed) in a new process.
+
+    Returns
+    -------
+    dict
+        of phase name to the duration in seconds.
+    """
+    src_path = str(pathlib.Path(tethysts.__path__[0]).parent)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [src_path] + [p for p in [env.get("PYTHONPATH")] if p]
+    )
+
+    out = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            run_script,
+            orjson.dumps(remotes or []),
+            dataset_id,
+            mode,
+        ],
+        env=env,
+        capture_output=True,
+        check=True,
+    )
+
+    return orjson.loads(out.stdout.splitlines()[-1])
+
+
+##############################################
+### Main function
+
+
+def run(n_remotes: int = 3, n_stations: int = 10, repeat: int = 3):
+    """
+    Generate the synthetic remotes and time the import of tethysts and the first query of the first remote in new processes.
+
+    Parameters
+    ----------
+    n_remotes : int
+        The number of remotes (of one dataset each).
+    n_stations : int
+        The number of stations of each dataset.
+    repeat : int
+        The number of processes per mode.
+
+    Returns
+    -------
+    dict
+        of import and eager_ and deferred_ phase names to the median and minimum durations in seconds.
+    """
+    timer = Timer()
+
+    with tempfile.TemporaryDirectory() as tmp_dir, contextlib.ExitStack() as stack:
+        tmp_path = pathlib.Path(tmp_dir)
+        remotes = []
+        dataset_ids = []
+        for i in range(n_remotes):
+            dataset_id = "{:024x}".format(i + 1)
+            root = tmp_path.joinpath("remote{}".format(i))
+            make_remote(root, dataset_id=dataset_id, n_stations=n_stations)
+            server = stack.enter_context(serve_remote(root))
+            remotes.append(
+                {"bucket": "tethysts", "public_url": server.public_url, "version": 4}
+            )
+            dataset_ids.append(dataset_id)
+
+        for i in range(repeat):
+            d1 = run_process()
+            timer.durations.setdefault("import", []).append(d1["import"])
+
+            for mode in ("eager", "deferred"):
+                d2 = run_process(remotes, dataset_ids[0], mode)
+                for name in ("init", "first_query"):
+                    timer.durations.setdefault(mode + "_" + name, []).append(d2[name])
+
+    return timer.summary()
+
+
+def main(args=None):
+    """ """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--remotes", type=int, default=3)
+    parser.add_argument("--stations", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=pathlib.Path, default=None)
+    parser.add_argument("--baseline", type=pathlib.Path, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--min-delta", type=float, default=0.005)
+    args = parser.parse_args(args)
+
+    summary = run(args.remotes, args.stations, args.repeat)
+
+    for name, stats in summary.items():
+        print(
+            "{:<30} {:>10.4f} s  (min {:.4f} s)".format(
+                name, stats["median"], stats["min"]
+            )
+        )
+
+    if args.output is not None:
+        args.output.write_bytes(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+
+    if args.baseline is not None:
+        baseline = orjson.loads(args.baseline.read_bytes())
+        regressions = compare(summary, baseline, args.tolerance, args.min_delta)
+        for name, (old, new) in regressions.items():
+            print("Regression in {}: {:.4f} s -> {:.4f} s".format(name, old, new))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
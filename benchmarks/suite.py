@@ -0,0 +1,252 @@
+"""
+An offline benchmark suite of the main operations of tethysts. Synthetic remotes of a configurable size are generated with benchmarks/synthetic.py and served by a local http server (like a public S3 bucket), so the benchmarks don't need the network and can run in CI. Each phase is timed on cold runs (an empty cache) and warm runs (the cache of the cold run).
+
+Run from the root of the repository (with tethysts installed):
+
+    python -m benchmarks.suite --stations 200 --chunks 10 --output timings.json
+
+and compare with the timings of a previous run (the exit code is 1 if any phase is slower than the tolerance allows):
+
+    python -m benchmarks.suite --stations 200 --chunks 10 --baseline timings.json
+"""
+import argparse
+import pathlib
+import statistics
+import sys
+import tempfile
+import time
+
+import orjson
+
+from benchmarks.synthetic import make_remote, serve_remote
+from tethysts import Tethys, utils
+
+##############################################
+### Helper functions
+
+
+class Timer(object):
+    """
+    Collects the durations of the phases over the runs. If the server of the remote is passed, then the number of requests for results chunks that it receives during each phase is collected too.
+    """
+
+    def __init__(self, server=None):
+        """ """
+        self.server = server
+        self.durations = {}
+        self.chunk_requests = {}
+
+    def time(self, name: str, func, *args, **kwargs):
+        """
+        Call the function and record its duration under the name.
+        """
+        if self.server is not None:
+            n_requests = len(self.server.requests)
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.durations.setdefault(name, []).append(time.perf_counter() - start)
+        if self.server is not None:
+            n_chunks = sum(
+                ".results." in r[1] for r in self.server.requests[n_requests:]
+            )
+            self.chunk_requests.setdefault(name, []).append(n_chunks)
+
+        return result
+
+    def summary(self):
+        """
+        The median and the minimum duration in seconds of each phase (and the median number of requests for results chunks if the server was passed).
+        """
+        summary = {}
+        for name, durations in self.durations.items():
+            summary[name] = {
+                "median": statistics.median(durations),
+                "min": min(durations),
+                "n": len(durations),
+            }
+            if name in self.chunk_requests:
+                summary[name]["chunk_requests"] = statistics.median(
+                    self.chunk_requests[name]
+                )
+
+        return summary
+
+
+def run_phases(remote: dict, cache: pathlib.Path, timer: Timer, prefix: str):
+    """
+    Time each phase once with a new Tethys object.
+    """
+    t1 = timer.time(prefix + "init", Tethys, [remote], cache=cache)
+    dataset = t1.datasets[0]
+    dataset_id = dataset["dataset_id"]
+    time_interval = int(dataset["chunk_parameters"]["time_interval"])
+
+    stns = timer.time(prefix + "get_stations", t1.get_stations, dataset_id)
+    lon, lat = stns[0]["geometry"]["coordinates"]
+    from_date = stns[0]["time_range"]["from_date"]
+    timer.time(
+        prefix + "get_stations_spatial",
+        t1.get_stations,
+        dataset_id,
+        lat=lat,
+        lon=lon,
+        distance=1.0,
+    )
+    timer.time(
+        prefix + "get_stations_temporal",
+        t1.get_stations,
+        dataset_id,
+        from_date=from_date,
+        to_date=from_date,
+    )
+
+    ## The results chunks of half of the stations
+    stn_ids = [s["station_id"] for s in stns[: max(len(stns) // 2, 1)]]
+    vd = t1.get_versions(dataset_id)[-1]["version_date"]
+    rc_index = t1._get_results_chunks(dataset_id, vd)
+    chunks = timer.time(
+        prefix + "chunk_filters",
+        utils.chunk_filters,
+        rc_index,
+        stn_ids,
+        time_interval,
+    )
+
+    download_remote = t1._get_download_remote(dataset_id)
+    results_list = timer.time(
+        prefix + "download_results",
+        lambda: [
+            utils.download_results(chunk=chunk, **download_remote) for chunk in chunks
+        ],
+    )
+
+    r1 = timer.time(prefix + "results_concat", utils.results_concat, results_list)
+    r1.close()
+
+    r2 = timer.time(prefix + "get_results", t1.get_results, dataset_id, stn_ids)
+    r2.close()
+    t1.close()
+
+
+def compare(
+    summary: dict, baseline: dict, tolerance: float = 0.25, min_delta: float = 0.005
+):
+    """
+    The phases whose median duration is more than the tolerance (a fraction) and more than min_delta seconds slower than in the baseline. The min_delta keeps the noise of the very short phases from being reported.
+
+    Returns
+    -------
+    dict
+        of phase name to a tuple of the baseline and the current median durations.
+    """
+    regressions = {}
+    for name, stats in summary.items():
+        if name in baseline:
+            old = baseline[name]["median"]
+            if (stats["median"] > old * (1 + tolerance)) and (
+                stats["median"] - old > min_delta
+            ):
+                regressions[name] = (old, stats["median"])
+
+    return regressions
+
+
+##############################################
+### Main function
+
+
+def run(
+    n_stations: int = 50,
+    n_chunks: int = 5,
+    chunk_len: int = 30,
+    compressed: bool = False,
+    repeat: int = 3,
+):
+    """
+    Generate a synthetic remote and time the phases on cold and warm runs. Each repeat starts with an empty cache (the cold run), which is then reused (the warm run).
+
+    Parameters
+    ----------
+    n_stations : int
+        The number of stations of the remote.
+    n_chunks : int
+        The number of results chunks per station.
+    chunk_len : int
+        The number of daily time steps per results chunk.
+    compressed : bool
+        Should the results chunks be zstandard compressed netcdf3 files rather than hdf5 files?
+    repeat : int
+        The number of cold and warm runs.
+
+    Returns
+    -------
+    dict
+        of cold_ and warm_ phase names to the median and minimum durations in seconds and the median number of requests for results chunks.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = pathlib.Path(tmp_dir)
+        root = tmp_path.joinpath("remote")
+        make_remote(
+            root,
+            n_stations=n_stations,
+            n_chunks=n_chunks,
+            chunk_len=chunk_len,
+            compressed=compressed,
+        )
+
+        with serve_remote(root) as server:
+            timer = Timer(server)
+            remote = {
+                "bucket": "tethysts",
+                "public_url": server.public_url,
+                "version": 4,
+            }
+            for i in range(repeat):
+                cache = tmp_path.joinpath("cache{}".format(i))
+                run_phases(remote, cache, timer, "cold_")
+                run_phases(remote, cache, timer, "warm_")
+
+    return timer.summary()
+
+
+def main(args=None):
+    """ """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--stations", type=int, default=50)
+    parser.add_argument("--chunks", type=int, default=5)
+    parser.add_argument("--chunk-len", type=int, default=30)
+    parser.add_argument("--compressed", action="store_true")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=pathlib.Path, default=None)
+    parser.add_argument("--baseline", type=pathlib.Path, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--min-delta", type=float, default=0.005)
+    args = parser.parse_args(args)
+
+    summary = run(
+        args.stations, args.chunks, args.chunk_len, args.compressed, args.repeat
+    )
+
+    for name, stats in summary.items():
+        print(
+            "{:<30} {:>10.4f} s  (min {:.4f} s)".format(
+                name, stats["median"], stats["min"]
+            )
+        )
+
+    if args.output is not None:
+        args.output.write_bytes(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+
+    if args.baseline is not None:
+        baseline = orjson.loads(args.baseline.read_bytes())
+        regressions = compare(summary, baseline, args.tolerance, args.min_delta)
+        for name, (old, new) in regressions.items():
+            print("Regression in {}: {:.4f} s -> {:.4f} s".format(name, old, new))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,352 @@
+"""
+Synthetic Tethys remotes and a local http server to serve them, so that the tests do not need the public remotes.
+"""
+import contextlib
+import email.utils
+import hashlib
+import io
+import os
+import pathlib
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import orjson
+import pandas as pd
+import tethys_data_models as tdm
+import xarray as xr
+import zstandard as zstd
+from hdf5tools import H5
+
+##############################################
+### Parameters
+
+bucket = "tethysts"
+version_date = "2022-01-01T00:00:00"
+time_interval = 30
+
+##############################################
+### Functions
+
+
+def write_object(root, obj_key, data: bytes):
+    """ """
+    path = pathlib.Path(root).joinpath(bucket, obj_key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def json_zstd(obj):
+    """ """
+    return zstd.ZstdCompressor().compress(orjson.dumps(obj))
+
+
+def make_results(station_id, geometry, times, rng, n_heights=1):
+    """ """
+    data = xr.Dataset(
+        {
+            "precipitation": (
+                ("geometry", "time", "height"),
+                rng.random((1, len(times), n_heights)).round(3),
+            ),
+            "station_id": (("geometry",), [station_id]),
+        },
+        coords={
+            "geometry": [geometry],
+            "time": times,
+            "height": list(range(n_heights)),
+        },
+    )
+    data["precipitation"].encoding = {
+        "dtype": "int32",
+        "scale_factor": 0.001,
+        "_FillValue": -99999,
+    }
+
+    return data
+
+
+def make_remote(
+    root,
+    dataset_id="a7b0c5d2e8f1a3b4c6d9e0f2",
+    n_stations=10,
+    n_chunks=3,
+    chunk_len=time_interval,
+    compressed=False,
+    time_chunk=None,
+    n_heights=1,
+    seed=0,
+    values_seed=None,
+):
+    """
+    Write a synthetic version 4 remote with a single dataset to the root path.
+
+    Parameters
+    ----------
+    root : str or pathlib.Path
+        The directory that will be served as the base public url. The objects are written into the bucket directory.
+    dataset_id : str
+        The dataset_id.
+    n_stations : int
+        The number of stations.
+    n_chunks : int
+        The number of results chunks per station.
+    chunk_len : int
+        The number of daily time steps per results chunk.
+    compressed : bool
+        Should the results chunks be zstandard compressed netcdf3 files (.nc.zst) rather than hdf5 files?
+    time_chunk : int or None
+        The number of time steps per hdf5 chunk of the results chunks. None will let hdf5tools guess the chunks.
+    n_heights : int
+        The number of heights in the results chunks.
+    seed : int
+        The random seed.
+    values_seed : int or None
+        The random seed of the results values (but not the station geometries). None will use the seed.
+
+    Returns
+    -------
+    dict
+        The remote dict.
+    """
+    key_patterns = tdm.utils.key_patterns[4]
+    rng = np.random.default_rng(seed)
+    if values_seed is None:
+        values_rng = rng
+    else:
+        values_rng = np.random.default_rng(values_seed)
+    vd_key = pd.Timestamp(version_date).strftime("%Y%m%dT%H%M%SZ")
+    start_date = pd.Timestamp("2020-01-01")
+
+    dataset = {
+        "dataset_id": dataset_id,
+        "parameter": "precipitation",
+        "result_type": "time_series",
+        "frequency_interval": "24H",
+        "utc_offset": "0H",
+        "chunk_parameters": {"time_interval": time_interval},
+    }
+
+    write_object(root, key_patterns["datasets"], json_zstd([dataset]))
+    write_object(
+        root,
+        key_patterns["versions"].format(dataset_id=dataset_id),
+        json_zstd([{"dataset_id": dataset_id, "version_date": version_date}]),
+    )
+
+    stns = []
+    rc_list = []
+    for i in range(n_stations):
+        station_id = hashlib.blake2b(
+            "{}{}".format(dataset_id, i).encode(), digest_size=12
+        ).hexdigest()
+        lon = round(float(170 + rng.random() * 5), 5)
+        lat = round(float(-45 + rng.random() * 5), 5)
+        geometry = "{:.5f},{:.5f}".format(lon, lat)
+        end_date = start_date + pd.Timedelta(days=chunk_len * n_chunks - 1)
+
+        stns.append(
+            {
+                "station_id": station_id,
+                "dataset_id": dataset_id,
+                "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                "time_range": {
+                    "from_date": start_date.isoformat(),
+                    "to_date": end_date.isoformat(),
+                },
+            }
+        )
+
+        for c in range(n_chunks):
+            chunk_start = start_date + pd.Timedelta(days=chunk_len * c)
+            times = pd.date_range(chunk_start, periods=chunk_len, freq="D").values
+            data = make_results(station_id, geometry, times, values_rng, n_heights)
+            chunk_id = "{:08d}".format(c)
+            key = key_patterns["results"].format(
+                dataset_id=dataset_id,
+                version_date=vd_key,
+                station_id=station_id,
+                chunk_id=chunk_id,
+            )
+
+            if compressed:
+                obj = zstd.ZstdCompressor().compress(data.to_netcdf(engine="scipy"))
+                key = key.replace(".results.h5", ".results.nc.zst")
+            else:
+                b1 = io.BytesIO()
+                if time_chunk is None:
+                    chunks = None
+                else:
+                    chunks = {
+                        "precipitation": (1, time_chunk, 1),
+                        "time": (time_chunk,),
+                    }
+                H5(data).to_hdf5(b1, compression="zstd", chunks=chunks)
+                obj = b1.getvalue()
+
+            write_object(root, key, obj)
+
+            rc_list.append(
+                {
+                    "dataset_id": dataset_id,
+                    "station_id": station_id,
+                    "chunk_id": chunk_id,
+                    "chunk_hash": hashlib.blake2b(obj, digest_size=12).hexdigest(),
+                    "version_date": version_date,
+                    "key": key,
+                    "chunk_day": int(chunk_start.timestamp() / 60 / 60 / 24),
+                    "height": 0,
+                    "modified_date": version_date,
+                    "content_length": len(obj),
+                }
+            )
+
+    write_object(
+        root,
+        key_patterns["stations"].format(dataset_id=dataset_id, version_date=vd_key),
+        json_zstd(stns),
+    )
+    write_object(
+        root,
+        key_patterns["results_chunks"].format(
+            dataset_id=dataset_id, version_date=vd_key
+        ),
+        json_zstd(rc_list),
+    )
+
+    remote = {"bucket": bucket, "version": 4}
+
+    return remote
+
+
+##############################################
+### Local http server
+
+
+def add_version(root, new_version_date, dataset_id="a7b0c5d2e8f1a3b4c6d9e0f2"):
+    """
+    Add a new version to a synthetic remote with the same stations and results chunks as the last version (as if nothing had changed). The objects of the results chunks are copied to the keys of the new version.
+    """
+    key_patterns = tdm.utils.key_patterns[4]
+    path = pathlib.Path(root).joinpath(bucket)
+    versions_key = key_patterns["versions"].format(dataset_id=dataset_id)
+    versions = orjson.loads(
+        zstd.ZstdDecompressor().decompress(path.joinpath(versions_key).read_bytes())
+    )
+    old_vd_key = pd.Timestamp(versions[-1]["version_date"]).strftime("%Y%m%dT%H%M%SZ")
+    new_vd_key = pd.Timestamp(new_version_date).strftime("%Y%m%dT%H%M%SZ")
+
+    for name in ("stations", "results_chunks"):
+        old_key = key_patterns[name].format(
+            dataset_id=dataset_id, version_date=old_vd_key
+        )
+        new_key = key_patterns[name].format(
+            dataset_id=dataset_id, version_date=new_vd_key
+        )
+        objs = orjson.loads(
+            zstd.ZstdDecompressor().decompress(path.joinpath(old_key).read_bytes())
+        )
+        if name == "results_chunks":
+            for rc in objs:
+                key = rc["key"].replace(old_vd_key, new_vd_key)
+                write_object(root, key, path.joinpath(rc["key"]).read_bytes())
+                rc["key"] = key
+                rc["version_date"] = new_version_date
+        write_object(root, new_key, json_zstd(objs))
+
+    versions.append({"dataset_id": dataset_id, "version_date": new_version_date})
+    write_object(root, versions_key, json_zstd(versions))
+
+
+class RemoteRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves the files like a public S3 bucket would: with ETag and Last-Modified headers, conditional requests, byte range requests, and persistent connections. Faults can be injected with the failures (path to the number of 503 responses to send) and delays (path to a list of delays in seconds of the next requests) attributes of the server.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(
+            (self.command, self.path, dict(self.headers), self.client_address)
+        )
+        path = self.translate_path(self.path)
+
+        delays = self.server.delays.get(self.path)
+        if delays:
+            time.sleep(delays.pop(0))
+
+        if self.server.failures.get(self.path, 0) > 0:
+            self.server.failures[self.path] -= 1
+            self.send_error(503)
+            return
+
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        stat = os.stat(path)
+        etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+        last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        range1 = self.headers.get("Range")
+        if range1 is not None:
+            start, end = range1.replace("bytes=", "").split("-")
+            start = int(start)
+            end = len(data) - 1 if end == "" else min(int(end), len(data) - 1)
+            body = data[start : end + 1]
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes {}-{}/{}".format(start, end, len(data))
+            )
+        else:
+            body = data
+            self.send_response(200)
+
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_error(405)
+
+
+@contextlib.contextmanager
+def serve_remote(root):
+    """
+    Serve the root path over http on a free local port. Yields the server, which has the base url as the public_url attribute and a list of the received requests as the requests attribute.
+    """
+    handler = lambda *args, **kwargs: RemoteRequestHandler(
+        *args, directory=str(root), **kwargs
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.requests = []
+    server.failures = {}
+    server.delays = {}
+    server.public_url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -1,4 +1,27 @@
-from tethysts import utils
-from tethysts.main import Tethys
+import importlib
 
-__all__ = ["Tethys", "utils"]
+## The public objects are only imported on first access (PEP 562)
+_exports = {
+    "Tethys": "tethysts.main",
+    "AsyncTethys": "tethysts.aio",
+    "Metrics": "tethysts.metrics",
+    "ResultsStore": "tethysts.store",
+    "RetryPolicy": "tethysts.clients",
+}
+
+__all__ = ["Tethys", "AsyncTethys", "Metrics", "ResultsStore", "RetryPolicy", "utils"]
+
+
+def __getattr__(name):
+    if name in _exports:
+        obj = getattr(importlib.import_module(_exports[name]), name)
+        globals()[name] = obj
+        return obj
+    elif name == "utils":
+        return importlib.import_module("tethysts.utils")
+
+    raise AttributeError("module 'tethysts' has no attribute '{}'".format(name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
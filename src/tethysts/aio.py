@@ -0,0 +1,584 @@
+"""
+An asyncio counterpart of the Tethys object.
+"""
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import functools
+import io
+import pathlib
+import warnings
+from datetime import datetime
+from typing import List, Union
+
+import orjson
+
+from tethysts import utils
+from tethysts.clients import RetryPolicy, classify_error, throttle_status_codes
+from tethysts.imports import lazy_import
+from tethysts.indexes import ResultsChunkIndex, StationTable
+from tethysts.main import Tethys, warn_remote_datasets
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+pd = lazy_import("pandas")
+tdm = lazy_import("tethys_data_models")
+xr = lazy_import("xarray")
+
+##############################################
+### Helper functions
+
+
+def classify_aio_error(err: Exception):
+    """
+    Classify an exception of a request to a remote like clients.classify_error, including the aiohttp errors.
+    """
+    if aiohttp is not None:
+        if isinstance(err, aiohttp.ClientResponseError):
+            if err.status == 404:
+                return "missing"
+            if (err.status >= 500) or (err.status in throttle_status_codes):
+                return "transient"
+            return "fatal"
+        if isinstance(err, aiohttp.ClientError):
+            return "transient"
+    if isinstance(err, asyncio.TimeoutError):
+        return "transient"
+
+    return classify_error(err)
+
+
+##############################################
+### Class
+
+
+class AsyncTethys(object):
+    """
+    The asyncio Tethys object. The methods mirror those of the Tethys object, but are awaitable. All downloads run concurrently on the event loop under a single connection limit and the CPU bound decoding runs in an executor. Requires the aiohttp package.
+
+    Remotes with a public_url are downloaded with aiohttp. Remotes that only have a connection_config are downloaded with botocore in the executor, but under the same connection limit.
+
+    Parameters
+    ----------
+    remotes : list of dict or None
+        list of dict of the S3 remotes to access or None which will parse all public datasets. The datasets are loaded with get_datasets or when entering the async context manager.
+    cache : str, pathlib.Path, or None
+        If the input is a path, then data will be cached locally. None will perform no caching.
+    metadata_ttl : int or float
+        See the Tethys object.
+    max_connections : int
+        The maximum number of simultaneous downloads shared by all of the calls on this object.
+    executor : concurrent.futures.Executor or None
+        The executor for the decoding. The results chunks that are downloaded into the cache are decoded in threads of their own (up to max_connections), as they wait on the cross-process locks of the cache. None will use a ThreadPoolExecutor owned by this object.
+    retry_policy : RetryPolicy or None
+        The retries and timeouts of the requests to the remotes (see the Tethys object). Hedged requests are not used. None will use the defaults of RetryPolicy.
+
+    Returns
+    -------
+    AsyncTethys object
+    """
+
+    def __init__(
+        self,
+        remotes: List[tdm.base.Remote] = None,
+        cache: Union[pathlib.Path, str] = None,
+        metadata_ttl: Union[int, float] = 0,
+        max_connections: int = 30,
+        executor: concurrent.futures.Executor = None,
+        retry_policy: RetryPolicy = None,
+    ):
+        """ """
+        if aiohttp is None:
+            raise ImportError(
+                "AsyncTethys requires aiohttp. Install it with pip install tethysts[async]."
+            )
+
+        self._tethys = Tethys(
+            remotes="pass",
+            cache=cache,
+            metadata_ttl=metadata_ttl,
+            max_pool_connections=max_connections,
+            retry_policy=retry_policy,
+        )
+        self._init_remotes = remotes
+        self.max_connections = max_connections
+        self._limit = asyncio.Semaphore(max_connections)
+        self._session = None
+        self._flights = {}
+        self._cache_executor = None
+
+        if executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor()
+            self._own_executor = True
+        else:
+            self._executor = executor
+            self._own_executor = False
+
+    @property
+    def datasets(self):
+        return self._tethys.datasets
+
+    @property
+    def cache(self):
+        return self._tethys.cache
+
+    async def __aenter__(self):
+        if not self._tethys.datasets:
+            try:
+                await self.get_datasets(self._init_remotes)
+            except BaseException:
+                await self.close()
+                raise
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        """
+        Close the http session, the pooled S3 clients, and the executor (if owned by this object).
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._tethys.close()
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+        if self._cache_executor is not None:
+            self._cache_executor.shutdown(wait=False)
+            self._cache_executor = None
+
+    def _get_session(self):
+        """ """
+        if self._session is None:
+            policy = self._tethys._clients.policy
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            timeout = aiohttp.ClientTimeout(
+                sock_connect=policy.connect_timeout, sock_read=policy.read_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+        return self._session
+
+    async def _run(self, func, *args, **kwargs):
+        """
+        Run a blocking function in the executor.
+        """
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    def _get_object_bytes(self, remote: dict, obj_key: str):
+        """
+        Blocking download of an object from a remote with S3 credentials. The S3 client is the pooled client of the Tethys object.
+        """
+        file_obj = self._tethys._clients.get_object(remote, obj_key)
+        if file_obj is None:
+            raise FileNotFoundError(obj_key)
+
+        return file_obj.read()
+
+    async def _fetch_url(self, url: str):
+        """ """
+        async with self._limit:
+            async with self._get_session().get(url) as resp:
+                resp.raise_for_status()
+                content = await resp.read()
+
+        return content
+
+    async def _single_flight(self, key, func, *args):
+        """
+        Await func(*args) unless a call with the same key is already in flight on this object, in which case its result (or exception) is shared (like locks.SingleFlight). The call runs in a task of its own, so a cancelled caller doesn't cancel it for the others.
+        """
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._flights[key] = task
+            task.add_done_callback(lambda t: self._flights.pop(key, None))
+
+        return await asyncio.shield(task)
+
+    async def _retry(self, func, *args):
+        """
+        Await a request with the retries of the retry policy (see RetryPolicy.call). A slot of the connection limit is not held during the backoff.
+        """
+        policy = self._tethys._clients.policy
+        attempt = 0
+        while True:
+            try:
+                return await func(*args)
+            except Exception as err:
+                if not policy.retry(err, attempt, classify_aio_error):
+                    raise
+            await asyncio.sleep(policy.backoff(attempt))
+            attempt += 1
+
+    async def _fetch(self, remote: dict, obj_key: str):
+        """
+        Download an object from a remote. Transient errors are retried with the retry policy.
+        """
+        return await self._retry(self._fetch_object, remote, obj_key)
+
+    async def _fetch_object(self, remote: dict, obj_key: str):
+        """
+        A single attempt of _fetch.
+        """
+        public_url = remote.get("public_url")
+        if public_url is not None:
+            url = utils.create_public_s3_url(str(public_url), remote["bucket"], obj_key)
+            content = await self._fetch_url(url)
+        else:
+            async with self._limit:
+                content = await self._run(self._get_object_bytes, remote, obj_key)
+
+        return content
+
+    async def _get_metadata(self, remote: dict, obj_key: str):
+        """
+        Get and decode a metadata object from a remote. The local metadata cache (which is blocking) is used if the cache path was set.
+        """
+        if self._tethys._metadata_cache is not None:
+            async with self._limit:
+                meta = await self._run(self._tethys._get_metadata, remote, obj_key)
+        else:
+            content = await self._fetch(remote, obj_key)
+            meta = await self._run(utils.read_json_zstd, content)
+
+        return meta
+
+    async def get_datasets(self, remotes: List[dict] = None):
+        """
+        The function to get datasets from many remotes. See the Tethys object for details.
+
+        Parameters
+        ----------
+        remotes : list of dict or None
+            list of dict of the S3 remotes to access or None which will parse all public datasets.
+
+        Returns
+        -------
+        list of dict
+            of datasets
+        """
+        if remotes is None:
+            if self._tethys._metadata_cache is None:
+                remotes_obj = await self._retry(
+                    self._fetch_url, utils.public_remote_key
+                )
+            else:
+                remotes_obj = await self._run(
+                    self._tethys._metadata_cache.get_url, utils.public_remote_key
+                )
+            remotes = utils.read_json_zstd(remotes_obj)
+
+        remotes_m = []
+        for remote in remotes:
+            remote_m = orjson.loads(tdm.base.Remote(**remote).json(exclude_none=True))
+            if "description" in remote_m:
+                _ = remote_m.pop("description")
+            remotes_m.append(remote_m)
+
+        kinds = await asyncio.gather(
+            *[self._load_remote_datasets(r) for r in remotes_m], return_exceptions=True
+        )
+
+        ## A remote that can't be loaded is skipped, unless no remote could be loaded at all
+        errors = [
+            (remote, kind)
+            for remote, kind in zip(remotes_m, kinds)
+            if isinstance(kind, BaseException)
+        ]
+        if errors:
+            if all(kind is not None for kind in kinds) and (not self._tethys._remotes):
+                raise errors[0][1]
+            for remote, err in errors:
+                warn_remote_datasets(remote, "fatal", err)
+
+        setattr(self._tethys, "remotes", remotes)
+
+        return self.datasets
+
+    async def _load_remote_datasets(self, remote: dict):
+        """
+        Get the datasets of a remote like Tethys._load_remote_datasets. Missing datasets and transient errors are warned about, the other errors are raised (see get_datasets).
+        """
+        version = remote["version"]
+        try:
+            ds_list = await self._get_metadata(
+                remote, self._tethys._key_patterns[version]["datasets"]
+            )
+        except Exception as err:
+            kind = classify_aio_error(err)
+            if kind == "fatal":
+                raise
+            warn_remote_datasets(remote, kind, err)
+
+            return kind
+
+        self._tethys._add_remote_datasets(remote, ds_list)
+
+    async def get_versions(self, dataset_id: str):
+        """
+        Function to get the versions of a particular dataset. Concurrent calls for the same dataset share a single download.
+
+        Parameters
+        ----------
+        dataset_id : str
+            The dataset_id of the dataset.
+
+        Returns
+        -------
+        list
+        """
+        if dataset_id not in self._tethys._versions:
+            await self._single_flight(
+                ("versions", dataset_id), self._load_versions, dataset_id
+            )
+
+        return self._tethys._versions[dataset_id]
+
+    async def _load_versions(self, dataset_id: str):
+        """ """
+        if dataset_id not in self._tethys._versions:
+            remote = self._tethys._remotes[dataset_id]
+            rv_key = self._tethys._key_patterns[remote["version"]]["versions"].format(
+                dataset_id=dataset_id
+            )
+            rv_list = await self._get_metadata(remote, rv_key)
+            self._tethys._versions[dataset_id] = rv_list
+
+    async def _load_stations(self, dataset_id: str, version_date: str):
+        """
+        Load the stations of a version of a dataset. Concurrent calls share a single download.
+        """
+        if version_date not in self._tethys._stations.get(dataset_id, {}):
+            await self._single_flight(
+                ("stations", dataset_id, version_date),
+                self._fetch_stations,
+                dataset_id,
+                version_date,
+            )
+
+    async def _fetch_stations(self, dataset_id: str, version_date: str):
+        """ """
+        if version_date not in self._tethys._stations.get(dataset_id, {}):
+            remote = self._tethys._remotes[dataset_id]
+            stn_key = self._tethys._get_stns_rc_key(
+                dataset_id, "stations", version_date
+            )
+            stn_list = await self._get_metadata(remote, stn_key)
+            stn_table = await self._run(StationTable.from_list, stn_list)
+            self._tethys._set_stations(dataset_id, version_date, stn_table)
+
+    async def _load_results_chunks(self, dataset_id: str, version_date: str):
+        """
+        Load the results chunks of a version of a dataset. Concurrent calls share a single download.
+        """
+        if version_date not in self._tethys._results_chunks.get(dataset_id, {}):
+            await self._single_flight(
+                ("results_chunks", dataset_id, version_date),
+                self._fetch_results_chunks,
+                dataset_id,
+                version_date,
+            )
+
+    async def _fetch_results_chunks(self, dataset_id: str, version_date: str):
+        """ """
+        if version_date not in self._tethys._results_chunks.get(dataset_id, {}):
+            remote = self._tethys._remotes[dataset_id]
+            rc_key = self._tethys._get_stns_rc_key(
+                dataset_id, "results_chunks", version_date
+            )
+            rc_list = await self._get_metadata(remote, rc_key)
+            rc_index = await self._run(ResultsChunkIndex, rc_list)
+            utils.update_nested(
+                self._tethys._results_chunks, dataset_id, version_date, rc_index
+            )
+
+    async def get_stations(
+        self,
+        dataset_id: str,
+        geometry: dict = None,
+        lat: float = None,
+        lon: float = None,
+        distance: float = None,
+        version_date: Union[str, datetime, pd.Timestamp] = None,
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        as_table: bool = False,
+    ):
+        """
+        Method to return the stations associated with a dataset. See Tethys.get_stations for the parameters. If the version has no stations object, then a warning is issued and None is returned. The other errors are raised.
+
+        Returns
+        -------
+        list of dict or StationTable
+            of station data
+        """
+        _ = await self.get_versions(dataset_id)
+        vd = self._tethys._get_version_date(dataset_id, version_date)
+
+        try:
+            await self._load_stations(dataset_id, vd)
+        except Exception as err:
+            if classify_aio_error(err) != "missing":
+                raise
+            warnings.warn(
+                "No stations.json.zst file in S3 bucket for dataset_id {} and version_date {}: {}".format(
+                    dataset_id, vd, err
+                ),
+                stacklevel=2,
+            )
+            return None
+
+        return self._tethys.get_stations(
+            dataset_id,
+            geometry,
+            lat,
+            lon,
+            distance,
+            vd,
+            from_date,
+            to_date,
+            as_table,
+        )
+
+    async def _download_chunk(self, remote: dict, chunk: dict):
+        """
+        Download a results chunk and decode it in the executor. With a cache path, the concurrent downloads of the same chunk on this object share a single download into the cache (see _cache_chunk).
+        """
+        cache = self._tethys.cache
+        if isinstance(cache, pathlib.Path):
+            chunk_path = utils.local_results_path(cache, chunk)
+            if not chunk_path.exists():
+                _ = await self._single_flight(
+                    chunk_path, self._cache_chunk, remote, chunk
+                )
+
+            self._tethys._track_chunk(chunk, chunk_path)
+
+            return chunk_path
+
+        content = await self._fetch(remote, chunk["key"])
+
+        return await self._run(utils.decode_results, chunk, io.BytesIO(content), cache)
+
+    async def _cache_chunk(self, remote: dict, chunk: dict):
+        """
+        Download a results chunk into the cache with utils.download_results, which holds the cross-process lock on the chunk. It runs in a thread of its own executor rather than the decoding executor, so the threads that wait on the locks of other processes never hold up the decoding. The requests still run on the event loop.
+        """
+        loop = asyncio.get_running_loop()
+
+        def getter(obj_key, **kwargs):
+            future = asyncio.run_coroutine_threadsafe(
+                self._fetch(remote, obj_key), loop
+            )
+            return io.BytesIO(future.result())
+
+        if self._cache_executor is None:
+            self._cache_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_connections
+            )
+
+        return await loop.run_in_executor(
+            self._cache_executor,
+            functools.partial(
+                utils.download_results,
+                chunk,
+                remote["bucket"],
+                cache=self._tethys.cache,
+                getter=getter,
+            ),
+        )
+
+    async def get_results(
+        self,
+        dataset_id: str,
+        station_ids: Union[str, List[str]] = None,
+        geometry: dict = None,
+        lat: float = None,
+        lon: float = None,
+        distance: float = None,
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        from_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        to_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        version_date: Union[str, pd.Timestamp, datetime] = None,
+        heights: Union[List[Union[int, float]], Union[int, float]] = None,
+        bands: Union[List[int], int] = None,
+        squeeze_dims: bool = False,
+        output_path: Union[str, pathlib.Path] = None,
+        compression: str = "lzf",
+    ):
+        """
+        Function to query the results data given a specific dataset_id and station_ids. See Tethys.get_results for the parameters. The number of simultaneous downloads is set by max_connections rather than threads. The query of the results chunks and the combining of the results run in the executor, so they don't block the event loop.
+
+        Returns
+        -------
+        xr.Dataset
+        """
+        _ = await self.get_versions(dataset_id)
+        vd = self._tethys._get_version_date(dataset_id, version_date)
+
+        if station_ids is None:
+            await self._load_stations(dataset_id, vd)
+        await self._load_results_chunks(dataset_id, vd)
+
+        vd, chunks = await self._run(
+            self._tethys._query_chunks,
+            dataset_id,
+            station_ids,
+            geometry,
+            lat,
+            lon,
+            distance,
+            from_date,
+            to_date,
+            from_mod_date,
+            to_mod_date,
+            vd,
+            heights,
+            bands,
+        )
+
+        if not chunks:
+            return xr.Dataset()
+
+        remote = self._tethys._remotes[dataset_id]
+        results_list = await asyncio.gather(
+            *[self._download_chunk(remote, chunk) for chunk in chunks],
+            return_exceptions=True,
+        )
+        errors = [r for r in results_list if isinstance(r, BaseException)]
+        if errors:
+            self._tethys._release_chunks(
+                [r for r in results_list if not isinstance(r, BaseException)]
+            )
+            raise errors[0]
+
+        xr3 = await self._run(
+            self._tethys._combine_results,
+            dataset_id,
+            vd,
+            list(results_list),
+            geometry,
+            lat,
+            lon,
+            distance,
+            from_date,
+            to_date,
+            from_mod_date,
+            to_mod_date,
+            squeeze_dims,
+            output_path,
+            compression,
+        )
+
+        return xr3
@@ -0,0 +1,194 @@
+"""
+Reusable buffers and copy-free file objects to decode results chunks with.
+"""
+import io
+import threading
+
+from tethysts.imports import lazy_import
+
+zstd = lazy_import("zstandard")
+
+##############################################
+### Parameters
+
+## The maximum size of a zstandard frame header
+frame_header_max_size = 18
+
+##############################################
+### Classes
+
+
+class BufferPool(object):
+    """
+    A pool of bytearray buffers that are reused between decodes, so that each decode doesn't allocate (and grow) a new buffer for the decompressed object. At most max_buffers buffers of at most max_size bytes are kept in the pool; other buffers are left to the garbage collector once they are released, as keeping a buffer of a large object would add to the peak memory of the next decodes rather than save an allocation.
+
+    Parameters
+    ----------
+    max_buffers : int
+        The maximum number of buffers kept in the pool.
+    max_size : int
+        The maximum size in bytes of a buffer kept in the pool.
+
+    Returns
+    -------
+    BufferPool
+    """
+
+    def __init__(self, max_buffers: int = 4, max_size: int = 2**24):
+        """ """
+        self.max_buffers = max_buffers
+        self.max_size = max_size
+        self._buffers = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a buffer from the pool (or a new empty one).
+        """
+        with self._lock:
+            if self._buffers:
+                return self._buffers.pop()
+
+        return bytearray()
+
+    def release(self, buffer: bytearray):
+        """
+        Return a buffer to the pool. There must not be any memoryviews left of the buffer.
+        """
+        if len(buffer) > self.max_size:
+            return
+
+        with self._lock:
+            if len(self._buffers) < self.max_buffers:
+                self._buffers.append(buffer)
+
+
+class BufferFile(io.RawIOBase):
+    """
+    A read-only, seekable file object of a memoryview. Reads return a copy of only the bytes that are read, so a parser can read from a (reusable) buffer without the buffer being copied as a whole first. Reads of at least view_min_size bytes return a memoryview of the buffer rather than a copy, for parsers that copy what they read into arrays anyway (like scipy's netcdf reader); the memoryviews must not be kept once the buffer is reused.
+
+    Parameters
+    ----------
+    view : memoryview
+        The bytes of the file.
+    view_min_size : int or None
+        The minimum size of the reads that return a memoryview. None will always return bytes.
+
+    Returns
+    -------
+    BufferFile
+    """
+
+    def __init__(self, view: memoryview, view_min_size: int = None):
+        """ """
+        self._view = view
+        self.view_min_size = view_min_size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError("Invalid whence: {}".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+
+        return pos
+
+    def read(self, size: int = -1):
+        start = min(self._pos, len(self._view))
+        if (size is None) or (size < 0):
+            stop = len(self._view)
+        else:
+            stop = min(start + size, len(self._view))
+        self._pos = stop
+
+        if (self.view_min_size is not None) and (stop - start) >= self.view_min_size:
+            return self._view[start:stop]
+
+        return self._view[start:stop].tobytes()
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        data = self._view[self._pos : self._pos + len(b)]
+        n = len(data)
+        b[:n] = data
+        self._pos += n
+
+        return n
+
+
+##############################################
+### Functions
+
+
+class _PrefixedStream(object):
+    """
+    A stream of some bytes that were already read from a stream followed by the rest of the stream.
+    """
+
+    def __init__(self, prefix: bytes, file_obj):
+        """ """
+        self._prefix = prefix
+        self._file_obj = file_obj
+
+    def read(self, size: int = -1):
+        if self._prefix:
+            data = self._prefix
+            self._prefix = b""
+            return data
+
+        return self._file_obj.read(size)
+
+
+def decompress_into(file_obj, buffer: bytearray, read_size: int = 2**19):
+    """
+    Stream-decompress a zstandard file object (e.g. the body of a response) directly into a buffer. The buffer is sized from the content size in the frame header if it has one, otherwise it is grown as needed. The compressed object is never held in memory as a whole.
+
+    Returns
+    -------
+    int
+        The number of decompressed bytes in the buffer.
+    """
+    header = file_obj.read(frame_header_max_size)
+    try:
+        content_size = zstd.get_frame_parameters(header).content_size
+    except zstd.ZstdError:
+        content_size = zstd.CONTENTSIZE_UNKNOWN
+    if content_size == zstd.CONTENTSIZE_UNKNOWN:
+        content_size = 0
+
+    min_size = content_size + read_size
+    if len(buffer) < min_size:
+        buffer.extend(bytes(min_size - len(buffer)))
+
+    n = 0
+    with zstd.ZstdDecompressor().stream_reader(
+        _PrefixedStream(header, file_obj), read_size=read_size, closefd=False
+    ) as reader:
+        while True:
+            if (len(buffer) - n) < read_size:
+                buffer.extend(bytes(len(buffer)))
+            with memoryview(buffer) as view:
+                n_read = reader.readinto(view[n:])
+            if n_read == 0:
+                break
+            n += n_read
+
+    return n
@@ -0,0 +1,673 @@
+"""
+Local caching of the remote objects.
+"""
+import collections
+import email.utils
+import io
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+import warnings
+from typing import Union
+
+import orjson
+import requests
+
+from tethysts import utils
+from tethysts.clients import classify_error, remote_name
+from tethysts.imports import imported_types, lazy_import
+from tethysts.locks import FileLock, lock_path, temp_path
+
+s3tethys = lazy_import("s3tethys")
+
+##############################################
+### Parameters
+
+metadata_dir = "metadata"
+tmp_dir = "tmp"
+manifest_name = "manifest.jsonl"
+results_pattern = "*.results.h5"
+
+## The number of access records that are kept in memory before they are appended to the manifest
+flush_records = 100
+
+##############################################
+### Helper functions
+
+
+def write_bytes_atomic(path: pathlib.Path, data: bytes):
+    """
+    Write bytes to a temporary file next to the path and rename it into place so that readers never see a partially written file.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = temp_path(path)
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def fetch_url(
+    url: str,
+    validators: dict = None,
+    timeout: int = 120,
+    session: requests.Session = None,
+):
+    """
+    Get the content of a url with a conditional request if validators (etag and/or last_modified) are passed. The session is used if one is passed.
+
+    Returns
+    -------
+    tuple of (content, validators)
+        content is None if the object was not modified.
+    """
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    if session is None:
+        session = requests
+
+    resp = session.get(url, headers=headers, timeout=timeout)
+
+    if resp.status_code == 304:
+        return None, validators
+
+    resp.raise_for_status()
+
+    validators1 = {
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+    }
+
+    return resp.content, validators1
+
+
+def fetch_s3(
+    s3: "botocore.client.BaseClient", bucket: str, obj_key: str, validators: dict = None
+):
+    """
+    Get the content of an S3 object with a conditional request if validators (etag and/or last_modified) are passed.
+
+    Returns
+    -------
+    tuple of (content, validators)
+        content is None if the object was not modified.
+    """
+    kwargs = {"Bucket": bucket, "Key": obj_key}
+    if validators:
+        if validators.get("etag"):
+            kwargs["IfNoneMatch"] = validators["etag"]
+        elif validators.get("last_modified"):
+            kwargs["IfModifiedSince"] = email.utils.parsedate_to_datetime(
+                validators["last_modified"]
+            )
+
+    try:
+        resp = s3.get_object(**kwargs)
+    except imported_types("botocore.exceptions", "ClientError") as err:
+        status = err.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        code = err.response.get("Error", {}).get("Code")
+        if (status == 304) or (code in ("304", "NotModified")):
+            return None, validators
+        raise
+
+    content = resp["Body"].read()
+
+    last_modified = resp.get("LastModified")
+    if last_modified is not None:
+        last_modified = email.utils.format_datetime(last_modified, usegmt=True)
+
+    validators1 = {"etag": resp.get("ETag"), "last_modified": last_modified}
+
+    return content, validators1
+
+
+def url_name(url: str):
+    """
+    A relative path for the local copies of the objects of a url (or a remote name), with the scheme dropped and the port separator replaced.
+    """
+    url1 = urllib.parse.urlparse(url)
+
+    return (url1.netloc.replace(":", "_") + url1.path).lstrip("/")
+
+
+##############################################
+### Class
+
+
+class MetadataCache(object):
+    """
+    A local cache of the remote metadata objects (remotes, datasets, versions, stations, and results_chunks). Each object is stored with its ETag and Last-Modified validators. Within the ttl the local copy is used without contacting the remote; after the ttl a conditional request revalidates the local copy and the object is only downloaded again if it has changed. If the revalidation fails with a transient error (e.g. the remote can't be reached), the local copy is used. Other errors are raised, and if the object no longer exists in the remote, the local copy is removed.
+
+    Parameters
+    ----------
+    cache_path : str or pathlib.Path
+        The base cache path. The objects are stored in the metadata directory within it.
+    ttl : int or float
+        The number of seconds after a download or revalidation that the local copy is used without revalidation. 0 will revalidate on every request.
+
+    Returns
+    -------
+    MetadataCache
+    """
+
+    def __init__(self, cache_path: Union[str, pathlib.Path], ttl: float = 0):
+        """ """
+        self.path = pathlib.Path(cache_path).joinpath(metadata_dir)
+        self.ttl = ttl
+
+    def _get(self, name: str, fetch):
+        """ """
+        data_path = self.path.joinpath(name)
+        meta_path = data_path.with_name(data_path.name + ".meta.json")
+
+        validators = None
+        if meta_path.exists() and data_path.exists():
+            try:
+                validators = orjson.loads(meta_path.read_bytes())
+            except orjson.JSONDecodeError:
+                validators = None
+
+        if validators is not None:
+            if (time.time() - validators.get("checked", 0)) < self.ttl:
+                return data_path.read_bytes()
+
+            try:
+                content, validators1 = fetch(validators)
+            except Exception as err:
+                kind = classify_error(err)
+                if kind == "transient":
+                    return data_path.read_bytes()
+                if kind == "missing":
+                    data_path.unlink(missing_ok=True)
+                    meta_path.unlink(missing_ok=True)
+                raise
+
+            if content is None:
+                validators["checked"] = time.time()
+                write_bytes_atomic(meta_path, orjson.dumps(validators))
+                return data_path.read_bytes()
+        else:
+            content, validators1 = fetch(None)
+
+        validators1["checked"] = time.time()
+        write_bytes_atomic(data_path, content)
+        write_bytes_atomic(meta_path, orjson.dumps(validators1))
+
+        return content
+
+    def get_url(self, url: str, session: requests.Session = None):
+        """
+        Get the content of an object from a url.
+        """
+        return self._get(url_name(url), lambda v: fetch_url(url, v, session=session))
+
+    def get_object(
+        self,
+        obj_key: str,
+        bucket: str,
+        s3: "botocore.client.BaseClient" = None,
+        connection_config: dict = None,
+        public_url: str = None,
+        session: requests.Session = None,
+    ):
+        """
+        Get the content of an object from a remote. The public_url is used (with the session if passed) if it is passed, otherwise the s3 client or the connection_config. The local copies are stored by the endpoint and bucket of the remote (see clients.remote_name), so the same bucket name on different endpoints doesn't share them.
+        """
+        if public_url is not None:
+            url = utils.create_public_s3_url(str(public_url), bucket, obj_key)
+            fetch = lambda v: fetch_url(url, v, session=session)
+        elif (s3 is not None) or isinstance(connection_config, dict):
+            if s3 is None:
+                s3 = s3tethys.s3_client(connection_config)
+            fetch = lambda v: fetch_s3(s3, bucket, obj_key, v)
+        else:
+            raise TypeError(
+                "One of s3, connection_config, or public_url needs to be correctly defined."
+            )
+
+        if (public_url is None) and (not isinstance(connection_config, dict)):
+            connection_config = {"endpoint_url": s3.meta.endpoint_url}
+        remote = {
+            "bucket": bucket,
+            "public_url": public_url,
+            "connection_config": connection_config,
+        }
+        name = "{}/{}".format(url_name(remote_name(remote)), obj_key)
+
+        return self._get(name, fetch)
+
+
+class MemoryBudget(object):
+    """
+    Tracks the memory used by the downloaded results chunks of a single query. Once the in-memory chunks reach the budget, the remaining chunks are spilled to files in a temporary directory and the merged results are written to and opened from a file rather than held in memory.
+
+    Parameters
+    ----------
+    max_size : int or float
+        The memory budget in MBs.
+    cache : pathlib.Path or None
+        The cache path. If it's a path, then the temporary directory will be created in the cache path, otherwise in the system temporary directory.
+
+    Returns
+    -------
+    MemoryBudget
+    """
+
+    def __init__(self, max_size: Union[int, float], cache: pathlib.Path = None):
+        """ """
+        self.max_bytes = int(max_size * 1000000)
+        self.used = 0
+        self._lock = threading.Lock()
+        if isinstance(cache, pathlib.Path):
+            self._base_path = cache.joinpath(tmp_dir)
+        else:
+            self._base_path = None
+        self._path = None
+
+    @property
+    def path(self):
+        """
+        The temporary directory of the query. It is created on first use.
+        """
+        with self._lock:
+            if self._path is None:
+                if self._base_path is not None:
+                    self._base_path.mkdir(parents=True, exist_ok=True)
+                self._path = pathlib.Path(tempfile.mkdtemp(dir=self._base_path))
+
+        return self._path
+
+    @property
+    def chunks_path(self):
+        """
+        The directory of the spilled results chunks.
+        """
+        return self.path.joinpath("chunks")
+
+    def spill(self):
+        """
+        Should the next results chunk be spilled to disk?
+        """
+        with self._lock:
+            return self.used >= self.max_bytes
+
+    def add(self, data_obj):
+        """
+        Account for a downloaded results chunk.
+        """
+        if isinstance(data_obj, io.BytesIO):
+            with self._lock:
+                self.used += data_obj.getbuffer().nbytes
+
+    def exceeded(self, results_list: list):
+        """
+        Is the total size of the results chunks (in memory and on disk) larger than the budget?
+        """
+        total = 0
+        for data_obj in results_list:
+            if isinstance(data_obj, io.BytesIO):
+                total += data_obj.getbuffer().nbytes
+            else:
+                total += pathlib.Path(data_obj).stat().st_size
+
+        return total > self.max_bytes
+
+    def remove_chunks(self):
+        """
+        Remove the spilled results chunks.
+        """
+        if self._path is not None:
+            shutil.rmtree(self.chunks_path, ignore_errors=True)
+
+    def remove(self):
+        """
+        Remove the temporary directory.
+        """
+        if self._path is not None:
+            shutil.rmtree(self._path, ignore_errors=True)
+
+
+class CacheManager(object):
+    """
+    Manages the results chunks in the local cache. It keeps a manifest of every cached results chunk with its size, last access time, and chunk_hash, so the total size of the cache is always known and the least recently used files can be evicted without scanning the cache directory. Each access is an O(1) update of the in-memory LRU order and a record for the manifest file. The records are appended in one write once a query has finished (see flush), and the manifest is compacted once it has grown to twice the number of entries. The manifest is shared by the processes that use the cache: the flushes, evictions and compactions hold a lock on the manifest and first apply the records of the other processes, so the total size and the LRU order include their files.
+
+    Parameters
+    ----------
+    cache_path : str or pathlib.Path
+        The base cache path.
+    max_size : int, float, or None
+        The total maximum size of all results chunks in the cache in MBs. None will not limit the size.
+    max_age : int, float, or None
+        The maximum time since the last access of the results chunks in the cache in days. None will not limit the age.
+
+    Returns
+    -------
+    CacheManager
+    """
+
+    def __init__(
+        self,
+        cache_path: Union[str, pathlib.Path],
+        max_size: Union[int, float] = None,
+        max_age: Union[int, float] = None,
+    ):
+        """ """
+        self.path = pathlib.Path(cache_path)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.total_size = 0
+        self._manifest_path = self.path.joinpath(manifest_name)
+        self._entries = collections.OrderedDict()
+        self._pinned = collections.Counter()
+        self._lock = threading.RLock()
+        self._n_records = 0
+        self._pending = []
+        self._offset = 0
+        self._manifest_ino = None
+        self._event = threading.Event()
+        self._stop = False
+        self._thread = None
+
+        self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<CacheManager: {} files, {:.1f} MB>".format(
+            len(self), self.total_size * 0.000001
+        )
+
+    def _load(self):
+        """
+        Load the manifest. If there is no manifest, then the cache is scanned once to create it.
+        """
+        if self._manifest_path.exists():
+            self._read()
+            return
+
+        entries = {}
+        for file_path in self.path.rglob(results_pattern):
+            rel = file_path.relative_to(self.path).as_posix()
+            if rel.startswith(tmp_dir + "/"):
+                continue
+            stats = file_path.stat()
+            chunk_hash = file_path.name.split(".")[-3]
+            entries[rel] = [stats.st_size, stats.st_mtime, chunk_hash]
+
+        for rel, entry in sorted(entries.items(), key=lambda e: e[1][1]):
+            self._entries[rel] = entry
+            self.total_size += entry[0]
+
+        self.compact()
+
+    def _apply(self, record: dict):
+        """
+        Apply a record of the manifest to the entries. An access that is older than the entry is ignored.
+
+        Returns
+        -------
+        bool
+            True if the access is older than the most recent entry, so the entries are no longer in LRU order.
+        """
+        rel = record["path"]
+        entry = self._entries.get(rel)
+        if "deleted" in record:
+            if entry is not None:
+                del self._entries[rel]
+                self.total_size -= entry[0]
+            return False
+
+        if (entry is not None) and (entry[1] > record["atime"]):
+            return False
+
+        last = next(reversed(self._entries.values()), None)
+        if entry is not None:
+            del self._entries[rel]
+            self.total_size -= entry[0]
+        self._entries[rel] = [record["size"], record["atime"], record.get("chunk_hash")]
+        self.total_size += record["size"]
+
+        return (last is not None) and (record["atime"] < last[1])
+
+    def _read(self):
+        """
+        Apply the records that have been appended to the manifest since the last read (including the records of the other processes that share the cache). The manifest is read again from the start if another process has rewritten it.
+        """
+        try:
+            f = open(self._manifest_path, "rb")
+        except FileNotFoundError:
+            return
+
+        with f:
+            ino = os.fstat(f.fileno()).st_ino
+            reset = ino != self._manifest_ino
+            if reset:
+                self._entries.clear()
+                self.total_size = 0
+                self._n_records = 0
+                self._offset = 0
+                self._manifest_ino = ino
+            f.seek(self._offset)
+            data = f.read()
+
+        ## Only the complete lines
+        end = data.rfind(b"\n") + 1
+        unordered = False
+        for line in data[:end].splitlines():
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            self._n_records += 1
+            unordered |= self._apply(record)
+        self._offset += end
+
+        ## The accesses that have not been written yet
+        if reset:
+            for record in self._pending:
+                unordered |= self._apply(record)
+
+        if unordered:
+            self._entries = collections.OrderedDict(
+                sorted(self._entries.items(), key=lambda e: e[1][1])
+            )
+
+    def _flush(self):
+        """
+        Read the new records of the manifest and append the pending records. The manifest lock must be held.
+        """
+        self._read()
+        if self._pending:
+            data = b"".join(orjson.dumps(record) + b"\n" for record in self._pending)
+            with open(self._manifest_path, "ab") as f:
+                f.write(data)
+                self._offset = f.tell()
+            self._manifest_ino = os.stat(self._manifest_path).st_ino
+            self._n_records += len(self._pending)
+            self._pending = []
+
+    def flush(self):
+        """
+        Write the pending access records to the manifest (at once while holding the lock on the manifest) and apply the records of the other processes.
+        """
+        with self._lock:
+            with FileLock(lock_path(self._manifest_path)):
+                self._flush()
+
+    def compact(self):
+        """
+        Rewrite the manifest with only the current entries. The records of the other processes are merged first while holding the lock on the manifest.
+        """
+        with self._lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with FileLock(lock_path(self._manifest_path)):
+                self._flush()
+                lines = [
+                    orjson.dumps(
+                        {"path": rel, "size": size, "atime": atime, "chunk_hash": h}
+                    )
+                    for rel, (size, atime, h) in self._entries.items()
+                ]
+                data = b"\n".join(lines) + b"\n" if lines else b""
+                write_bytes_atomic(self._manifest_path, data)
+                self._manifest_ino = os.stat(self._manifest_path).st_ino
+                self._offset = len(data)
+                self._n_records = len(lines)
+
+    def _relative(self, file_path: Union[str, pathlib.Path]):
+        """
+        The manifest key of a file path or None if the file is not a cached results chunk.
+        """
+        file_path = pathlib.Path(file_path)
+        if not file_path.is_relative_to(self.path):
+            return None
+
+        rel = file_path.relative_to(self.path).as_posix()
+        if rel.startswith(tmp_dir + "/") or rel.startswith(metadata_dir + "/"):
+            return None
+
+        return rel
+
+    def touch(
+        self,
+        file_path: Union[str, pathlib.Path],
+        chunk_hash: str = None,
+        pin: bool = False,
+    ):
+        """
+        Record an access of a cached results chunk. If pin is True, then the file will not be evicted by this object until it is unpinned (the pins are not seen by the other processes).
+        """
+        rel = self._relative(file_path)
+        if rel is None:
+            return
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(rel)
+            if entry is None:
+                try:
+                    size = pathlib.Path(file_path).stat().st_size
+                except FileNotFoundError:
+                    return
+                entry = [size, now, chunk_hash]
+                self._entries[rel] = entry
+                self.total_size += size
+            else:
+                entry[1] = now
+                if chunk_hash is not None:
+                    entry[2] = chunk_hash
+                self._entries.move_to_end(rel)
+
+            if pin:
+                self._pinned[rel] += 1
+
+            self._pending.append(
+                {"path": rel, "size": entry[0], "atime": now, "chunk_hash": entry[2]}
+            )
+            if len(self._pending) >= flush_records:
+                self.flush()
+
+    def unpin(self, file_path: Union[str, pathlib.Path]):
+        """
+        Allow a pinned file to be evicted again.
+        """
+        rel = self._relative(file_path)
+        if rel is None:
+            return
+
+        with self._lock:
+            if self._pinned[rel] > 1:
+                self._pinned[rel] -= 1
+            else:
+                self._pinned.pop(rel, None)
+
+    def evict(
+        self, max_size: Union[int, float] = None, max_age: Union[int, float] = None
+    ):
+        """
+        Remove the least recently used results chunks until the cache is within max_size (in MBs) and remove all results chunks that have not been accessed within max_age (in days). Pinned files are skipped.
+
+        Returns
+        -------
+        list of str
+            The removed files relative to the cache path.
+        """
+        if max_size is not None:
+            max_bytes = max_size * 1000000
+        else:
+            max_bytes = None
+        if max_age is not None:
+            cutoff = time.time() - (max_age * 60 * 60 * 24)
+        else:
+            cutoff = None
+
+        removed = []
+        with self._lock, FileLock(lock_path(self._manifest_path)):
+            self._flush()
+            for rel, (size, atime, h) in list(self._entries.items()):
+                over_size = (max_bytes is not None) and (self.total_size > max_bytes)
+                too_old = (cutoff is not None) and (atime < cutoff)
+                if not (over_size or too_old):
+                    break
+                if rel in self._pinned:
+                    continue
+
+                self.path.joinpath(rel).unlink(missing_ok=True)
+                del self._entries[rel]
+                self.total_size -= size
+                self._pending.append({"path": rel, "deleted": True})
+                removed.append(rel)
+
+            self._flush()
+
+        if self._n_records > (2 * len(self._entries) + 1000):
+            self.compact()
+
+        return removed
+
+    def start(self):
+        """
+        Start the background eviction thread. It evicts with the max_size and max_age of the object each time an eviction is requested.
+        """
+        if (self._thread is None) or (not self._thread.is_alive()):
+            self._stop = False
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background eviction thread and write the pending records.
+        """
+        self.flush()
+        self._stop = True
+        self._event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def request_eviction(self):
+        """
+        Trigger an eviction in the background thread (if it has been started).
+        """
+        self._event.set()
+
+    def _run(self):
+        """ """
+        while True:
+            self._event.wait()
+            self._event.clear()
+            if self._stop:
+                break
+            try:
+                self.evict(self.max_size, self.max_age)
+            except Exception as err:
+                warnings.warn("Cache eviction failed: {}".format(err))
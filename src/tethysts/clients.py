@@ -0,0 +1,606 @@
+"""
+Pooled connections to the remotes, the adaptive download concurrency, and the retry policy.
+"""
+import collections
+import concurrent.futures
+import io
+import random
+import threading
+import time
+from typing import Union
+
+import orjson
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from tethysts import utils
+from tethysts.imports import imported_types, lazy_import
+
+np = lazy_import("numpy")
+s3tethys = lazy_import("s3tethys")
+
+##############################################
+### Parameters
+
+throttle_status_codes = (429, 503)
+throttle_error_codes = (
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequests",
+    "ServiceUnavailable",
+)
+missing_error_codes = ("NoSuchKey", "NoSuchBucket", "NotFound", "404")
+
+## The size of the reads of the hedged requests, between which the losing request is stopped
+hedge_read_size = 2**18
+
+##############################################
+### Helper functions
+
+
+def remote_name(remote: dict):
+    """
+    A name that identifies the remote (endpoint and bucket).
+    """
+    if remote.get("public_url") is not None:
+        base = str(remote["public_url"])
+    else:
+        base = remote["connection_config"].get("endpoint_url", "s3")
+
+    return "{}/{}".format(base.rstrip("/"), remote["bucket"])
+
+
+def is_throttled(err: Exception):
+    """
+    Is the exception a sign that the remote is overloaded (throttling responses and timeouts)?
+    """
+    if isinstance(err, requests.HTTPError) and (err.response is not None):
+        return err.response.status_code in throttle_status_codes
+    if isinstance(err, imported_types("botocore.exceptions", "ClientError")):
+        status = err.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        code = err.response.get("Error", {}).get("Code")
+        return (status in throttle_status_codes) or (code in throttle_error_codes)
+
+    return isinstance(
+        err,
+        (requests.Timeout, requests.ConnectionError)
+        + imported_types(
+            "botocore.exceptions", "ReadTimeoutError", "ConnectTimeoutError"
+        ),
+    )
+
+
+def classify_error(err: Exception):
+    """
+    Classify an exception of a request to a remote.
+
+    Returns
+    -------
+    str
+        missing if the object does not exist, transient if the request could succeed when retried (throttling, timeouts, server errors, and broken connections), or fatal otherwise (e.g. access denied or a corrupt object).
+    """
+    if isinstance(err, FileNotFoundError):
+        return "missing"
+    if isinstance(err, requests.HTTPError) and (err.response is not None):
+        status = err.response.status_code
+        if status == 404:
+            return "missing"
+        if (status >= 500) or (status in throttle_status_codes):
+            return "transient"
+        return "fatal"
+    if isinstance(err, imported_types("botocore.exceptions", "ClientError")):
+        status = err.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        code = err.response.get("Error", {}).get("Code")
+        if (status == 404) or (code in missing_error_codes):
+            return "missing"
+        if is_throttled(err) or ((status is not None) and (status >= 500)):
+            return "transient"
+        return "fatal"
+    if is_throttled(err) or isinstance(
+        err,
+        (
+            requests.RequestException,
+            urllib3.exceptions.HTTPError,
+            ConnectionError,
+            TimeoutError,
+        )
+        + imported_types(
+            "botocore.exceptions",
+            "HTTPClientError",
+            "IncompleteReadError",
+            "ResponseStreamingError",
+        ),
+    ):
+        return "transient"
+
+    return "fatal"
+
+
+##############################################
+### Classes
+
+
+class RetryPolicy(object):
+    """
+    How the requests to the remotes are retried. Transient errors (throttling, timeouts, server errors, and broken connections) are retried with full jitter exponential backoff, i.e. a random wait between 0 and base_delay * 2**attempt seconds (capped at max_delay). Missing objects are not retried and are remembered for negative_ttl seconds, so that further requests for them fail immediately. Other errors are raised straight away.
+
+    Hedged requests can optionally be used for the results chunks. Once a results chunk download has taken longer than the hedge_percentile of the recent transfer latencies of the remote, a second request for the same chunk is sent and the first to finish is used. This cuts the tail latency of queries at the cost of a few percent more requests.
+
+    Parameters
+    ----------
+    max_attempts : int
+        The maximum number of attempts of a request (including the first).
+    base_delay : int or float
+        The base of the backoff in seconds.
+    max_delay : int or float
+        The maximum backoff in seconds.
+    connect_timeout : int or float
+        The timeout to establish a connection in seconds (public urls only).
+    read_timeout : int or float
+        The timeout between bytes received in seconds.
+    hedge_percentile : int, float, or None
+        The percentile (0-100) of the latency of the remote after which a hedged request is sent. None will not send hedged requests.
+    negative_ttl : int or float
+        The number of seconds that a missing object is remembered.
+
+    Returns
+    -------
+    RetryPolicy
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: Union[int, float] = 0.25,
+        max_delay: Union[int, float] = 10,
+        connect_timeout: Union[int, float] = 10,
+        read_timeout: Union[int, float] = 120,
+        hedge_percentile: Union[int, float] = None,
+        negative_ttl: Union[int, float] = 300,
+    ):
+        """ """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.hedge_percentile = hedge_percentile
+        self.negative_ttl = negative_ttl
+
+    def backoff(self, attempt: int):
+        """
+        The jittered wait in seconds after a failed attempt (starting at 0).
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def retry(self, err: Exception, attempt: int, classify=classify_error):
+        """
+        Should a request be retried after the error of the attempt (starting at 0)? Missing objects are raised as FileNotFoundError. classify is the function that classifies the error (see classify_error).
+        """
+        kind = classify(err)
+        if kind == "missing":
+            if not isinstance(err, FileNotFoundError):
+                raise FileNotFoundError(str(err)) from err
+            return False
+
+        return (kind == "transient") and (attempt + 1 < self.max_attempts)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call the function with the retries.
+        """
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                if not self.retry(err, attempt):
+                    raise
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+
+class AdaptiveConcurrency(object):
+    """
+    Limits the number of simultaneous downloads from a remote and adapts the limit to the remote with additive increase/multiplicative decrease (AIMD). The limit grows by one for each full window of successful downloads while there are more downloads waiting than the limit allows. It is halved on throttling errors and timeouts, and reduced by a tenth when the average latency rises above latency_tolerance times the lowest observed latency (i.e. the remote or the network is saturated). There is at most one decrease per round trip.
+
+    Parameters
+    ----------
+    max_limit : int
+        The cap of the number of simultaneous downloads.
+    initial : int
+        The starting limit.
+    min_limit : int
+        The lowest limit.
+    latency_tolerance : float
+        The ratio of the average latency to the lowest latency above which the limit is reduced.
+
+    Returns
+    -------
+    AdaptiveConcurrency
+    """
+
+    def __init__(
+        self,
+        max_limit: int = 30,
+        initial: int = 8,
+        min_limit: int = 1,
+        latency_tolerance: float = 3.0,
+    ):
+        """ """
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_tolerance = latency_tolerance
+        self._limit = float(max(min(initial, max_limit), min_limit))
+        self._in_flight = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+        self._latency = None
+        self._min_latency = None
+        self._last_decrease = 0
+        self._bytes = 0
+        self._seconds = 0.0
+        self._samples = collections.deque(maxlen=256)
+        self.n_requests = 0
+        self.n_throttled = 0
+        self.n_hedged = 0
+
+    @property
+    def limit(self):
+        """
+        The current number of simultaneous downloads.
+        """
+        return int(self._limit)
+
+    def acquire(self):
+        """
+        Block until a download slot is available.
+        """
+        with self._cond:
+            self._waiting += 1
+            while self._in_flight >= int(self._limit):
+                self._cond.wait()
+            self._waiting -= 1
+            self._in_flight += 1
+
+    def try_acquire(self):
+        """
+        Take a download slot if one is available without waiting.
+
+        Returns
+        -------
+        bool
+            Whether a slot was taken.
+        """
+        with self._cond:
+            if self._in_flight >= int(self._limit):
+                return False
+            self._in_flight += 1
+
+        return True
+
+    def record_hedge(self):
+        """
+        Count a hedged request.
+        """
+        with self._cond:
+            self.n_hedged += 1
+
+    def release(self, latency: float = None, nbytes: int = 0, throttled: bool = False):
+        """
+        Release a download slot and adjust the limit from the outcome of the download.
+        """
+        now = time.monotonic()
+
+        with self._cond:
+            saturated = (self._waiting > 0) or (self._in_flight >= int(self._limit))
+            self._in_flight -= 1
+            self.n_requests += 1
+
+            if latency is not None:
+                if self._latency is None:
+                    self._latency = latency
+                else:
+                    self._latency = 0.8 * self._latency + 0.2 * latency
+                if (self._min_latency is None) or (latency < self._min_latency):
+                    self._min_latency = latency
+                self._samples.append(latency)
+                self._bytes += nbytes
+                self._seconds += latency
+
+            rtt = self._latency or 0
+            can_decrease = (now - self._last_decrease) > rtt
+
+            if throttled:
+                self.n_throttled += 1
+                if can_decrease:
+                    self._limit = max(self.min_limit, self._limit * 0.5)
+                    self._last_decrease = now
+            elif latency is not None:
+                congested = self._latency > (
+                    self.latency_tolerance * max(self._min_latency, 0.01)
+                )
+                if congested:
+                    if can_decrease:
+                        self._limit = max(self.min_limit, self._limit * 0.9)
+                        self._last_decrease = now
+                elif saturated:
+                    self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+            self._cond.notify_all()
+
+    def percentile(self, q: Union[int, float], min_samples: int = 20):
+        """
+        The percentile of the recent transfer latencies of the downloads or None if there are fewer than min_samples.
+        """
+        with self._cond:
+            if len(self._samples) < min_samples:
+                return None
+            samples = list(self._samples)
+
+        return float(np.percentile(samples, q))
+
+    def stats(self):
+        """
+        The current limit and the observations it is based on.
+
+        Returns
+        -------
+        dict
+        """
+        with self._cond:
+            if self._seconds > 0:
+                throughput = self._bytes / self._seconds * self.limit
+            else:
+                throughput = None
+            stats = {
+                "limit": self.limit,
+                "max_limit": self.max_limit,
+                "in_flight": self._in_flight,
+                "latency": self._latency,
+                "min_latency": self._min_latency,
+                "throughput": throughput,
+                "n_requests": self.n_requests,
+                "n_throttled": self.n_throttled,
+                "n_hedged": self.n_hedged,
+            }
+
+        return stats
+
+
+class ClientPool(object):
+    """
+    The connections to the remotes for the life of a Tethys object. Remotes with a public_url share a single requests.Session, which keeps a separate connection pool for each host. Remotes with a connection_config get one botocore client per connection_config. The session and the clients are created on first use and reused by every metadata and results chunk request afterwards, so repeated queries don't need to open new connections (and do the TLS handshakes again).
+
+    Parameters
+    ----------
+    max_pool_connections : int
+        The maximum number of connections kept open per remote. Requests beyond this number still run, but their connections are closed afterwards rather than kept in the pool.
+    policy : RetryPolicy or None
+        The timeouts, negative caching, and hedging of the requests. None will use the default RetryPolicy. The retries themselves are done by the callers, because the errors can also happen while the objects are read.
+
+    Returns
+    -------
+    ClientPool
+    """
+
+    def __init__(self, max_pool_connections: int = 30, policy: RetryPolicy = None):
+        """ """
+        if policy is None:
+            policy = RetryPolicy()
+        self.max_pool_connections = max_pool_connections
+        self.policy = policy
+        self._session = None
+        self._s3_clients = {}
+        self._limiters = {}
+        self._missing = {}
+        self._hedge_executor = None
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        ## The connections can't be pickled, so a pickled ClientPool (e.g. in a dask task on another process) opens its own
+        return (ClientPool, (self.max_pool_connections, self.policy))
+
+    @property
+    def session(self):
+        """
+        The requests.Session for the public urls.
+        """
+        with self._lock:
+            if self._session is None:
+                adapter = HTTPAdapter(
+                    pool_connections=10, pool_maxsize=self.max_pool_connections
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+
+        return self._session
+
+    def s3(self, connection_config: dict):
+        """
+        The botocore client of a connection_config.
+        """
+        conn_key = orjson.dumps(connection_config, option=orjson.OPT_SORT_KEYS)
+
+        with self._lock:
+            s3 = self._s3_clients.get(conn_key)
+            if s3 is None:
+                s3 = s3tethys.s3_client(
+                    connection_config,
+                    self.max_pool_connections,
+                    max_attempts=1,
+                    read_timeout=self.policy.read_timeout,
+                )
+                self._s3_clients[conn_key] = s3
+
+        return s3
+
+    def limiter(self, remote: dict):
+        """
+        The AdaptiveConcurrency of a remote. The cap is the max_pool_connections.
+        """
+        name = remote_name(remote)
+
+        with self._lock:
+            limiter = self._limiters.get(name)
+            if limiter is None:
+                limiter = AdaptiveConcurrency(self.max_pool_connections)
+                self._limiters[name] = limiter
+
+        return limiter
+
+    def concurrency(self):
+        """
+        The stats of the adaptive concurrency of the remotes that have been downloaded from.
+
+        Returns
+        -------
+        dict
+            remote name to the dict of AdaptiveConcurrency.stats
+        """
+        with self._lock:
+            limiters = dict(self._limiters)
+
+        return {name: limiter.stats() for name, limiter in limiters.items()}
+
+    def remote_kwargs(self, remote: dict):
+        """
+        The pooled client of a remote as the s3 or session keyword argument of utils.get_object.
+        """
+        if remote.get("public_url") is not None:
+            return {"session": self.session}
+        else:
+            return {"s3": self.s3(remote["connection_config"])}
+
+    def get_object(
+        self,
+        remote: dict,
+        obj_key: str,
+        range_start: int = None,
+        range_end: int = None,
+    ):
+        """
+        Get the file object of an object (or a byte range of it) in a remote. Raises a FileNotFoundError if the object does not exist (or did not exist within the negative_ttl).
+        """
+        missing_key = (remote_name(remote), obj_key)
+        expires = self._missing.get(missing_key)
+        if expires is not None:
+            if time.monotonic() < expires:
+                raise FileNotFoundError(obj_key)
+            self._missing.pop(missing_key, None)
+
+        try:
+            file_obj = utils.get_object(
+                obj_key,
+                remote["bucket"],
+                connection_config=remote.get("connection_config"),
+                public_url=remote.get("public_url"),
+                connect_timeout=self.policy.connect_timeout,
+                read_timeout=self.policy.read_timeout,
+                range_start=range_start,
+                range_end=range_end,
+                **self.remote_kwargs(remote),
+            )
+        except Exception as err:
+            if classify_error(err) == "missing":
+                self._missing[missing_key] = time.monotonic() + self.policy.negative_ttl
+            raise
+
+        return file_obj
+
+    def get_object_hedged(
+        self,
+        remote: dict,
+        obj_key: str,
+        limiter: AdaptiveConcurrency = None,
+        range_start: int = None,
+        range_end: int = None,
+    ):
+        """
+        Get an object in a remote with a hedged request (see RetryPolicy). The object is read into a BytesIO object. The hedged request takes a download slot of the limiter (so it counts towards the concurrency of the remote) and is only sent once a slot is free. The executor of the requests has room for a hedged request of each of the downloads. Once one of the requests has finished, the other stops reading and its response is closed. The threshold is the hedge_percentile of the transfer latencies of the remote (the requests and the reads of the bodies, not the decoding of the chunks). Falls back to get_object if hedging is not enabled, there aren't enough latencies of the remote yet, or a byte range is requested (the latencies are of whole objects).
+        """
+        if (
+            (self.policy.hedge_percentile is None)
+            or (limiter is None)
+            or (range_start is not None)
+            or (range_end is not None)
+        ):
+            return self.get_object(remote, obj_key, range_start, range_end)
+
+        threshold = limiter.percentile(self.policy.hedge_percentile)
+        if threshold is None:
+            return self.get_object(remote, obj_key)
+
+        with self._lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_pool_connections * 2
+                )
+            executor = self._hedge_executor
+
+        finished = threading.Event()
+
+        def read():
+            file_obj = self.get_object(remote, obj_key)
+            try:
+                buf = io.BytesIO()
+                while not finished.is_set():
+                    data = file_obj.read(hedge_read_size)
+                    if not data:
+                        buf.seek(0)
+                        return buf
+                    buf.write(data)
+            finally:
+                file_obj.close()
+
+        def hedge():
+            throttled = False
+            try:
+                return read()
+            except Exception as err:
+                throttled = is_throttled(err)
+                raise
+            finally:
+                limiter.release(throttled=throttled)
+
+        ## The hedged request takes its own download slot, so it waits for a free one while the first request is still running
+        futures = [executor.submit(read)]
+        done, _ = concurrent.futures.wait(futures, timeout=threshold)
+        while not done:
+            if limiter.try_acquire():
+                futures.append(executor.submit(hedge))
+                limiter.record_hedge()
+                break
+            done, _ = concurrent.futures.wait(futures, timeout=threshold)
+
+        ## The losing request stops reading and its response is closed
+        try:
+            for f in concurrent.futures.as_completed(futures):
+                if f.exception() is None:
+                    return f.result()
+        finally:
+            finished.set()
+            for f in futures:
+                f.cancel()
+
+        raise futures[0].exception()
+
+    def close(self):
+        """
+        Close the open connections.
+        """
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+            for s3 in self._s3_clients.values():
+                s3.close()
+            self._s3_clients = {}
+            if self._hedge_executor is not None:
+                self._hedge_executor.shutdown(wait=False)
+                self._hedge_executor = None
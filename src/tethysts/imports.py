@@ -0,0 +1,39 @@
+"""
+Lazy imports of the heavy dependencies, so that importing tethysts (and creating a Tethys object) doesn't pay for the modules that only the results queries need.
+"""
+import importlib.util
+import sys
+
+##############################################
+### Functions
+
+
+def lazy_import(name: str):
+    """
+    Import a module that is only loaded on the first access of one of its attributes. A module that has already been imported is returned as is. Raises an ImportError (like a normal import) if the module is not installed.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named {}".format(name), name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
+
+
+def imported_types(name: str, *attrs: str):
+    """
+    The classes (e.g. the exceptions) of a module if it has already been imported, otherwise an empty tuple. An object can't be an instance of a class of a module that hasn't been imported yet, so isinstance checks and except clauses can use these without importing the module.
+    """
+    module = sys.modules.get(name)
+    if (module is None) or (type(module).__name__ != "module"):
+        return ()
+
+    return tuple(getattr(module, attr) for attr in attrs)
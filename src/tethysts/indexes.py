@@ -0,0 +1,632 @@
+"""
+Index structures that are built once per dataset version and reused by the queries.
+"""
+from __future__ import annotations
+
+from datetime import datetime
+from typing import List, Optional, Union
+
+import orjson
+
+from tethysts.imports import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+shapely = lazy_import("shapely")
+
+##############################################
+### Helper functions
+
+
+def to_datetime64(date: Union[str, pd.Timestamp, datetime]):
+    """
+    Convert a date to a naive (UTC) numpy datetime64 for comparisons against the columnar tables.
+    """
+    date1 = pd.Timestamp(date)
+    if date1.tzinfo is not None:
+        date1 = date1.tz_convert(None)
+
+    return date1.to_datetime64()
+
+
+def nearest_axis(axis: np.ndarray, values: np.ndarray):
+    """
+    The positions of the values of a 1D coordinate (e.g. the lon or lat of a grid) that are nearest to the query values. A regular coordinate is resolved by index arithmetic and any other by a binary search of its sorted values.
+    """
+    axis = np.asarray(axis, dtype=float)
+    values = np.asarray(values, dtype=float)
+    n = len(axis)
+    if n == 0:
+        raise ValueError("The coordinate has no values.")
+    if n == 1:
+        return np.zeros(len(values), dtype=int)
+
+    step = (axis[-1] - axis[0]) / (n - 1)
+    diffs = np.diff(axis)
+    if (step != 0) and np.allclose(diffs, step, rtol=1e-6, atol=0):
+        pos = np.rint((values - axis[0]) / step)
+        return np.clip(pos, 0, n - 1).astype(int)
+
+    if (diffs > 0).all():
+        order = None
+        sorted_axis = axis
+    else:
+        order = np.argsort(axis, kind="stable")
+        sorted_axis = axis[order]
+
+    pos = np.clip(np.searchsorted(sorted_axis, values), 1, n - 1)
+    left = sorted_axis[pos - 1]
+    right = sorted_axis[pos]
+    pos = pos - ((values - left) <= (right - values))
+
+    if order is not None:
+        pos = order[pos]
+
+    return pos
+
+
+##############################################
+### Class
+
+
+class StationTable(object):
+    """
+    A columnar table of the stations of a single dataset version. The columns used for filtering are stored as numpy arrays and the full station dicts are only materialized on request. The stations are kept as a single buffer of json bytes, which is far more compact than a dict per station.
+
+    Parameters
+    ----------
+    station_id : np.ndarray
+        The station_ids.
+    lon : np.ndarray
+        The longitude of the station (the centroid if the geometry is not a point).
+    lat : np.ndarray
+        The latitude of the station (the centroid if the geometry is not a point).
+    from_date : np.ndarray
+        The datetime64 start of the station time_range.
+    to_date : np.ndarray
+        The datetime64 end of the station time_range.
+    bounds : np.ndarray
+        The (n, 4) array of minx, miny, maxx, maxy of the station geometries.
+    blob : bytes
+        The json bytes of all of the stations concatenated together.
+    starts : np.ndarray
+        The start positions of each station in the blob.
+    ends : np.ndarray
+        The end positions of each station in the blob.
+    is_point : bool
+        Are all station geometries points?
+
+    Returns
+    -------
+    StationTable
+    """
+
+    def __init__(
+        self,
+        station_id,
+        lon,
+        lat,
+        from_date,
+        to_date,
+        bounds,
+        blob,
+        starts,
+        ends,
+        is_point,
+    ):
+        """ """
+        self.station_id = station_id
+        self.lon = lon
+        self.lat = lat
+        self.from_date = from_date
+        self.to_date = to_date
+        self.bounds = bounds
+        self.blob = blob
+        self.starts = starts
+        self.ends = ends
+        self.is_point = is_point
+        self._positions = None
+
+    @classmethod
+    def from_list(cls, stn_list: List[dict]):
+        """
+        Create a StationTable from the list of station dicts stored in the stations.json.zst object.
+        """
+        stn_list = [s for s in stn_list if isinstance(s, dict)]
+        n = len(stn_list)
+
+        station_id = np.array([s["station_id"] for s in stn_list], dtype=str)
+        records = [orjson.dumps(s) for s in stn_list]
+        ends = np.cumsum([len(r) for r in records], dtype="int64")
+        starts = ends - np.array([len(r) for r in records], dtype="int64")
+        blob = b"".join(records)
+        del records
+
+        geo_list = [s["geometry"] for s in stn_list]
+        is_point = all(g["type"] == "Point" for g in geo_list)
+        if is_point:
+            coords = np.array([g["coordinates"][:2] for g in geo_list], dtype=float)
+            coords = coords.reshape(n, 2)
+            lon = coords[:, 0]
+            lat = coords[:, 1]
+            bounds = np.column_stack([lon, lat, lon, lat])
+        else:
+            geoms = shapely.from_geojson([orjson.dumps(g) for g in geo_list])
+            centroids = shapely.centroid(geoms)
+            lon = shapely.get_x(centroids)
+            lat = shapely.get_y(centroids)
+            bounds = shapely.bounds(geoms).reshape(n, 4)
+
+        time_ranges = [s.get("time_range", {}) for s in stn_list]
+        from_date = pd.to_datetime([t.get("from_date") for t in time_ranges])
+        to_date = pd.to_datetime([t.get("to_date") for t in time_ranges])
+        if from_date.tz is not None:
+            from_date = from_date.tz_convert(None)
+        if to_date.tz is not None:
+            to_date = to_date.tz_convert(None)
+
+        return cls(
+            station_id,
+            lon,
+            lat,
+            from_date.values.astype("datetime64[ns]"),
+            to_date.values.astype("datetime64[ns]"),
+            bounds,
+            blob,
+            starts,
+            ends,
+            is_point,
+        )
+
+    def __len__(self):
+        return len(self.station_id)
+
+    def __repr__(self):
+        return "<StationTable: {} stations>".format(len(self))
+
+    def __getitem__(self, key):
+        """
+        Select a subset of the table by a boolean mask or an array of positions.
+        """
+        return StationTable(
+            self.station_id[key],
+            self.lon[key],
+            self.lat[key],
+            self.from_date[key],
+            self.to_date[key],
+            self.bounds[key],
+            self.blob,
+            self.starts[key],
+            self.ends[key],
+            self.is_point,
+        )
+
+    def __contains__(self, station_id):
+        return self.positions([station_id])[0] >= 0
+
+    def positions(self, station_ids):
+        """
+        Return the positions of the station_ids in the table (-1 if missing).
+        """
+        if self._positions is None:
+            self._positions = pd.Index(self.station_id)
+
+        return self._positions.get_indexer(np.asarray(station_ids, dtype=str))
+
+    def sel(self, station_ids):
+        """
+        Select the stations by station_ids in the order of station_ids. Missing station_ids are ignored.
+        """
+        pos = self.positions(station_ids)
+
+        return self[pos[pos >= 0]]
+
+    def mask(
+        self,
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        bbox: tuple = None,
+    ):
+        """
+        Create a boolean mask of the stations that pass the temporal and bounding box filters. The from_date filter keeps the stations that start on or after from_date and the to_date filter keeps the stations that end on or before to_date. The bbox is a tuple of (min_lon, min_lat, max_lon, max_lat) and keeps the stations whose envelopes intersect it. Returns None if no filters were passed.
+        """
+        mask = None
+
+        if isinstance(from_date, (str, pd.Timestamp, datetime)):
+            mask = self.from_date >= to_datetime64(from_date)
+
+        if isinstance(to_date, (str, pd.Timestamp, datetime)):
+            mask1 = self.to_date <= to_datetime64(to_date)
+            mask = mask1 if mask is None else mask & mask1
+
+        if bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            mask1 = (
+                (self.bounds[:, 0] <= max_lon)
+                & (self.bounds[:, 2] >= min_lon)
+                & (self.bounds[:, 1] <= max_lat)
+                & (self.bounds[:, 3] >= min_lat)
+            )
+            mask = mask1 if mask is None else mask & mask1
+
+        return mask
+
+    def geometries(self):
+        """
+        Create the shapely geometries of the stations.
+        """
+        if self.is_point:
+            geoms = shapely.points(np.column_stack([self.lon, self.lat]))
+        else:
+            geoms = shapely.from_geojson(
+                [orjson.dumps(r["geometry"]) for r in self._iter_records()]
+            )
+
+        return geoms
+
+    def _iter_records(self):
+        """ """
+        view = memoryview(self.blob)
+        for start, end in zip(self.starts.tolist(), self.ends.tolist()):
+            yield orjson.loads(view[start:end])
+
+    def to_list(self):
+        """
+        Materialize the stations as a list of station dicts.
+        """
+        return list(self._iter_records())
+
+    def to_dict(self):
+        """
+        Materialize the stations as a dict of station_id to station dict.
+        """
+        return {s["station_id"]: s for s in self._iter_records()}
+
+
+class SpatialIndex(object):
+    """
+    A spatial index of the station geometries of a single dataset version. The geometries are parsed and the STRtree is built once, so subsequent nearest and intersection queries only pay for the query itself.
+
+    Parameters
+    ----------
+    stns : StationTable or dict
+        A StationTable or a dict of station_id to station dict. Each station dict must contain a geometry in GeoJSON format.
+
+    Returns
+    -------
+    SpatialIndex
+    """
+
+    def __init__(self, stns: Union[StationTable, dict]):
+        """ """
+        if isinstance(stns, StationTable):
+            station_ids = stns.station_id
+            geoms = stns.geometries()
+        else:
+            station_ids = np.array(list(stns.keys()), dtype=str)
+            geo_list = [s["geometry"] for s in stns.values()]
+
+            if geo_list and all(g["type"] == "Point" for g in geo_list):
+                coords = np.array([g["coordinates"][:2] for g in geo_list], dtype=float)
+                geoms = shapely.points(coords)
+            else:
+                geoms = np.array(
+                    [shapely.geometry.shape(g) for g in geo_list], dtype=object
+                )
+
+        self.station_ids = station_ids
+        self.geometries = geoms
+        self._positions = pd.Index(station_ids)
+        self._strtree = shapely.STRtree(geoms)
+
+    def __len__(self):
+        return len(self.station_ids)
+
+    def __repr__(self):
+        return "<SpatialIndex: {} stations>".format(len(self))
+
+    def mask(self, station_ids):
+        """
+        Create a boolean mask of the index positions of a subset of station_ids.
+        """
+        if isinstance(station_ids, StationTable):
+            station_ids = station_ids.station_id
+        else:
+            station_ids = np.array(list(station_ids), dtype=str)
+
+        pos = self._positions.get_indexer(station_ids)
+        mask = np.zeros(len(self), dtype=bool)
+        mask[pos[pos >= 0]] = True
+
+        return mask
+
+    def nearest(self, geom_query, mask: Optional[np.ndarray] = None):
+        """
+        Return the station_id of the station nearest to the query geometry. If mask is passed, then only the stations in the mask are considered.
+        """
+        if isinstance(geom_query, dict):
+            geom_query = shapely.geometry.shape(geom_query)
+
+        if (mask is None) or mask.all():
+            res_index = self._strtree.nearest(geom_query)
+        else:
+            candidates = np.flatnonzero(mask)
+            if len(candidates) == 0:
+                raise ValueError("There are no stations to query.")
+            dist = shapely.distance(self.geometries[candidates], geom_query)
+            res_index = candidates[np.argmin(dist)]
+
+        return str(self.station_ids[res_index])
+
+    def nearest_points(self, lons, lats, mask: Optional[np.ndarray] = None):
+        """
+        Return the station_ids of the stations nearest to each of the points in a single (vectorized) query of the STRtree. If mask is passed, then only the stations in the mask are considered.
+        """
+        points = shapely.points(
+            np.column_stack(
+                [np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)]
+            )
+        )
+
+        if (mask is None) or mask.all():
+            res_index = self._strtree.nearest(points)
+        else:
+            candidates = np.flatnonzero(mask)
+            if len(candidates) == 0:
+                raise ValueError("There are no stations to query.")
+            tree = shapely.STRtree(self.geometries[candidates])
+            res_index = candidates[tree.nearest(points)]
+
+        return self.station_ids[res_index]
+
+    def intersects(self, geom_query, mask: Optional[np.ndarray] = None):
+        """
+        Return the station_ids of the stations whose envelopes intersect the query geometry. If mask is passed, then only the stations in the mask are returned.
+        """
+        if isinstance(geom_query, dict):
+            geom_query = shapely.geometry.shape(geom_query)
+
+        res_index = self._strtree.query(geom_query)
+
+        if mask is not None:
+            res_index = res_index[mask[res_index]]
+
+        return self.station_ids[res_index].tolist()
+
+
+class ResultsChunkIndex(object):
+    """
+    A columnar index of the results chunks of a single dataset version. The fields used by the chunk filters are stored as numpy arrays so that the filters are boolean masks rather than passes over the list of dicts. The chunk dicts themselves are only copied for the selected chunks.
+
+    Parameters
+    ----------
+    results_chunks : list of dict
+        The list of results chunk dicts stored in the results_chunks.json.zst object.
+
+    Returns
+    -------
+    ResultsChunkIndex
+    """
+
+    def __init__(self, results_chunks: List[dict]):
+        """ """
+        self.records = results_chunks
+        n = len(results_chunks)
+
+        if n > 0:
+            first_one = results_chunks[0]
+        else:
+            first_one = {}
+
+        ## Station codes and the positions of the chunks grouped by station
+        codes, uniques = pd.factorize(
+            np.array([rc["station_id"] for rc in results_chunks], dtype=object)
+        )
+        order = np.argsort(codes, kind="stable")
+        counts = np.bincount(codes, minlength=len(uniques))
+        self.station_code = codes
+        self._stations = pd.Index(uniques)
+        self._station_order = order
+        self._station_offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        ## The filter fields
+        if "chunk_day" in first_one:
+            self.chunk_day = np.array(
+                [rc["chunk_day"] for rc in results_chunks], dtype="int64"
+            )
+        else:
+            self.chunk_day = None
+
+        if "height" in first_one:
+            self.height = np.array(
+                [rc["height"] for rc in results_chunks], dtype="int64"
+            )
+        else:
+            self.height = None
+
+        if "band" in first_one:
+            self.band = np.array([rc["band"] for rc in results_chunks], dtype="int64")
+        else:
+            self.band = None
+
+        if "modified_date" in first_one:
+            mod_dates = pd.to_datetime(
+                [rc.get("modified_date", "1900-01-01") for rc in results_chunks]
+            )
+            if mod_dates.tz is not None:
+                mod_dates = mod_dates.tz_convert(None)
+            self.modified_date = mod_dates.values.astype("datetime64[ns]")
+        else:
+            self.modified_date = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __repr__(self):
+        return "<ResultsChunkIndex: {} chunks>".format(len(self))
+
+    def station_positions(self, stn_ids: List[str]):
+        """
+        Return the sorted positions of the chunks of the station_ids.
+        """
+        codes = self._stations.get_indexer(list(stn_ids))
+        codes = np.unique(codes[codes >= 0])
+
+        pos = [
+            self._station_order[self._station_offsets[c] : self._station_offsets[c + 1]]
+            for c in codes
+        ]
+
+        if pos:
+            pos = np.sort(np.concatenate(pos))
+        else:
+            pos = np.array([], dtype="int64")
+
+        return pos
+
+    def select(
+        self,
+        stn_ids: List[str],
+        time_interval: int = None,
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        heights: Union[List[Union[int, float]], Union[int, float]] = None,
+        bands: Union[List[int], int] = None,
+        from_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        to_mod_date: Union[str, pd.Timestamp, datetime] = None,
+    ):
+        """
+        Return the positions of the chunks that pass the filters sorted by the modified_date.
+        """
+        pos = self.station_positions(stn_ids)
+
+        if time_interval is None:
+            time_interval = 0
+
+        ## Temporal filters
+        if (self.chunk_day is not None) and (len(pos) > 0):
+            chunk_day = self.chunk_day[pos]
+            mask = np.ones(len(pos), dtype=bool)
+
+            if isinstance(from_date, (str, pd.Timestamp, datetime)):
+                from_date1 = int(pd.Timestamp(from_date).timestamp() / 60 / 60 / 24)
+                mask &= (chunk_day + time_interval) >= from_date1
+
+            if isinstance(to_date, (str, pd.Timestamp, datetime)):
+                to_date1 = int(pd.Timestamp(to_date).timestamp() / 60 / 60 / 24)
+                mask &= chunk_day <= to_date1
+
+            pos = pos[mask]
+
+        if (self.modified_date is not None) and (len(pos) > 0):
+            mod_date = self.modified_date[pos]
+            mask = np.ones(len(pos), dtype=bool)
+
+            if isinstance(from_mod_date, (str, pd.Timestamp, datetime)):
+                mask &= mod_date >= to_datetime64(from_mod_date)
+
+            if isinstance(to_mod_date, (str, pd.Timestamp, datetime)):
+                mask &= mod_date <= to_datetime64(to_mod_date)
+
+            pos = pos[mask]
+
+        ## Heights and bands filter
+        if (heights is not None) and (self.height is not None) and (len(pos) > 0):
+            if isinstance(heights, (int, float)):
+                h1 = [int(heights * 1000)]
+            elif isinstance(heights, list):
+                h1 = [int(h * 1000) for h in heights]
+            else:
+                raise TypeError("heights must be an int, float, or list of int/float.")
+            pos = pos[np.isin(self.height[pos], h1)]
+
+        if (bands is not None) and (self.band is not None) and (len(pos) > 0):
+            if isinstance(bands, int):
+                b1 = [bands]
+            elif isinstance(bands, list):
+                b1 = [int(b) for b in bands]
+            else:
+                raise TypeError("bands must be an int or list of int.")
+            pos = pos[np.isin(self.band[pos], b1)]
+
+        ## Sort by mod date
+        if (self.modified_date is not None) and (len(pos) > 0):
+            pos = pos[np.argsort(self.modified_date[pos], kind="stable")]
+
+        return pos
+
+    def take(self, pos):
+        """
+        Materialize copies of the chunk dicts at the positions.
+        """
+        return [dict(self.records[i]) for i in pos]
+
+
+class GridIndex(object):
+    """
+    The nearest cell lookups of gridded results. Grids with lon and lat coordinates are resolved on each coordinate separately (the nearest cell of a point has the nearest lon and the nearest lat), so the cells are never expanded into all of the lon and lat pairs. Grids of geometry blocks (a geometry coordinate of WKB hex geometries) use a KD-tree of the centroids of the geometries, which is built once per GridIndex.
+
+    Parameters
+    ----------
+    data : xr.Dataset
+        The gridded results (or only their coordinates).
+
+    Returns
+    -------
+    GridIndex
+    """
+
+    def __init__(self, data):
+        """ """
+        if "geometry" in data.coords:
+            geoms = shapely.from_wkb(np.asarray(data["geometry"].values))
+            xy = shapely.get_coordinates(shapely.centroid(geoms))
+            from scipy import spatial
+
+            self._kdtree = spatial.cKDTree(xy)
+            self.lons = None
+            self.lats = None
+        elif ("lon" in data.coords) and ("lat" in data.coords):
+            self._kdtree = None
+            self.lons = np.asarray(data["lon"].values, dtype=float)
+            self.lats = np.asarray(data["lat"].values, dtype=float)
+        else:
+            raise ValueError(
+                "The gridded results must have either a geometry or lon and lat coordinates."
+            )
+
+    def __repr__(self):
+        if self._kdtree is None:
+            return "<GridIndex: {} lons x {} lats>".format(
+                len(self.lons), len(self.lats)
+            )
+        else:
+            return "<GridIndex: {} geometries>".format(self._kdtree.n)
+
+    def nearest(self, lons, lats):
+        """
+        The positions of the nearest cells to the points.
+
+        Parameters
+        ----------
+        lons : array-like of float
+            The longitudes of the points.
+        lats : array-like of float
+            The latitudes of the points.
+
+        Returns
+        -------
+        dict
+            of the dimension name (geometry or lon and lat) to the positions of the nearest cells of the points as an np.ndarray.
+        """
+        lons = np.atleast_1d(np.asarray(lons, dtype=float))
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+
+        if self._kdtree is None:
+            return {
+                "lon": nearest_axis(self.lons, lons),
+                "lat": nearest_axis(self.lats, lats),
+            }
+        else:
+            _, pos = self._kdtree.query(np.column_stack([lons, lats]))
+            return {"geometry": np.asarray(pos, dtype=int)}
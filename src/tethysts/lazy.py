@@ -0,0 +1,322 @@
+"""
+Lazy, dask-backed results. The results chunks are only downloaded and decoded when the values that they hold are computed.
+"""
+from datetime import datetime
+from typing import List
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from tethysts import utils
+from tethysts.clients import ClientPool
+
+try:
+    import dask
+    import dask.array as da
+except ImportError:
+    dask = None
+
+##############################################
+### Parameters
+
+## The coordinates of the results chunks that are not part of the results
+excluded_coords = ["station_geometry", "chunk_date"]
+
+epoch = pd.Timestamp("1970-01-01")
+
+##############################################
+### Helper functions
+
+
+def parse_interval(interval: str):
+    """
+    Parse a frequency_interval or utc_offset of a dataset (e.g. 24H, 15T, or -3H) as a pd.Timedelta. None is returned for the instantaneous (irregular) interval T.
+    """
+    if (interval is None) or (interval.upper() == "T"):
+        return None
+    if interval.upper().endswith("T"):
+        interval = interval[:-1] + "min"
+
+    return pd.Timedelta(interval.lower())
+
+
+def time_grid(
+    chunk_day: int, time_interval: int, freq: pd.Timedelta, utc_offset: pd.Timedelta
+):
+    """
+    The times of a regular frequency within the time interval of a results chunk that starts on the chunk_day.
+    """
+    start = epoch + pd.Timedelta(days=int(chunk_day))
+    end = start + pd.Timedelta(days=int(time_interval))
+    anchor = epoch + utc_offset
+    first = anchor + int(np.ceil((start - anchor) / freq)) * freq
+
+    return pd.date_range(first, end, freq=freq, inclusive="left").values
+
+
+def fill_dtype(dtype: np.dtype):
+    """
+    The dtype and the fill value of a variable with missing values (like xarray's reindex).
+    """
+    if dtype.kind in ("M", "m"):
+        return dtype, np.array("NaT", dtype=dtype)
+    elif dtype.kind == "f":
+        return dtype, np.nan
+    elif dtype.kind in ("i", "u", "b"):
+        return np.dtype("float64"), np.nan
+    else:
+        return np.dtype("O"), None
+
+
+def open_results(data_obj):
+    """
+    Open a decoded results chunk (an hdf5 path or BytesIO object) as a loaded xr.Dataset.
+    """
+    with xr.open_dataset(data_obj, engine="h5netcdf", cache=False) as ds:
+        ds = ds.load()
+
+    return ds.drop_vars(excluded_coords, errors="ignore")
+
+
+##############################################
+### Tasks
+
+
+def load_block(
+    clients: ClientPool,
+    remote: dict,
+    chunks: List[dict],
+    names: List[str],
+    times: np.ndarray,
+    heights: np.ndarray,
+    dtypes: dict,
+    from_date=None,
+    to_date=None,
+    from_mod_date=None,
+    to_mod_date=None,
+):
+    """
+    The dask task of a block of lazy results: download the results chunks of a station and a time interval, and reindex them onto the times and heights of the block. The chunks are in modified_date order, so the values of later chunks take precedence.
+
+    Returns
+    -------
+    dict
+        of variable name to np.ndarray with a geometry dimension of length 1.
+    """
+    remote1 = dict(remote, **clients.remote_kwargs(remote))
+
+    combined = None
+    for chunk in chunks:
+        data_obj = clients.policy.call(
+            utils.download_results,
+            chunk=chunk,
+            from_date=from_date,
+            to_date=to_date,
+            **remote1,
+        )
+        ds = utils.filter_mod_dates(open_results(data_obj), from_mod_date, to_mod_date)
+        indexers = {"time": times}
+        if (heights is not None) and ("height" in ds.dims):
+            indexers["height"] = heights
+        ds = ds.reindex(indexers)
+        if combined is None:
+            combined = ds
+        else:
+            combined = ds.combine_first(combined)
+
+    return {name: combined[name].values.astype(dtypes[name]) for name in names}
+
+
+##############################################
+### Main function
+
+
+def lazy_results(
+    clients: ClientPool,
+    remote: dict,
+    chunks: List[dict],
+    template: xr.Dataset,
+    time_interval: int,
+    frequency_interval: str,
+    utc_offset: str = None,
+    from_date=None,
+    to_date=None,
+    from_mod_date=None,
+    to_mod_date=None,
+):
+    """
+    Build an xr.Dataset of dask arrays from the results chunks. The dataset must have a regular frequency_interval, so that the times of every results chunk are known without downloading it. There is one dask task per station and results chunk time interval (i.e. per results chunk, unless the dataset has several heights).
+
+    Parameters
+    ----------
+    clients : ClientPool
+        The clients of the downloads. The ClientPool is picklable, so the tasks can also run on other processes (e.g. with dask.distributed).
+    remote : dict
+        The remote parameters of utils.download_results without the clients.
+    chunks : list of dict
+        The results chunks (from utils.chunk_filters).
+    template : xr.Dataset
+        A results chunk of the dataset for the variables, dtypes, and attributes of the results.
+    time_interval : int
+        The number of days of the results chunks.
+    frequency_interval : str
+        The frequency_interval of the dataset.
+    utc_offset : str or None
+        The utc_offset of the dataset.
+
+    Returns
+    -------
+    xr.Dataset
+    """
+    if dask is None:
+        raise ImportError("lazy results require the dask package.")
+
+    freq = parse_interval(frequency_interval)
+    if (freq is None) or (time_interval == 0):
+        raise ValueError(
+            "lazy results require a dataset with a regular frequency_interval and a chunk time_interval."
+        )
+    offset = parse_interval(utc_offset)
+    if offset is None:
+        offset = pd.Timedelta(0)
+
+    if any("band" in c for c in chunks):
+        raise ValueError("lazy results are not available for datasets with bands.")
+
+    ## The blocks of the stations and the time intervals
+    stn_ids = sorted({c["station_id"] for c in chunks})
+    chunk_days = sorted({int(c["chunk_day"]) for c in chunks})
+    block_chunks = {}
+    for chunk in chunks:
+        block_chunks.setdefault(
+            (chunk["station_id"], int(chunk["chunk_day"])), []
+        ).append(chunk)
+
+    times = {d: time_grid(d, time_interval, freq, offset) for d in chunk_days}
+
+    if ("height" in template.dims) and all("height" in c for c in chunks):
+        heights = np.unique([c["height"] for c in chunks]) / 1000
+        heights = heights.astype(template["height"].dtype)
+    elif "height" in template.dims:
+        heights = template["height"].values
+    else:
+        heights = None
+
+    ## The variables with a geometry dimension are lazy, the others are from the template
+    names = [
+        name
+        for name in template.data_vars
+        if ("geometry" in template[name].dims) and (name != "station_id")
+    ]
+    dtypes = {}
+    fills = {}
+    for name in names:
+        if ("time" in template[name].dims) or ("height" in template[name].dims):
+            dtypes[name], fills[name] = fill_dtype(template[name].dtype)
+        else:
+            dtypes[name], fills[name] = template[name].dtype, None
+
+    tasks = {}
+    for (stn_id, chunk_day), chunks1 in block_chunks.items():
+        tasks[(stn_id, chunk_day)] = dask.delayed(load_block, pure=True)(
+            clients,
+            remote,
+            chunks1,
+            names,
+            times[chunk_day],
+            heights,
+            dtypes,
+            from_date,
+            to_date,
+            from_mod_date,
+            to_mod_date,
+        )
+
+    ## The first block of each station for the variables without a time dimension
+    first_tasks = {}
+    for stn_id, chunk_day in sorted(tasks):
+        first_tasks.setdefault(stn_id, tasks[(stn_id, chunk_day)])
+
+    def block_shape(dims, chunk_day):
+        shape = []
+        for dim in dims:
+            if dim == "geometry":
+                shape.append(1)
+            elif dim == "time":
+                shape.append(len(times[chunk_day]))
+            elif dim == "height":
+                shape.append(len(heights))
+            else:
+                shape.append(template.sizes[dim])
+        return tuple(shape)
+
+    data_vars = {}
+    for name in names:
+        dims = template[name].dims
+        geo_axis = dims.index("geometry")
+        if "time" in dims:
+            time_axis = dims.index("time")
+            grid_shape = [1] * len(dims)
+            grid_shape[geo_axis] = len(stn_ids)
+            grid_shape[time_axis] = len(chunk_days)
+            grid = np.empty(grid_shape, dtype=object)
+            for i, stn_id in enumerate(stn_ids):
+                for j, chunk_day in enumerate(chunk_days):
+                    shape = block_shape(dims, chunk_day)
+                    task = tasks.get((stn_id, chunk_day))
+                    if task is None:
+                        block = da.full(shape, fills[name], dtype=dtypes[name])
+                    else:
+                        block = da.from_delayed(task[name], shape, dtypes[name])
+                    index = [0] * len(dims)
+                    index[geo_axis] = i
+                    index[time_axis] = j
+                    grid[tuple(index)] = block
+        else:
+            grid_shape = [1] * len(dims)
+            grid_shape[geo_axis] = len(stn_ids)
+            grid = np.empty(grid_shape, dtype=object)
+            for i, stn_id in enumerate(stn_ids):
+                shape = block_shape(dims, chunk_days[0])
+                index = [0] * len(dims)
+                index[geo_axis] = i
+                grid[tuple(index)] = da.from_delayed(
+                    first_tasks[stn_id][name], shape, dtypes[name]
+                )
+
+        data_vars[name] = (dims, da.block(grid.tolist()), template[name].attrs)
+
+    for name in template.data_vars:
+        if "geometry" not in template[name].dims:
+            data_vars[name] = template[name]
+
+    coords = {
+        "time": np.concatenate([times[d] for d in chunk_days]),
+        "station_id": ("geometry", stn_ids),
+    }
+    if heights is not None:
+        coords["height"] = ("height", heights, template["height"].attrs)
+
+    xr3 = xr.Dataset(data_vars, coords=coords, attrs=template.attrs)
+
+    ## Time filters
+    if isinstance(from_date, (str, pd.Timestamp, datetime)):
+        from_date1 = np.datetime64(from_date)
+    else:
+        from_date1 = None
+    if isinstance(to_date, (str, pd.Timestamp, datetime)):
+        to_date1 = np.datetime64(to_date)
+    else:
+        to_date1 = None
+    ## Like the selection of hdf5tools (that the results that are not lazy use), the to_date is exclusive
+    time_index = xr3["time"].values
+    mask = np.ones(len(time_index), dtype=bool)
+    if from_date1 is not None:
+        mask &= time_index >= from_date1
+    if to_date1 is not None:
+        mask &= time_index < to_date1
+    if not mask.all():
+        xr3 = xr3.isel(time=np.flatnonzero(mask))
+
+    return xr3
@@ -0,0 +1,152 @@
+"""
+Locks to coordinate the downloads and the writes to the local cache between processes and threads.
+"""
+import concurrent.futures
+import os
+import pathlib
+import threading
+from typing import Union
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+##############################################
+### Helper functions
+
+
+def temp_path(path: pathlib.Path):
+    """
+    A temporary file path next to the path that is unique to the process and thread.
+    """
+    return path.with_name(
+        "{}.{}.{}.tmp".format(path.name, os.getpid(), threading.get_ident())
+    )
+
+
+def lock_path(path: pathlib.Path):
+    """
+    The lock file path of a file in the cache.
+    """
+    return path.with_name(path.name + ".lock")
+
+
+##############################################
+### Classes
+
+
+class FileLock(object):
+    """
+    An exclusive lock on a lock file that works across processes and threads (each acquire opens its own file descriptor). The lock file is removed on release, so that the cache does not fill up with lock files. Acquirers that were waiting on a removed lock file open the new one and try again. On platforms without fcntl (i.e. Windows) the lock is a no-op and only the atomic writes protect the cache.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        The path of the lock file.
+
+    Returns
+    -------
+    FileLock
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path]):
+        """ """
+        self.path = pathlib.Path(path)
+        self._fd = None
+
+    def acquire(self):
+        """
+        Block until the lock is acquired.
+        """
+        if fcntl is None:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        while True:
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                same_file = os.stat(self.path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                same_file = False
+            except BaseException:
+                os.close(fd)
+                raise
+
+            if same_file:
+                self._fd = fd
+                break
+
+            os.close(fd)
+
+    def release(self):
+        """
+        Remove the lock file and release the lock.
+        """
+        if self._fd is None:
+            return
+
+        try:
+            self.path.unlink(missing_ok=True)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key within a process. The first caller of a key runs the function and the callers that arrive while it is running wait for and share its result (or exception). Nothing is kept once the call has finished.
+
+    Returns
+    -------
+    SingleFlight
+    """
+
+    def __init__(self):
+        """ """
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) unless a call with the same key is already in flight.
+
+        Returns
+        -------
+        tuple of (result, shared)
+            shared is True if the result came from another caller's call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = concurrent.futures.Future()
+                self._calls[key] = call
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            return call.result(), True
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as err:
+            call.set_exception(err)
+            raise
+        else:
+            call.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+        return result, False
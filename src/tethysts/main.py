@@ -3,31 +3,130 @@ Created on 2020-11-05.
 
 @author: Mike K
 """
+from __future__ import annotations
+
 import concurrent.futures
 import copy
+import functools
+import io
+import multiprocessing
 import os
 import pathlib
+import threading
+import time
+import warnings
+import weakref
 from datetime import datetime
 from typing import List, Union
 
 import orjson
-import pandas as pd
-import requests
-import tethys_data_models as tdm
-import xarray as xr
-
-# import utils
-from s3tethys import decompress_stream_to_object, get_object_s3, s3_client
 
 from tethysts import utils
+from tethysts.cache import CacheManager, MemoryBudget, MetadataCache
+from tethysts.clients import (
+    AdaptiveConcurrency,
+    ClientPool,
+    RetryPolicy,
+    classify_error,
+    is_throttled,
+    remote_name,
+)
+from tethysts.imports import lazy_import
+from tethysts.indexes import ResultsChunkIndex, SpatialIndex, StationTable
+from tethysts.locks import SingleFlight
+from tethysts.metrics import CallMetrics, Metrics, phase
+from tethysts.store import ResultsStore
+
+pd = lazy_import("pandas")
+s3tethys = lazy_import("s3tethys")
+tdm = lazy_import("tethys_data_models")
+xr = lazy_import("xarray")
 
 # pd.options.display.max_columns = 10
 
+##############################################
+### Parameters
+
+## The parameters of the queries of get_results_batch
+batch_query_params = (
+    "key",
+    "dataset_id",
+    "station_ids",
+    "geometry",
+    "lat",
+    "lon",
+    "distance",
+    "from_date",
+    "to_date",
+    "from_mod_date",
+    "to_mod_date",
+    "version_date",
+    "heights",
+    "bands",
+    "squeeze_dims",
+)
+
+
+##############################################
+### Helper functions
+
+
+def warn_remote_datasets(remote: dict, kind: str, err: Exception):
+    """
+    Warn that the datasets of a remote could not be loaded because they are missing or due to a transient error.
+    """
+    if kind == "missing":
+        msg = "No datasets.json.zst file in the remote {}.".format(remote_name(remote))
+    else:
+        msg = "The datasets of {} could not be loaded: {}".format(
+            remote_name(remote), err
+        )
+    warnings.warn(msg, RuntimeWarning, stacklevel=3)
+
+
+def close_spilled(store_close, budget: MemoryBudget):
+    """
+    Close the file of results that were spilled to disk and remove the temporary files of the memory budget.
+    """
+    try:
+        store_close()
+    finally:
+        budget.remove()
+
+
+def timed_call(timings: list, func, *args, **kwargs):
+    """
+    Call func and append the seconds that it took to timings.
+    """
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timings.append(time.perf_counter() - start)
+
 
 ##############################################
 ### data models
 
 
+class Catalog(dict):
+    """
+    A dict of dataset_id to the datasets (or the remotes) of a Tethys object. In the deferred mode, a missing dataset_id loads the datasets of the remotes that have not been loaded yet (in order) until it's found.
+    """
+
+    def __init__(self, loader):
+        """ """
+        super().__init__()
+        self._loader = loader
+
+    def __missing__(self, dataset_id):
+        self._loader(dataset_id)
+        if dataset_id in self:
+            return dict.__getitem__(self, dataset_id)
+
+        raise KeyError(dataset_id)
+
+
 ##############################################
 ### Class
 
@@ -58,6 +157,14 @@ class Tethys(object):
         self,
         remotes: List[tdm.base.Remote] = None,
         cache: Union[pathlib.Path, str] = None,
+        metadata_ttl: Union[int, float] = 0,
+        cache_max_size: Union[int, float] = None,
+        cache_max_age: Union[int, float] = None,
+        max_pool_connections: int = 30,
+        retry_policy: RetryPolicy = None,
+        metrics: Metrics = None,
+        decode_processes: int = None,
+        deferred: bool = False,
     ):
         """
         The cache parameter might eventually include pymongo.database.Database.
@@ -77,38 +184,148 @@ class Tethys(object):
                 The system version number.
         cache : str, pathlib.Path, or None
             If the input is a path, then data will be cached locally. None will perform no caching.
+        metadata_ttl : int or float
+            Only applies when cache is a path. The number of seconds that the cached metadata (remotes, datasets, versions, stations, and results_chunks) are used without checking the remote. After that, the cached metadata are revalidated with a conditional request and only downloaded again if they have changed. 0 will revalidate on every request.
+        cache_max_size : int, float, or None
+            Only applies when cache is a path. The total maximum size of the cached results chunks in MBs. The least recently used results chunks are evicted in a background thread after each get_results call once the cache is larger. None will not limit the size.
+        cache_max_age : int, float, or None
+            Only applies when cache is a path. The cached results chunks that have not been accessed within this number of days are evicted in the same background thread. None will not limit the age.
+        max_pool_connections : int
+            The maximum number of connections kept open per remote. The connections (and S3 clients) are kept for the life of the object and shared by all requests. It is also the cap of the adaptive download concurrency per remote, and if threads is set in get_results, then it should be at least as large.
+        retry_policy : RetryPolicy or None
+            The retries, timeouts, negative caching of missing objects, and (optional) hedged requests of the requests to the remotes. None will use the defaults of RetryPolicy.
+        metrics : Metrics or None
+            Records the time of each phase (e.g. transfer, decompress, and concat) and the counters (e.g. bytes, cache hits, and retries) of each get_results and iter_results call. See Metrics for the phases, counters, and callbacks. None will not record anything.
+        decode_processes : int or None
+            The number of processes that decode the results chunks. The requests of the downloads stay in the threads of get_results, but the CPU bound decompression and re-encoding of the results chunks run in a pool of this many processes (started on first use), so they don't contend on the GIL. The raw and decoded results chunks are passed to and from the processes through temporary files (in the cache if set). It's worth it for the zstandard compressed results chunks or for many simultaneous downloads without a cache. None will decode in the download threads.
+        deferred : bool
+            Should the datasets of each remote only be loaded on the first access to a dataset_id of that remote? The remotes are validated up front, but the datasets of the remotes (and the list of the public remotes if remotes is None) are only downloaded once a method is called with a dataset_id. The remotes are then loaded one at a time (in order) until the dataset_id is found, so put the remotes that are used the most first. Accessing the datasets attribute loads all of the remaining remotes. Otherwise the datasets of all of the remotes are loaded when the object is created.
         """
-        setattr(self, "datasets", [])
-        setattr(self, "_datasets", {})
-        setattr(self, "_remotes", {})
+        setattr(self, "_dataset_list", [])
+        setattr(self, "_datasets", Catalog(self._load_deferred))
+        setattr(self, "_remotes", Catalog(self._load_deferred))
+        setattr(self, "_pending_remotes", [])
+        setattr(self, "_pending_public", False)
+        setattr(self, "_deferred_lock", threading.Lock())
         setattr(self, "_stations", {})
+        setattr(self, "_spatial_indexes", {})
         setattr(self, "_key_patterns", tdm.utils.key_patterns)
         # setattr(self, '_results', {})
         setattr(self, "_versions", {})
         setattr(self, "_results_chunks", {})
+        setattr(self, "_flight", SingleFlight())
+        setattr(self, "_clients", ClientPool(max_pool_connections, retry_policy))
+        setattr(self, "metrics", metrics)
+        setattr(self, "decode_processes", decode_processes)
+        setattr(self, "_decode_pool", None)
+        setattr(self, "_decode_pool_lock", threading.Lock())
+        setattr(self, "_cached_chunks", {})
+        setattr(self, "_cached_chunks_lock", threading.Lock())
 
         if isinstance(cache, (str, pathlib.Path)):
             cache_path = pathlib.Path(cache)
             os.makedirs(cache_path, exist_ok=True)
             setattr(self, "cache", cache_path)
+            setattr(self, "_metadata_cache", MetadataCache(cache_path, metadata_ttl))
+            cache_manager = CacheManager(cache_path, cache_max_size, cache_max_age)
+            if (cache_max_size is not None) or (cache_max_age is not None):
+                cache_manager.start()
+            setattr(self, "_cache_manager", cache_manager)
         else:
             setattr(self, "cache", None)
+            setattr(self, "_metadata_cache", None)
+            setattr(self, "_cache_manager", None)
 
         if isinstance(remotes, list):
-            _ = self.get_datasets(remotes)
+            if deferred:
+                setattr(self, "_pending_remotes", self._validate_remotes(remotes))
+                setattr(self, "remotes", remotes)
+            else:
+                _ = self.get_datasets(remotes)
 
         elif remotes is None:
-            resp = requests.get(utils.public_remote_key)
-            resp.raise_for_status()
-
-            remotes = utils.read_json_zstd(resp.content)
-            _ = self.get_datasets(remotes)
+            if deferred:
+                setattr(self, "_pending_public", True)
+            else:
+                _ = self.get_datasets(self._get_public_remotes())
 
         elif remotes != "pass":
             raise ValueError("remotes must be a list of dict or None.")
 
         pass
 
+    @property
+    def datasets(self):
+        """
+        The list of the datasets of the remotes. In the deferred mode, the remotes that have not been loaded yet are loaded first.
+        """
+        if self._pending_remotes or self._pending_public:
+            self._load_deferred()
+
+        return self._dataset_list
+
+    def _get_public_remotes(self):
+        """
+        Get the list of the public remotes.
+        """
+        if self._metadata_cache is None:
+            resp = self._clients.session.get(utils.public_remote_key)
+            resp.raise_for_status()
+            remotes_obj = resp.content
+        else:
+            remotes_obj = self._metadata_cache.get_url(
+                utils.public_remote_key, self._clients.session
+            )
+
+        return utils.read_json_zstd(remotes_obj)
+
+    def _validate_remotes(self, remotes: List[dict]):
+        """
+        Validate the remotes and drop their descriptions.
+        """
+        remotes_m = []
+        for remote in remotes:
+            remote_m = orjson.loads(tdm.base.Remote(**remote).json(exclude_none=True))
+            if "description" in remote_m:
+                _ = remote_m.pop("description")
+            remotes_m.append(remote_m)
+
+        return remotes_m
+
+    def _load_deferred(self, dataset_id: str = None):
+        """
+        Load the datasets of the deferred remotes. With a dataset_id, the remotes are loaded one at a time until the dataset_id is found. Otherwise all of the remaining remotes are loaded at once. The remotes that fail with transient errors stay pending, so that a later access retries them.
+        """
+        with self._deferred_lock:
+            if self._pending_public:
+                remotes = self._get_public_remotes()
+                setattr(self, "_pending_remotes", self._validate_remotes(remotes))
+                setattr(self, "remotes", remotes)
+                setattr(self, "_pending_public", False)
+
+            if dataset_id is None:
+                pending = self._pending_remotes
+                setattr(self, "_pending_remotes", [])
+                setattr(self, "_pending_remotes", self._load_remotes(pending))
+            else:
+                failed = []
+                try:
+                    while self._pending_remotes and (dataset_id not in self._datasets):
+                        remote = self._pending_remotes[0]
+                        raise_fatal = (
+                            (len(self._pending_remotes) == 1)
+                            and (not failed)
+                            and (not self._remotes)
+                        )
+                        if (
+                            self._load_remote_datasets(remote, raise_fatal)
+                            == "transient"
+                        ):
+                            failed.append(remote)
+                        _ = self._pending_remotes.pop(0)
+                finally:
+                    self._pending_remotes[:0] = failed
+
     def get_datasets(self, remotes: List[dict], threads: int = 30):
         """
         The function to get datasets from many remotes.
@@ -135,25 +352,52 @@ class Tethys(object):
             of datasets
         """
         ## Validate remotes
-        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-            futures = []
-            for remote in remotes:
-                # if not 'version' in remote:
-                #     remote['version'] = 2
-                remote_m = orjson.loads(
-                    tdm.base.Remote(**remote).json(exclude_none=True)
-                )
-                if "description" in remote_m:
-                    _ = remote_m.pop("description")
-                f = executor.submit(self._load_remote_datasets, remote_m)
-                futures.append(f)
-            _ = concurrent.futures.wait(futures)
+        remotes_m = self._validate_remotes(remotes)
+        self._load_remotes(remotes_m, threads)
 
         setattr(self, "remotes", remotes)
 
         return self.datasets
 
-    def _load_remote_datasets(self, remote: dict):
+    def _load_remotes(self, remotes: List[dict], threads: int = 30):
+        """
+        Load the datasets of many validated remotes concurrently.
+
+        Returns
+        -------
+        list of dict
+            The remotes whose datasets could not be loaded due to transient errors.
+        """
+        if not remotes:
+            return []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [
+                executor.submit(self._load_remote_datasets, remote, True)
+                for remote in remotes
+            ]
+            _ = concurrent.futures.wait(futures)
+
+        kinds = []
+        errors = []
+        for remote, f in zip(remotes, futures):
+            err = f.exception()
+            if err is None:
+                kinds.append(f.result())
+            else:
+                kinds.append("fatal")
+                errors.append((remote, err))
+
+        ## A remote that can't be loaded (e.g. access denied or a corrupt datasets object) is skipped, unless no remote could be loaded at all
+        if errors:
+            if all(kind is not None for kind in kinds) and (not self._remotes):
+                raise errors[0][1]
+            for remote, err in errors:
+                warn_remote_datasets(remote, "fatal", err)
+
+        return [remote for remote, kind in zip(remotes, kinds) if kind == "transient"]
+
+    def _load_remote_datasets(self, remote: dict, raise_fatal: bool = False):
         """
         Get datasets from an individual remote. Saves result into the object.
 
@@ -168,31 +412,71 @@ class Tethys(object):
                 A dict of strings of service_name, s3, endpoint_url, aws_access_key_id, and aws_secret_access_key. Or it could be a string of the public_url endpoint.
             version: int
                 The S3 object structure version.
+        raise_fatal : bool
+            Should the fatal errors (see classify_error) be raised rather than warned about?
 
         Returns
         -------
-        None
+        str or None
+            missing, transient, or fatal (see classify_error) if the datasets could not be loaded, otherwise None.
         """
+        version = remote["version"]
         try:
-            get_dict = copy.deepcopy(remote)
+            ds_list = self._get_metadata(
+                remote, self._key_patterns[version]["datasets"]
+            )
+        except Exception as err:
+            kind = classify_error(err)
+            if (kind == "fatal") and raise_fatal:
+                raise
+            warn_remote_datasets(remote, kind, err)
+
+            return kind
+
+        self._add_remote_datasets(remote, ds_list)
 
-            version = get_dict.pop("version")
+    def _add_remote_datasets(self, remote: dict, ds_list: List[dict]):
+        """
+        Add the datasets of a remote to the object.
+        """
+        # [l.pop('properties') for l in ds_list2]
+        self._dataset_list.extend(ds_list)
 
-            get_dict["obj_key"] = self._key_patterns[version]["datasets"]
-            ds_obj = get_object_s3(**get_dict)
-            ds_list = orjson.loads(decompress_stream_to_object(ds_obj, "zstd").read())
+        ds_dict = {d["dataset_id"]: d for d in ds_list}
+        remote_dict = {d: remote for d in ds_dict}
 
-            # [l.pop('properties') for l in ds_list2]
-            self.datasets.extend(ds_list)
+        self._datasets.update(ds_dict)
+        self._remotes.update(remote_dict)
+
+    def _get_metadata(self, remote: dict, obj_key: str):
+        """
+        Get and decode a zstandard compressed json metadata object from a remote. The local metadata cache is used if the cache path was set. Concurrent requests for the same object share a single download and transient errors are retried with the retry policy.
+        """
+        key = ("metadata", remote_name(remote), obj_key)
+        meta, _ = self._flight.do(
+            key, self._clients.policy.call, self._load_metadata, remote, obj_key
+        )
 
-            ds_dict = {d["dataset_id"]: d for d in ds_list}
-            remote_dict = {d: remote for d in ds_dict}
+        return meta
 
-            self._datasets.update(ds_dict)
-            self._remotes.update(remote_dict)
+    def _load_metadata(self, remote: dict, obj_key: str):
+        """ """
+        if self._metadata_cache is None:
+            obj = self._clients.get_object(remote, obj_key)
+            meta = orjson.loads(
+                s3tethys.decompress_stream_to_object(obj, "zstd").read()
+            )
+        else:
+            obj = self._metadata_cache.get_object(
+                obj_key,
+                remote["bucket"],
+                connection_config=remote.get("connection_config"),
+                public_url=remote.get("public_url"),
+                **self._clients.remote_kwargs(remote),
+            )
+            meta = utils.read_json_zstd(obj)
 
-        except:
-            print("No datasets.json.zst file in S3 bucket")
+        return meta
 
     def get_stations(
         self,
@@ -204,6 +488,7 @@ class Tethys(object):
         version_date: Union[str, datetime, pd.Timestamp] = None,
         from_date: Union[str, pd.Timestamp, datetime] = None,
         to_date: Union[str, pd.Timestamp, datetime] = None,
+        as_table: bool = False,
     ):
         """
         Method to return the stations associated with a dataset.
@@ -226,64 +511,80 @@ class Tethys(object):
             The start date of the selection.
         to_date : str, Timestamp, datetime, or None
             The end date of the selection.
+        as_table : bool
+            Should the stations be returned as a columnar StationTable rather than a list of dict? The StationTable is much more compact for datasets with many stations.
 
         Returns
         -------
-        list of dict
+        list of dict or StationTable
             of station data
         """
-        remote = copy.deepcopy(self._remotes[dataset_id])
-        version = remote.pop("version")
-
         vd = self._get_version_date(dataset_id, version_date)
-        stn_key = self._get_stns_rc_key(dataset_id, "stations", vd)
-
-        run_get = True
-
-        if dataset_id in self._stations:
-            if vd in self._stations[dataset_id]:
-                stn_dict = copy.deepcopy(self._stations[dataset_id][vd])
-                run_get = False
 
-        if run_get:
+        stn_table = self._stations.get(dataset_id, {}).get(vd)
+        if stn_table is None:
             try:
-                remote["obj_key"] = stn_key
-                stn_obj = get_object_s3(**remote)
-                stn_list = orjson.loads(
-                    decompress_stream_to_object(stn_obj, "zstd").read()
+                stn_table, _ = self._flight.do(
+                    ("stations", dataset_id, vd), self._load_stations, dataset_id, vd
                 )
-                stn_dict = {s["station_id"]: s for s in stn_list if isinstance(s, dict)}
-                utils.update_nested(self._stations, dataset_id, vd, stn_dict)
-            except:
+            except FileNotFoundError:
                 print("No stations.json.zst file in S3 bucket")
                 return None
 
         ## Temporal queries
-        if isinstance(from_date, (str, pd.Timestamp, datetime)):
-            from_date1 = pd.Timestamp(from_date)
-            stn_dict = {
-                s_id: s
-                for s_id, s in stn_dict.items()
-                if pd.Timestamp(s["time_range"]["from_date"]) >= from_date1
-            }
-
-        if isinstance(to_date, (str, pd.Timestamp, datetime)):
-            to_date1 = pd.Timestamp(to_date)
-            stn_dict = {
-                s_id: s
-                for s_id, s in stn_dict.items()
-                if pd.Timestamp(s["time_range"]["to_date"]) <= to_date1
-            }
+        mask = stn_table.mask(from_date, to_date)
+        if mask is not None:
+            stn_table = stn_table[mask]
 
         ## Spatial query
-        stn_ids = utils.spatial_query(stn_dict, geometry, lat, lon, distance)
+        if (geometry is not None) or (lat is not None and lon is not None):
+            sindex = self._get_spatial_index(dataset_id, vd)
+        else:
+            sindex = None
+        stn_ids = utils.spatial_query(stn_table, geometry, lat, lon, distance, sindex)
 
         if isinstance(stn_ids, list):
-            stn_list1 = [stn_dict[s] for s in stn_ids]
+            stn_table = stn_table.sel(stn_ids)
+
+        if as_table:
+            return stn_table
         else:
-            stn_list1 = list(stn_dict.values())
+            return stn_table.to_list()
+
+    def _load_stations(self, dataset_id: str, version_date: str):
+        """
+        Download the stations of a dataset version into a StationTable (unless another caller has just done it).
+        """
+        stn_table = self._stations.get(dataset_id, {}).get(version_date)
+        if stn_table is None:
+            remote = self._remotes[dataset_id]
+            stn_key = self._get_stns_rc_key(dataset_id, "stations", version_date)
+            stn_list = self._get_metadata(remote, stn_key)
+            stn_table = StationTable.from_list(stn_list)
+            self._set_stations(dataset_id, version_date, stn_table)
+
+        return stn_table
+
+    def _set_stations(self, dataset_id: str, version_date: str, stn_table):
+        """
+        Assign the StationTable of a dataset version and drop the spatial index of the replaced stations.
+        """
+        utils.update_nested(self._stations, dataset_id, version_date, stn_table)
+        if dataset_id in self._spatial_indexes:
+            self._spatial_indexes[dataset_id].pop(version_date, None)
+
+    def _get_spatial_index(self, dataset_id: str, version_date: str):
+        """
+        Get the spatial index of the stations of a dataset version. The index is built on first use and kept until the stations of that version are reloaded.
+        """
+        if dataset_id in self._spatial_indexes:
+            if version_date in self._spatial_indexes[dataset_id]:
+                return self._spatial_indexes[dataset_id][version_date]
+
+        sindex = SpatialIndex(self._stations[dataset_id][version_date])
+        utils.update_nested(self._spatial_indexes, dataset_id, version_date, sindex)
 
-        return stn_list1
+        return sindex
 
     def _get_stns_rc_key(self, dataset_id: str, key_name, version_date: str = None):
         """ """
@@ -304,30 +605,34 @@ class Tethys(object):
         return stn_key
 
     def _get_results_chunks(self, dataset_id: str, version_date: str = None):
-        """ """
-        remote = copy.deepcopy(self._remotes[dataset_id])
-        system_version = remote.pop("version")
-
-        run_get = True
+        """
+        Get the ResultsChunkIndex of a dataset version. The index is built once when the results_chunks object is downloaded and concurrent callers share that download.
+        """
+        rc_index = self._results_chunks.get(dataset_id, {}).get(version_date)
+        if rc_index is None:
+            rc_index, _ = self._flight.do(
+                ("results_chunks", dataset_id, version_date),
+                self._load_results_chunks,
+                dataset_id,
+                version_date,
+            )
 
-        if dataset_id in self._results_chunks:
-            if version_date in self._results_chunks[dataset_id]:
-                rc_list = self._results_chunks[dataset_id][version_date]
-                run_get = False
+        return rc_index
 
-        if run_get:
+    def _load_results_chunks(self, dataset_id: str, version_date: str = None):
+        """ """
+        rc_index = self._results_chunks.get(dataset_id, {}).get(version_date)
+        if rc_index is None:
+            remote = self._remotes[dataset_id]
             rc_key = self._get_stns_rc_key(dataset_id, "results_chunks", version_date)
+            rc_list = self._get_metadata(remote, rc_key)
+            rc_index = ResultsChunkIndex(rc_list)
 
-            remote1 = copy.deepcopy(remote)
-
-            remote1["obj_key"] = rc_key
-            stn_obj = get_object_s3(**remote1)
-
-            rc_list = orjson.loads(decompress_stream_to_object(stn_obj, "zstd").read())
-
-            utils.update_nested(self._results_chunks, dataset_id, version_date, rc_list)
+            utils.update_nested(
+                self._results_chunks, dataset_id, version_date, rc_index
+            )
 
-        return rc_list
+        return rc_index
 
     def get_versions(self, dataset_id: str):
         """
@@ -342,21 +647,15 @@ class Tethys(object):
         -------
         list
         """
-        if dataset_id not in self._versions:
-            remote = copy.deepcopy(self._remotes[dataset_id])
-            version = remote.pop("version")
-
-            rv_key = self._key_patterns[version]["versions"].format(
+        versions = self._versions.get(dataset_id)
+        if versions is None:
+            remote = self._remotes[dataset_id]
+            rv_key = self._key_patterns[remote["version"]]["versions"].format(
                 dataset_id=dataset_id
             )
-            remote["obj_key"] = rv_key
+            rv_list = self._get_metadata(remote, rv_key)
 
-            rv_obj = get_object_s3(**remote)
-            rv_list = orjson.loads(decompress_stream_to_object(rv_obj, "zstd").read())
-
-            self._versions[dataset_id] = rv_list
-
-        versions = self._versions[dataset_id]
+            versions = self._versions.setdefault(dataset_id, rv_list)
 
         return versions
 
@@ -381,14 +680,14 @@ class Tethys(object):
 
     def clear_cache(self, max_size=1000, max_age=7):
         """
-        Clears the cache based on specified max_size and max_age. The cache path must be assigned at the Tethys initialisation for this function to work.
+        Clears the results chunks in the cache based on specified max_size and max_age. The least recently used results chunks are removed first. The cache path must be assigned at the Tethys initialisation for this function to work.
 
         Parameters
         ----------
         max_size: int
-            The total maximum size of all files in the cache in MBs.
+            The total maximum size of all results chunks in the cache in MBs.
         max_age: int or float
-            The maximum age of files in the cache in days.
+            The maximum time since the last access of the results chunks in the cache in days.
 
         Returns
         -------
@@ -397,30 +696,8 @@ class Tethys(object):
         if not isinstance(self.cache, pathlib.Path):
             raise TypeError("The cache path must be set when initialising Tethys.")
 
-        cache_gen1 = list(self.cache.rglob("*.nc"))
-
-        stats1 = []
-        for c in cache_gen1:
-            stats = c.stat()
-            stats1.append([str(c), stats.st_size, stats.st_mtime])
-
-        stats2 = pd.DataFrame(stats1, columns=["file_path", "file_size", "mtime"])
-        stats2["mtime"] = pd.to_datetime(stats2["mtime"], unit="s").round("s")
-
-        stats2 = stats2.sort_values("mtime")
-        stats2["file_cumsum"] = stats2["file_size"].cumsum()
-
-        now1 = pd.Timestamp.now().round("s")
-        then1 = now1 - pd.DateOffset(days=max_age)
-
-        rem1_bool = stats2["mtime"] < then1
-        rem2_bool = stats2["file_cumsum"] > (max_size * 1000000)
-
-        rem_files = stats2[rem1_bool | rem2_bool]["file_path"].tolist()
-
-        if rem_files:
-            for f in rem_files:
-                os.remove(f)
+        _ = self._cache_manager.evict(max_size, max_age)
+        self._cache_manager.compact()
 
     def get_results(
         self,
@@ -440,7 +717,9 @@ class Tethys(object):
         squeeze_dims: bool = False,
         output_path: Union[str, pathlib.Path] = None,
         compression: str = "lzf",
-        threads: int = 30,
+        threads: int = None,
+        memory_budget: Union[int, float] = None,
+        lazy: bool = False,
         # include_chunk_vars: bool = False
     ):
         """
@@ -480,24 +759,680 @@ class Tethys(object):
             The optional path to save the results to an hdf5 file. A value of None will not save a file.
         compression : str or None
             This only applies when output_path is a path string. This is the type of compression used for the output hdf5 file. The options are gzip, lzf, zstd, or None. gzip is compatible with any hdf5 installation (not only h5py), so this should be used if interoperability across platforms is important. lzf is compatible with any h5py installation, so if only python users will need to access these files then this is a better option than gzip. zstd requires the hdf5plugin python package, but is the best compression option if only users of the tethysts package will be using it. None has no compression and is generally not recommended except in niche situations.
-        threads : int
-            The number of threads to simultaneously download results chunks. Realistically, this should not exceede 60.
+        threads : int or None
+            The number of threads to simultaneously download results chunks. None will adapt the number of simultaneous downloads to each remote from the observed latency and throttling errors (see get_concurrency), capped at max_pool_connections.
+        memory_budget : int, float, or None
+            The memory budget in MBs for the downloaded results when output_path is None. Once the downloaded results chunks reach the budget, the remaining chunks are spilled to temporary files (in the cache path if set) and if the combined results are larger than the budget, then they are written to a temporary file and opened from disk rather than held in memory. The temporary file is removed when the returned xr.Dataset is closed, or once it and the datasets derived from it have been garbage collected. None will keep everything in memory.
+        lazy : bool
+            Should the results be returned as an xr.Dataset of dask arrays? Only one results chunk is downloaded (for the variables of the results) and the other results chunks are downloaded by the dask tasks when their values are computed, so selections and reductions only download the results chunks that they need. The tasks run on the current dask scheduler (e.g. threads or dask.distributed). Requires the dask package and a time series dataset with a regular frequency_interval. The times are the regular times of the frequency_interval over the results chunks (missing values are NaN) and the geometry dimension is labelled by the station_id coordinate. output_path, memory_budget, and threads are not used. Results chunks that the tasks save in the cache are not counted towards cache_max_size until they are used by results that are not lazy.
 
         Returns
         -------
         xr.Dataset
         """
+        if memory_budget is not None:
+            budget = MemoryBudget(memory_budget, self.cache)
+        else:
+            budget = None
+
+        call = self._start_metrics("get_results")
+        try:
+            xr3 = self._get_results(
+                dataset_id,
+                station_ids,
+                geometry,
+                lat,
+                lon,
+                distance,
+                from_date,
+                to_date,
+                from_mod_date,
+                to_mod_date,
+                version_date,
+                heights,
+                bands,
+                squeeze_dims,
+                output_path,
+                compression,
+                threads,
+                budget,
+                lazy,
+                call,
+            )
+        finally:
+            self._finish_metrics(call)
+
+        return xr3
+
+    def _get_results(
+        self,
+        dataset_id: str,
+        station_ids: Union[str, List[str]] = None,
+        geometry: dict = None,
+        lat: float = None,
+        lon: float = None,
+        distance: float = None,
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        from_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        to_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        version_date: Union[str, pd.Timestamp, datetime] = None,
+        heights: Union[List[Union[int, float]], Union[int, float]] = None,
+        bands: Union[List[int], int] = None,
+        squeeze_dims: bool = False,
+        output_path: Union[str, pathlib.Path] = None,
+        compression: str = "lzf",
+        threads: int = None,
+        budget: MemoryBudget = None,
+        lazy: bool = False,
+        call=None,
+    ):
+        """
+        The body of get_results. call is the CallMetrics of the call (or None).
+        """
+        vd, chunks = self._query_chunks(
+            dataset_id,
+            station_ids,
+            geometry,
+            lat,
+            lon,
+            distance,
+            from_date,
+            to_date,
+            from_mod_date,
+            to_mod_date,
+            version_date,
+            heights,
+            bands,
+            call,
+        )
+
+        if chunks and lazy:
+            xr3 = self._lazy_results(
+                dataset_id,
+                vd,
+                chunks,
+                from_date,
+                to_date,
+                from_mod_date,
+                to_mod_date,
+                squeeze_dims,
+            )
+
+        elif chunks:
+            ## Get results chunks
+            results_list = self._download_chunks(
+                dataset_id, chunks, from_date, to_date, threads, budget, call
+            )
+
+            ## combine results
+            xr3 = self._combine_results(
+                dataset_id,
+                vd,
+                results_list,
+                geometry,
+                lat,
+                lon,
+                distance,
+                from_date,
+                to_date,
+                from_mod_date,
+                to_mod_date,
+                squeeze_dims,
+                output_path,
+                compression,
+                budget,
+                call,
+            )
+
+        else:
+            xr3 = xr.Dataset()
+
+        return xr3
+
+    def iter_results(
+        self,
+        dataset_id: str,
+        station_ids: Union[str, List[str]] = None,
+        geometry: dict = None,
+        lat: float = None,
+        lon: float = None,
+        distance: float = None,
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        from_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        to_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        version_date: Union[str, pd.Timestamp, datetime] = None,
+        heights: Union[List[Union[int, float]], Union[int, float]] = None,
+        bands: Union[List[int], int] = None,
+        squeeze_dims: bool = False,
+        threads: int = None,
+    ):
+        """
+        Generator version of get_results. The results are yielded as one xr.Dataset per station as soon as all of the results chunks of that station have been downloaded, so the first results can be processed before the slowest downloads have finished. Only a limited number of stations are downloaded ahead of the consumer, so the memory scales with the number of results chunks per station rather than the size of the whole query. See get_results for the parameters.
+
+        Yields
+        ------
+        xr.Dataset
+        """
+        call = self._start_metrics("iter_results")
+        try:
+            yield from self._iter_results(
+                dataset_id,
+                station_ids,
+                geometry,
+                lat,
+                lon,
+                distance,
+                from_date,
+                to_date,
+                from_mod_date,
+                to_mod_date,
+                version_date,
+                heights,
+                bands,
+                squeeze_dims,
+                threads,
+                call,
+            )
+        finally:
+            self._finish_metrics(call)
+
+    def _iter_results(
+        self,
+        dataset_id: str,
+        station_ids: Union[str, List[str]] = None,
+        geometry: dict = None,
+        lat: float = None,
+        lon: float = None,
+        distance: float = None,
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        from_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        to_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        version_date: Union[str, pd.Timestamp, datetime] = None,
+        heights: Union[List[Union[int, float]], Union[int, float]] = None,
+        bands: Union[List[int], int] = None,
+        squeeze_dims: bool = False,
+        threads: int = None,
+        call=None,
+    ):
+        """
+        The body of iter_results. call is the CallMetrics of the call (or None).
+        """
+        vd, chunks = self._query_chunks(
+            dataset_id,
+            station_ids,
+            geometry,
+            lat,
+            lon,
+            distance,
+            from_date,
+            to_date,
+            from_mod_date,
+            to_mod_date,
+            version_date,
+            heights,
+            bands,
+            call,
+        )
+
+        if not chunks:
+            return
+
+        ## Group the chunks by station (keeping the modified_date order within each group)
+        groups = {}
+        for chunk in chunks:
+            groups.setdefault(chunk["station_id"], []).append(chunk)
+        groups = list(groups.values())
+
+        remote = self._get_download_remote(dataset_id)
+        limiter, max_workers = self._get_limiter(remote, threads)
+        max_pending = max(max_workers * 2, 1)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        futures_by_group = {}
+        try:
+            pending = {}
+            next_group = 0
+
+            while (next_group < len(groups)) or futures_by_group:
+                ## Submit the chunks of the next groups while there is space
+                while (next_group < len(groups)) and (
+                    (len(pending) < max_pending) or (not futures_by_group)
+                ):
+                    group_futures = []
+                    for chunk in groups[next_group]:
+                        f = executor.submit(
+                            self._download_chunk,
+                            remote,
+                            chunk,
+                            from_date,
+                            to_date,
+                            limiter=limiter,
+                            call=call,
+                        )
+                        pending[f] = next_group
+                        group_futures.append(f)
+                    futures_by_group[next_group] = group_futures
+                    next_group += 1
+
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for f in done:
+                    del pending[f]
+
+                ## Yield the groups that have finished
+                finished = [
+                    g
+                    for g, group_futures in futures_by_group.items()
+                    if all(f.done() for f in group_futures)
+                ]
+                for g in finished:
+                    results_list = [f.result() for f in futures_by_group[g]]
+                    del futures_by_group[g]
+
+                    xr3 = self._combine_results(
+                        dataset_id,
+                        vd,
+                        results_list,
+                        geometry,
+                        lat,
+                        lon,
+                        distance,
+                        from_date,
+                        to_date,
+                        from_mod_date,
+                        to_mod_date,
+                        squeeze_dims,
+                        call=call,
+                    )
+                    del results_list
+
+                    yield xr3
+
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            for group_futures in futures_by_group.values():
+                self._release_futures(group_futures)
+
+    def get_results_batch(
+        self,
+        queries: List[dict],
+        threads: int = None,
+    ):
+        """
+        Query the results of many datasets and stations at once. The versions and results chunks indexes of the queries are resolved concurrently, and the results chunks of all of the queries are downloaded through one shared thread pool, so the downloads of the datasets overlap. The results of each query are combined as soon as its results chunks have been downloaded, while the downloads of the other queries carry on.
+
+        Parameters
+        ----------
+        queries : list of dict
+            The queries as dicts of the get_results parameters: dataset_id (required), station_ids, geometry, lat, lon, distance, from_date, to_date, from_mod_date, to_mod_date, version_date, heights, bands, and squeeze_dims. A query can also have a key to name its results (the default is the dataset_id, which must then be unique).
+        threads : int or None
+            The number of threads of the shared pool. None will use max_pool_connections threads, and the simultaneous downloads of each remote are adapted to it as in get_results.
+
+        Returns
+        -------
+        dict
+            of query key to xr.Dataset.
+        """
+        query_keys = []
+        for query in queries:
+            if "dataset_id" not in query:
+                raise ValueError("Each query must have a dataset_id.")
+            unknown = set(query).difference(batch_query_params)
+            if unknown:
+                raise ValueError(
+                    "Unknown query parameters: {}".format(", ".join(sorted(unknown)))
+                )
+            query_keys.append(query.get("key", query["dataset_id"]))
+        if len(set(query_keys)) < len(query_keys):
+            raise ValueError(
+                "The query keys must be unique. Pass a key with each query of the same dataset_id."
+            )
+
+        call = self._start_metrics("get_results_batch")
+        try:
+            results = self._get_results_batch(queries, query_keys, threads, call)
+        finally:
+            self._finish_metrics(call)
+
+        return results
+
+    def _get_results_batch(
+        self, queries: List[dict], query_keys: list, threads: int = None, call=None
+    ):
+        """
+        The body of get_results_batch. call is the CallMetrics of the call (or None).
+        """
+        if threads is None:
+            max_workers = self._clients.max_pool_connections
+        else:
+            max_workers = threads
+
+        query_args = []
+        for query in queries:
+            query_args.append(
+                {
+                    name: query.get(name)
+                    for name in batch_query_params
+                    if name not in ("key", "squeeze_dims")
+                }
+            )
+
+        results = {}
+        futures_by_query = {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers
+            ) as executor:
+                ## Resolve the versions and results chunks of the queries
+                query_futures = [
+                    executor.submit(self._query_chunks, call=call, **args)
+                    for args in query_args
+                ]
+                query_chunks = [f.result() for f in query_futures]
+
+                ## Download the results chunks of all of the queries
+                pending = {}
+                for i, (args, (vd, chunks)) in enumerate(zip(query_args, query_chunks)):
+                    if not chunks:
+                        results[query_keys[i]] = xr.Dataset()
+                        continue
+                    remote = self._get_download_remote(args["dataset_id"])
+                    limiter, _ = self._get_limiter(remote, threads)
+                    query_futures = []
+                    for chunk in chunks:
+                        f = executor.submit(
+                            self._download_chunk,
+                            remote,
+                            chunk,
+                            args["from_date"],
+                            args["to_date"],
+                            limiter=limiter,
+                            call=call,
+                        )
+                        pending[f] = i
+                        query_futures.append(f)
+                    futures_by_query[i] = query_futures
+
+                ## Combine the results of each query once its downloads have finished
+                while futures_by_query:
+                    done, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for f in done:
+                        del pending[f]
+
+                    finished = [
+                        i
+                        for i, query_futures in futures_by_query.items()
+                        if all(f.done() for f in query_futures)
+                    ]
+                    for i in finished:
+                        results_list = [f.result() for f in futures_by_query[i]]
+                        del futures_by_query[i]
+
+                        args = query_args[i]
+                        results[query_keys[i]] = self._combine_results(
+                            args["dataset_id"],
+                            query_chunks[i][0],
+                            results_list,
+                            args["geometry"],
+                            args["lat"],
+                            args["lon"],
+                            args["distance"],
+                            args["from_date"],
+                            args["to_date"],
+                            args["from_mod_date"],
+                            args["to_mod_date"],
+                            queries[i].get("squeeze_dims", False),
+                            call=call,
+                        )
+                        del results_list
+        finally:
+            for query_futures in futures_by_query.values():
+                self._release_futures(query_futures)
+
+        return {key: results[key] for key in query_keys}
+
+    def get_results_points(
+        self,
+        dataset_id: str,
+        lat: List[float] = None,
+        lon: List[float] = None,
+        geometry: dict = None,
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        from_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        to_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        version_date: Union[str, pd.Timestamp, datetime] = None,
+        heights: Union[List[Union[int, float]], Union[int, float]] = None,
+        bands: Union[List[int], int] = None,
+        threads: int = None,
+    ):
+        """
+        Query the results of the nearest stations of many points at once. All of the points are resolved to their nearest stations in a single query of the spatial index, and the results chunks of each station are only downloaded once however many points share the station. For gridded results, the nearest cell of each point is selected from the results of the nearest blocks. See get_results for the other parameters.
+
+        Parameters
+        ----------
+        dataset_id : str
+            The dataset_id of the dataset.
+        lat : list of float or None
+            The latitudes of the points. Both lat and lon must be passed unless geometry is passed.
+        lon : list of float or None
+            The longitudes of the points.
+        geometry : dict or None
+            Instead of lat and lon, a MultiPoint (or Point) geometry in GeoJSON format of the points.
+        threads : int or None
+            The number of threads to simultaneously download results chunks. See get_results.
+
+        Returns
+        -------
+        xr.Dataset
+            With a point dimension in the order of the points (rather than a geometry dimension) and the point_lon and point_lat coordinates of the points. The results of the points that share a station are repeated.
+        """
+        lons, lats = utils.query_points(geometry, lat, lon)
+
+        dataset = self._datasets[dataset_id]
+        is_grid = "grid" in dataset.get("result_type", "")
+
+        call = self._start_metrics("get_results_points")
+        try:
+            with phase(call, "version"):
+                vd = self._get_version_date(dataset_id, version_date)
+            if vd not in self._stations.get(dataset_id, {}):
+                _ = self.get_stations(dataset_id, version_date=vd)
+            stn_table = self._stations[dataset_id][vd]
+            sindex = self._get_spatial_index(dataset_id, vd)
+
+            point_stn_ids = utils.get_nearest_stations(stn_table, lons, lats, sindex)
+            stn_ids = pd.unique(point_stn_ids).tolist()
+
+            vd, chunks = self._query_chunks(
+                dataset_id,
+                stn_ids,
+                from_date=from_date,
+                to_date=to_date,
+                from_mod_date=from_mod_date,
+                to_mod_date=to_mod_date,
+                version_date=vd,
+                heights=heights,
+                bands=bands,
+                call=call,
+            )
+
+            if chunks:
+                results_list = self._download_chunks(
+                    dataset_id, chunks, from_date, to_date, threads, call=call
+                )
+                xr3 = self._combine_results(
+                    dataset_id,
+                    vd,
+                    results_list,
+                    from_date=from_date,
+                    to_date=to_date,
+                    from_mod_date=from_mod_date,
+                    to_mod_date=to_mod_date,
+                    call=call,
+                )
+                xr3 = utils.select_points(
+                    xr3, lons, lats, None if is_grid else point_stn_ids
+                )
+            else:
+                xr3 = xr.Dataset()
+        finally:
+            self._finish_metrics(call)
+
+        return xr3
+
+    def sync_results(
+        self,
+        dataset_id: str,
+        station_ids: Union[str, List[str]],
+        store: Union[str, pathlib.Path, ResultsStore],
+        version_date: Union[str, pd.Timestamp, datetime] = None,
+        threads: int = None,
+        rebuild: bool = False,
+    ):
+        """
+        Bring the results of stations in a local ResultsStore up to date with the remote. Only the results chunks that are new or have changed (by chunk_hash and modified_date) since the last sync are downloaded and merged into the stored results of each station, so a regular refresh costs the size of the changes rather than the whole record. Stations without any results chunks in the remote are removed from the store. The stored results can be opened with ResultsStore.open.
+
+        Parameters
+        ----------
+        dataset_id : str
+            The dataset_id of the dataset.
+        station_ids : str or list of str
+            The station_ids of the stations to sync.
+        store : str, pathlib.Path, or ResultsStore
+            The store or its base path.
+        version_date : str, Timestamp, datetime, or None
+            The version date of the results. Defaults to None which will sync the last version.
+        threads : int or None
+            The number of threads to simultaneously download results chunks. See get_results.
+        rebuild : bool
+            Should the stored results of the stations be rebuilt from all of their results chunks?
+
+        Returns
+        -------
+        dict
+            of station_id to the number of results chunks that were merged (0 if the station was already up to date).
+        """
+        if not isinstance(store, ResultsStore):
+            store = ResultsStore(store)
+        if isinstance(station_ids, str):
+            station_ids = [station_ids]
+
+        call = self._start_metrics("sync_results")
+        try:
+            vd, chunks = self._query_chunks(
+                dataset_id, station_ids, version_date=version_date, call=call
+            )
+
+            groups = {stn_id: [] for stn_id in station_ids}
+            for chunk in chunks:
+                groups[chunk["station_id"]].append(chunk)
+
+            ## Stations without results chunks in the remote are removed from the store
+            deltas = {}
+            for stn_id, stn_chunks in groups.items():
+                if not stn_chunks:
+                    store.remove(dataset_id, stn_id)
+                elif rebuild:
+                    deltas[stn_id] = (stn_chunks, True)
+                else:
+                    deltas[stn_id] = store.delta(dataset_id, stn_id, stn_chunks)
+
+            merged = {stn_id: 0 for stn_id in groups}
+            for stn_id, (new_chunks, _) in deltas.items():
+                merged[stn_id] = len(new_chunks)
+
+            remote = self._get_download_remote(dataset_id)
+            limiter, max_workers = self._get_limiter(remote, threads)
+
+            futures_by_stn = {}
+            try:
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max_workers
+                ) as executor:
+                    pending = set()
+                    for stn_id, (new_chunks, _) in deltas.items():
+                        if not new_chunks:
+                            continue
+                        stn_futures = []
+                        for chunk in new_chunks:
+                            f = executor.submit(
+                                self._download_chunk,
+                                remote,
+                                chunk,
+                                limiter=limiter,
+                                call=call,
+                            )
+                            pending.add(f)
+                            stn_futures.append(f)
+                        futures_by_stn[stn_id] = stn_futures
+
+                    ## Merge each station once its downloads have finished
+                    while futures_by_stn:
+                        done, pending = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+                        finished = [
+                            stn_id
+                            for stn_id, stn_futures in futures_by_stn.items()
+                            if all(f.done() for f in stn_futures)
+                        ]
+                        for stn_id in finished:
+                            results_list = [f.result() for f in futures_by_stn[stn_id]]
+                            del futures_by_stn[stn_id]
+                            new_chunks, rebuild1 = deltas[stn_id]
+                            try:
+                                with phase(call, "concat"):
+                                    store.merge(
+                                        dataset_id,
+                                        stn_id,
+                                        vd,
+                                        new_chunks,
+                                        results_list,
+                                        rebuild1,
+                                    )
+                            finally:
+                                self._release_chunks(results_list)
+                            del results_list
+            finally:
+                for stn_futures in futures_by_stn.values():
+                    self._release_futures(stn_futures)
+        finally:
+            self._finish_metrics(call)
+
+        return merged
+
+    def _query_chunks(
+        self,
+        dataset_id: str,
+        station_ids: Union[str, List[str]] = None,
+        geometry: dict = None,
+        lat: float = None,
+        lon: float = None,
+        distance: float = None,
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        from_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        to_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        version_date: Union[str, pd.Timestamp, datetime] = None,
+        heights: Union[List[Union[int, float]], Union[int, float]] = None,
+        bands: Union[List[int], int] = None,
+        call=None,
+    ):
+        """
+        Resolve the version_date and the stations of a results query and return the version_date and the filtered results chunks. See get_results for the parameters.
+        """
         ## Get parameters
         dataset = self._datasets[dataset_id]
-        # parameter = dataset['parameter']
-        if "result_type" in dataset:
-            result_type = dataset["result_type"]
-        else:
-            result_type = ""
-        remote = copy.deepcopy(self._remotes[dataset_id])
-        version = remote.pop("version")
 
-        vd = self._get_version_date(dataset_id, version_date)
+        with phase(call, "version"):
+            vd = self._get_version_date(dataset_id, version_date)
 
         if "chunk_parameters" in dataset:
             time_interval = int(dataset["chunk_parameters"]["time_interval"])
@@ -517,68 +1452,475 @@ class Tethys(object):
             isinstance(lat, float) and isinstance(lon, float)
         ):
             ## Get all stations
-            if dataset_id not in self._stations:
+            if vd not in self._stations.get(dataset_id, {}):
                 _ = self.get_stations(dataset_id, version_date=vd)
 
-            stn_dict = self._stations[dataset_id][vd]
+            stn_table = self._stations[dataset_id][vd]
+            sindex = self._get_spatial_index(dataset_id, vd)
 
             # Run the spatial query
-            stn_ids = utils.spatial_query(stn_dict, geometry, lat, lon, distance)
+            stn_ids = utils.spatial_query(
+                stn_table, geometry, lat, lon, distance, sindex
+            )
         else:
             raise ValueError(
                 "station_ids, point/polygon geometry, or a combination of lat and lon (with or without distance) must be passed."
             )
 
         ## Get results chunks
-        rc_list = self._get_results_chunks(dataset_id, vd)
+        with phase(call, "results_chunks"):
+            rc_index = self._get_results_chunks(dataset_id, vd)
+
+        with phase(call, "chunk_filters"):
+            chunks = utils.chunk_filters(
+                rc_index,
+                stn_ids,
+                time_interval,
+                from_date,
+                to_date,
+                heights,
+                bands,
+                from_mod_date,
+                to_mod_date,
+            )
+
+        return vd, chunks
+
+    def _download_chunks(
+        self,
+        dataset_id: str,
+        chunks: List[dict],
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        threads: int = None,
+        budget: MemoryBudget = None,
+        call=None,
+    ):
+        """
+        Download the results chunks in a thread pool. The returned list is in the same order as the chunks.
+        """
+        remote = self._get_download_remote(dataset_id)
+        limiter, max_workers = self._get_limiter(remote, threads)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for chunk in chunks:
+                f = executor.submit(
+                    self._download_chunk,
+                    remote,
+                    chunk,
+                    from_date,
+                    to_date,
+                    budget,
+                    limiter,
+                    call,
+                )
+                futures.append(f)
+            _ = concurrent.futures.wait(futures)
+
+        try:
+            results_list = [f.result() for f in futures]
+        except Exception:
+            self._release_futures(futures)
+            raise
+
+        return results_list
+
+    def _download_chunk(
+        self,
+        remote: dict,
+        chunk: dict,
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        budget: MemoryBudget = None,
+        limiter: AdaptiveConcurrency = None,
+        call=None,
+    ):
+        """
+        Download a single results chunk. The chunk is spilled to a temporary file if the memory budget has been reached. Concurrent downloads of the same chunk (e.g. from overlapping queries in other threads) share a single download.
+        """
+        if (budget is not None) and (remote["cache"] is None) and budget.spill():
+            remote = dict(remote, cache=budget.chunks_path)
+
+        ## The cached chunks are content addressed, so the versions of a dataset share the downloads of the same chunk. Without a cache a chunk can be read partially (with range requests), so the time selection is part of the key
+        if isinstance(remote["cache"], pathlib.Path):
+            key = ("results", utils.local_results_path(remote["cache"], chunk))
+        else:
+            key = ("results", chunk["key"], remote["cache"], from_date, to_date)
+
+        data_obj, shared = self._flight.do(
+            key,
+            self._fetch_chunk,
+            remote,
+            chunk,
+            from_date,
+            to_date,
+            limiter,
+            call,
+        )
+        if shared and isinstance(data_obj, io.BytesIO):
+            data_obj = io.BytesIO(data_obj.getvalue())
+
+        if call is not None:
+            call.add("chunks")
+            if shared:
+                call.add("shared")
+
+        if budget is not None:
+            budget.add(data_obj)
+
+        self._track_chunk(chunk, data_obj)
+
+        return data_obj
 
-        chunks = utils.chunk_filters(
-            rc_list,
-            stn_ids,
+    def _fetch_chunk(
+        self,
+        remote: dict,
+        chunk: dict,
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        limiter: AdaptiveConcurrency = None,
+        call=None,
+    ):
+        """
+        Run utils.download_results with the retry policy and within a download slot of the limiter (if passed). Each attempt takes its own slot, so a slot is not held during the backoff. Chunks that are already in the cache don't need a slot.
+        """
+        if isinstance(remote["cache"], pathlib.Path):
+            cache_hit = utils.local_results_path(remote["cache"], chunk).exists()
+            if call is not None:
+                call.add("cache_hits" if cache_hit else "cache_misses")
+            if cache_hit:
+                return utils.download_results(
+                    chunk=chunk, from_date=from_date, to_date=to_date, **remote
+                )
+
+        policy = self._clients.policy
+        getter = functools.partial(
+            self._clients.get_object_hedged, remote, limiter=limiter
+        )
+
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+            ## Only the requests and the reads of their bodies count as the latency of the download (not the decompress, encode, or the wait for the cache lock). Without metrics only the requests are timed (the hedged requests read the bodies)
+            if call is None:
+                transfer = None
+                timings = []
+                attempt_getter = functools.partial(timed_call, timings, getter)
+            else:
+                transfer = CallMetrics("transfer")
+                attempt_getter = transfer.metered_getter(getter)
+            latency = None
+            throttled = False
+            try:
+                data_obj = utils.download_results(
+                    chunk=chunk,
+                    from_date=from_date,
+                    to_date=to_date,
+                    getter=attempt_getter,
+                    metrics=call,
+                    executor=self._get_decode_pool(),
+                    **remote,
+                )
+                if transfer is None:
+                    if timings:
+                        latency = sum(timings)
+                elif "transfer" in transfer.phases:
+                    latency = transfer.phases["transfer"]["seconds"]
+                return data_obj
+            except Exception as err:
+                throttled = is_throttled(err)
+                if not policy.retry(err, attempt):
+                    raise
+            finally:
+                if limiter is not None:
+                    limiter.release(latency, chunk.get("content_length", 0), throttled)
+
+            if call is not None:
+                call.add("retries")
+            time.sleep(policy.backoff(attempt))
+            attempt += 1
+
+    def _get_limiter(self, remote: dict, threads: int = None):
+        """
+        The limiter and the number of worker threads of a download. A fixed number of threads has no limiter.
+        """
+        if threads is None:
+            limiter = self._clients.limiter(remote)
+            return limiter, limiter.max_limit
+        else:
+            return None, threads
+
+    def _get_decode_pool(self):
+        """
+        The process pool of the decoding of the results chunks (if decode_processes is set). The processes are spawned rather than forked, as the download threads may hold locks when the pool starts.
+        """
+        if self.decode_processes is None:
+            return None
+
+        with self._decode_pool_lock:
+            if self._decode_pool is None:
+                self._decode_pool = concurrent.futures.ProcessPoolExecutor(
+                    self.decode_processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+
+        return self._decode_pool
+
+    def _start_metrics(self, name: str):
+        """
+        The CallMetrics of a new call, or None if there is no Metrics object.
+        """
+        if self.metrics is None:
+            return None
+
+        return self.metrics.start(name)
+
+    def _finish_metrics(self, call):
+        """ """
+        if call is not None:
+            self.metrics.finish(call)
+
+    def get_concurrency(self):
+        """
+        The adaptive download concurrency of the remotes that results have been downloaded from (with threads=None).
+
+        Returns
+        -------
+        dict
+            of remote name (endpoint/bucket) to a dict of the current limit, the cap (max_limit), the downloads in flight, the average and lowest latencies in seconds, the estimated throughput in bytes per second, and the number of requests and throttled requests.
+        """
+        return self._clients.concurrency()
+
+    def _track_chunk(self, chunk: dict, data_obj):
+        """
+        Record the access of a cached results chunk and pin it until the results have been combined. The pins only hold within this process, so the chunk is also kept until then to download it again if the eviction of another process removes it (see _restore_chunks).
+        """
+        if (self._cache_manager is not None) and isinstance(data_obj, pathlib.Path):
+            self._cache_manager.touch(data_obj, chunk.get("chunk_hash"), pin=True)
+            with self._cached_chunks_lock:
+                n, _ = self._cached_chunks.get(data_obj, (0, None))
+                self._cached_chunks[data_obj] = (n + 1, chunk)
+
+    def _release_chunks(self, results_list: list):
+        """
+        Unpin the cached results chunks once they have been combined, write their access records to the manifest, and trigger the background eviction.
+        """
+        if self._cache_manager is not None:
+            for data_obj in results_list:
+                if isinstance(data_obj, pathlib.Path):
+                    self._cache_manager.unpin(data_obj)
+                    with self._cached_chunks_lock:
+                        n, chunk = self._cached_chunks.pop(data_obj, (0, None))
+                        if n > 1:
+                            self._cached_chunks[data_obj] = (n - 1, chunk)
+            self._cache_manager.flush()
+            self._cache_manager.request_eviction()
+
+    def _restore_chunks(self, dataset_id: str, results_list: list):
+        """
+        Download the cached results chunks of results_list again that have been removed from the cache since they were downloaded (i.e. by the eviction of another process).
+
+        Returns
+        -------
+        bool
+            True if any results chunks were downloaded.
+        """
+        remote = self._get_download_remote(dataset_id)
+        with self._cached_chunks_lock:
+            chunks = [
+                self._cached_chunks[data_obj][1]
+                for data_obj in results_list
+                if isinstance(data_obj, pathlib.Path)
+                and (data_obj in self._cached_chunks)
+                and (not data_obj.exists())
+            ]
+        missing = [
+            chunk
+            for chunk in chunks
+            if utils.local_results_path(remote["cache"], chunk) in results_list
+        ]
+        if not missing:
+            return False
+
+        for chunk in missing:
+            _ = self._fetch_chunk(remote, chunk)
+
+        return True
+
+    def _release_futures(self, futures):
+        """
+        Release the results chunks of the downloads that have finished successfully (e.g. when another download of the query has failed).
+        """
+        results_list = [
+            f.result()
+            for f in futures
+            if f.done() and (not f.cancelled()) and (f.exception() is None)
+        ]
+        self._release_chunks(results_list)
+
+    def _get_download_remote(self, dataset_id: str, clients: bool = True):
+        """
+        The remote parameters passed to utils.download_results with the pooled client of the remote (unless clients is False).
+        """
+        remote = copy.deepcopy(self._remotes[dataset_id])
+        version = remote.pop("version")
+
+        remote["cache"] = self.cache
+        if clients:
+            remote.update(self._clients.remote_kwargs(remote))
+
+        return remote
+
+    def _lazy_results(
+        self,
+        dataset_id: str,
+        version_date: str,
+        chunks: List[dict],
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        from_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        to_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        squeeze_dims: bool = False,
+    ):
+        """
+        The dask-backed results of the results chunks (see lazy.lazy_results). The first results chunk is downloaded as the template of the results.
+        """
+        from tethysts import lazy
+
+        dataset = self._datasets[dataset_id]
+        if dataset.get("result_type") != "time_series":
+            raise ValueError(
+                "lazy results are only available for time series datasets."
+            )
+
+        if "chunk_parameters" in dataset:
+            time_interval = int(dataset["chunk_parameters"]["time_interval"])
+        else:
+            time_interval = 0
+
+        remote = self._get_download_remote(dataset_id)
+        data_obj = self._download_chunk(remote, chunks[0], from_date, to_date)
+        try:
+            template = lazy.open_results(data_obj)
+        finally:
+            self._release_chunks([data_obj])
+
+        xr3 = lazy.lazy_results(
+            self._clients,
+            self._get_download_remote(dataset_id, clients=False),
+            chunks,
+            template,
             time_interval,
+            dataset.get("frequency_interval"),
+            dataset.get("utc_offset"),
             from_date,
             to_date,
-            heights,
-            bands,
             from_mod_date,
             to_mod_date,
         )
 
-        if chunks:
-            ## Get results chunks
-            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-                remote["cache"] = self.cache
-                if "public_url" not in remote:
-                    s3 = s3_client(remote["connection_config"], threads)
-                    remote["s3"] = s3
-
-                futures = []
-                for chunk in chunks:
-                    remote["chunk"] = chunk
-                    remote["from_date"] = from_date
-                    remote["to_date"] = to_date
-                    f = executor.submit(utils.download_results, **remote)
-                    futures.append(f)
-                runs = concurrent.futures.wait(futures)
-
-            results_list = [r.result() for r in runs[0]]
-
-            ## Clear xarray cache...because it loves caching everything...
-            ## This is to ensure that xarray will open the file rather than opening a cache
-            ## The next xarray version should have this issue fixed:
-            ## https://github.com/pydata/xarray/pull/4879
-            xr.backends.file_manager.FILE_CACHE.clear()
+        xr3.attrs["version_date"] = (
+            pd.Timestamp(version_date).tz_localize(None).isoformat()
+        )
+
+        if squeeze_dims:
+            xr3 = xr3.squeeze()
+
+        return xr3
+
+    def close(self):
+        """
+        Close the pooled connections to the remotes, stop the background cache eviction, and shut down the decode processes. The object can still be used afterwards, but new connections (and processes) will be opened.
+        """
+        self._clients.close()
+        if self._cache_manager is not None:
+            self._cache_manager.stop()
+        with self._decode_pool_lock:
+            if self._decode_pool is not None:
+                self._decode_pool.shutdown(wait=True)
+                self._decode_pool = None
+
+    def _combine_results(
+        self,
+        dataset_id: str,
+        version_date: str,
+        results_list: list,
+        geometry: dict = None,
+        lat: float = None,
+        lon: float = None,
+        distance: float = None,
+        from_date: Union[str, pd.Timestamp, datetime] = None,
+        to_date: Union[str, pd.Timestamp, datetime] = None,
+        from_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        to_mod_date: Union[str, pd.Timestamp, datetime] = None,
+        squeeze_dims: bool = False,
+        output_path: Union[str, pathlib.Path] = None,
+        compression: str = "lzf",
+        budget: MemoryBudget = None,
+        call=None,
+    ):
+        """
+        Combine the downloaded results chunks into a single xr.Dataset and apply the final filters. See get_results for the parameters.
+        """
+        spill_output = False
+        if (output_path is None) and (budget is not None):
+            if budget.exceeded(results_list):
+                output_path = budget.path.joinpath("results.h5")
+                compression = "zstd"
+                spill_output = True
+        dataset = self._datasets[dataset_id]
+        if "result_type" in dataset:
+            result_type = dataset["result_type"]
+        else:
+            result_type = ""
 
+        if isinstance(geometry, dict):
+            geom_type = geometry["type"]
+        else:
+            geom_type = None
+
+        ## Clear xarray cache...because it loves caching everything...
+        ## This is to ensure that xarray will open the file rather than opening a cache
+        ## The next xarray version should have this issue fixed:
+        ## https://github.com/pydata/xarray/pull/4879
+        xr.backends.file_manager.FILE_CACHE.clear()
+
+        ## The temporary files are removed if anything fails before the results are returned
+        try:
             ## combine results
-            xr3 = utils.results_concat(
-                results_list,
-                output_path=output_path,
-                from_date=from_date,
-                to_date=to_date,
-                from_mod_date=from_mod_date,
-                to_mod_date=to_mod_date,
-                compression=compression,
-            )
+            try:
+                with phase(call, "concat"):
+                    concat = functools.partial(
+                        utils.results_concat,
+                        results_list,
+                        output_path=output_path,
+                        from_date=from_date,
+                        to_date=to_date,
+                        from_mod_date=from_mod_date,
+                        to_mod_date=to_mod_date,
+                        compression=compression,
+                    )
+                    ## hdf5tools doesn't raise a FileNotFoundError for a missing file, so the restore checks which files are missing
+                    try:
+                        xr3 = concat()
+                    except Exception:
+                        if not self._restore_chunks(dataset_id, results_list):
+                            raise
+                        xr3 = concat()
+                ## The file manager of a results file is shared by the lazy arrays of all of the datasets derived from xr3
+                store_close = xr3._close
+                file_manager = getattr(
+                    getattr(store_close, "__self__", None), "_manager", xr3
+                )
+            finally:
+                self._release_chunks(results_list)
+                if budget is not None:
+                    budget.remove_chunks()
+
+            if budget is not None:
+                del results_list
 
             ## Convert to new version
             attrs = xr3.attrs.copy()
@@ -597,13 +1939,23 @@ class Tethys(object):
                 xr3 = utils.get_nearest_from_extent(xr3, geometry, lat, lon)
 
             ## Filters
-            xr3.attrs["version_date"] = pd.Timestamp(vd).tz_localize(None).isoformat()
+            xr3.attrs["version_date"] = (
+                pd.Timestamp(version_date).tz_localize(None).isoformat()
+            )
 
             if squeeze_dims:
                 xr3 = xr3.squeeze()
 
-        else:
-            xr3 = xr.Dataset()
+            ## The spilled results file is removed once the returned dataset is closed or its file manager has been garbage collected
+            if spill_output:
+                xr3.set_close(functools.partial(close_spilled, store_close, budget))
+                weakref.finalize(file_manager, budget.remove)
+            elif budget is not None:
+                budget.remove()
+        except BaseException:
+            if budget is not None:
+                budget.remove()
+            raise
 
         return xr3
 
@@ -0,0 +1,243 @@
+"""
+Per call instrumentation of the phases of the results queries.
+"""
+import collections
+import contextlib
+import threading
+import time
+
+##############################################
+### Parameters
+
+_null_phase = contextlib.nullcontext()
+
+##############################################
+### Classes
+
+
+class MeteredStream(object):
+    """
+    Wraps a file object (e.g. the body of a response) and records the time spent in and the bytes returned by its reads as the transfer of a CallMetrics.
+    """
+
+    def __init__(self, file_obj, metrics):
+        """ """
+        self._file_obj = file_obj
+        self._metrics = metrics
+
+    def read(self, *args):
+        start = time.perf_counter()
+        data = self._file_obj.read(*args)
+        self._metrics.add_transfer(time.perf_counter() - start, len(data))
+
+        return data
+
+    def readinto(self, b):
+        start = time.perf_counter()
+        n = self._file_obj.readinto(b)
+        self._metrics.add_transfer(time.perf_counter() - start, n or 0)
+
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self._file_obj, name)
+
+
+class CallMetrics(object):
+    """
+    The metrics of a single call: the time of each phase (in seconds) with the number of times it ran, and the counters (e.g. the number of chunks, bytes, cache hits and misses, and retries). The phases run in several threads at once, so their sum can be more than the duration of the call. The transfer time is only counted as transfer: it is taken out of the phases (like decompress) that read the response streams. Safe to update from several threads.
+
+    Parameters
+    ----------
+    name : str
+        The name of the call (e.g. get_results).
+
+    Returns
+    -------
+    CallMetrics
+    """
+
+    def __init__(self, name: str):
+        """ """
+        self.name = name
+        self.phases = {}
+        self.counters = collections.Counter()
+        self.start_time = time.time()
+        self.duration = None
+        self._start = time.perf_counter()
+        self._transfer = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<CallMetrics {} {}>".format(self.name, self.as_dict())
+
+    def add_time(self, phase: str, seconds: float):
+        """
+        Add the time of a run of a phase.
+        """
+        with self._lock:
+            stats = self.phases.setdefault(phase, {"seconds": 0.0, "count": 0})
+            stats["seconds"] += seconds
+            stats["count"] += 1
+
+    def add(self, counter: str, n: int = 1):
+        """
+        Add to a counter.
+        """
+        with self._lock:
+            self.counters[counter] += n
+
+    def add_transfer(self, seconds: float, n_bytes: int = 0, request: bool = False):
+        """
+        Add the time and bytes of a request or a read of a response stream in the current thread. The count of the transfer phase is the number of requests.
+        """
+        ident = threading.get_ident()
+        with self._lock:
+            stats = self.phases.setdefault("transfer", {"seconds": 0.0, "count": 0})
+            stats["seconds"] += seconds
+            stats["count"] += int(request)
+            self.counters["bytes"] += n_bytes
+            self._transfer[ident] = self._transfer.get(ident, 0.0) + seconds
+
+    def _thread_transfer(self):
+        """ """
+        with self._lock:
+            return self._transfer.get(threading.get_ident(), 0.0)
+
+    @contextlib.contextmanager
+    def phase(self, phase: str):
+        """
+        Time a phase, less the time that the current thread spends in the transfers within it.
+        """
+        transfer = self._thread_transfer()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            seconds -= self._thread_transfer() - transfer
+            self.add_time(phase, max(seconds, 0.0))
+
+    def meter(self, file_obj):
+        """
+        Wrap a file object so that its reads are recorded as transfers.
+        """
+        return MeteredStream(file_obj, self)
+
+    def metered_getter(self, getter):
+        """
+        Wrap a getter of utils.download_results so that its requests (including the failed ones) and the reads of the returned file objects are recorded as transfers.
+        """
+
+        def get(obj_key, **kwargs):
+            start = time.perf_counter()
+            try:
+                file_obj = getter(obj_key, **kwargs)
+            finally:
+                self.add_transfer(time.perf_counter() - start, request=True)
+            return self.meter(file_obj)
+
+        return get
+
+    def finish(self):
+        """
+        Record the duration of the call.
+        """
+        self.duration = time.perf_counter() - self._start
+
+    def as_dict(self):
+        """
+        The metrics as a dict of the name, start_time, duration, phases, and counters.
+        """
+        with self._lock:
+            return {
+                "name": self.name,
+                "start_time": self.start_time,
+                "duration": self.duration,
+                "phases": {k: dict(v) for k, v in self.phases.items()},
+                "counters": dict(self.counters),
+            }
+
+
+class Metrics(object):
+    """
+    Collects the CallMetrics of the calls of a Tethys object (passed as its metrics parameter). The phases of get_results and iter_results are version (the version resolution), results_chunks (the download of the results chunks index), chunk_filters, transfer (the requests and reads of the results chunks), decompress (of the zstandard compressed results chunks), encode (to hdf5), decode (the decompress and encode in the decode processes, see decode_processes of Tethys), and concat (results_concat). The counters are chunks, bytes, cache_hits, cache_misses, shared (downloads shared with concurrent calls), and retries. The metrics of the last max_calls calls are kept in the calls attribute and each callback is called with the CallMetrics of a call once it has finished, so they can be sent on to a monitoring system. Without a Metrics object nothing is recorded.
+
+    Parameters
+    ----------
+    callbacks : list of callable or None
+        Functions that take a CallMetrics.
+    max_calls : int
+        The number of calls kept in the calls attribute.
+
+    Returns
+    -------
+    Metrics
+    """
+
+    def __init__(self, callbacks: list = None, max_calls: int = 100):
+        """ """
+        if callbacks is None:
+            callbacks = []
+        self.callbacks = list(callbacks)
+        self.calls = collections.deque(maxlen=max_calls)
+        self._lock = threading.Lock()
+
+    def add_callback(self, callback):
+        """
+        Add a function that takes the CallMetrics of each finished call.
+        """
+        self.callbacks.append(callback)
+
+    def start(self, name: str):
+        """
+        Start the metrics of a call.
+        """
+        return CallMetrics(name)
+
+    def finish(self, call: CallMetrics):
+        """
+        Finish the metrics of a call, keep them, and pass them to the callbacks.
+        """
+        call.finish()
+        with self._lock:
+            self.calls.append(call)
+        for callback in self.callbacks:
+            callback(call)
+
+    def summary(self):
+        """
+        The sums of the phases and the counters over the kept calls.
+
+        Returns
+        -------
+        dict
+            of the number of calls, the phases, and the counters.
+        """
+        phases1 = {}
+        counters = collections.Counter()
+        with self._lock:
+            calls = list(self.calls)
+        for call in calls:
+            d = call.as_dict()
+            for name, stats in d["phases"].items():
+                total = phases1.setdefault(name, {"seconds": 0.0, "count": 0})
+                total["seconds"] += stats["seconds"]
+                total["count"] += stats["count"]
+            counters.update(d["counters"])
+
+        return {"calls": len(calls), "phases": phases1, "counters": dict(counters)}
+
+
+##############################################
+### Functions
+
+
+def phase(call: CallMetrics, name: str):
+    """
+    The context manager that times a phase of the call, or a shared no-op context manager if the call is not instrumented.
+    """
+    if call is None:
+        return _null_phase
+
+    return call.phase(name)
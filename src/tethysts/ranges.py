@@ -0,0 +1,206 @@
+"""
+A lazy file object of a remote object that reads with byte range requests.
+"""
+import collections
+import io
+import threading
+from typing import Callable
+
+##############################################
+### Class
+
+
+class RangeFile(io.RawIOBase):
+    """
+    A read-only, seekable file object of a remote object that only downloads the byte ranges that are read. This lets h5py read the metadata and only the chunks of the selected data of an hdf5 file rather than the whole file. The reads are aligned to blocks which are kept in an LRU block cache, and the missing blocks of a read are fetched with a single range request. Sequential reads (like h5py reading the chunks of a coordinate one after another) fetch a growing number of blocks ahead, so they don't each need a request. Once more than full_fraction of the object has been fetched, the rest of the object is fetched with one request, so reading most of the object doesn't become many small requests.
+
+    Parameters
+    ----------
+    fetch : callable
+        A function of (start, end) that returns the bytes of the object from start to end (inclusive, like the http Range header).
+    size : int
+        The size of the object in bytes.
+    block_size : int or None
+        The size of the blocks in bytes. None will use 1/64 of the size of the object, between 4 KB and 64 KB.
+    max_blocks : int
+        The maximum number of blocks kept in the block cache.
+    max_readahead : int
+        The maximum number of blocks fetched ahead of sequential reads.
+    full_fraction : float
+        The fraction of the object after which the rest of the object is fetched at once.
+
+    Returns
+    -------
+    RangeFile
+    """
+
+    def __init__(
+        self,
+        fetch: Callable,
+        size: int,
+        block_size: int = None,
+        max_blocks: int = 256,
+        max_readahead: int = 32,
+        full_fraction: float = 0.75,
+    ):
+        """ """
+        if block_size is None:
+            block_size = min(max(size // 64, 2**12), 2**16)
+        self._fetch = fetch
+        self.size = size
+        self.block_size = block_size
+        self.max_readahead = max_readahead
+        self._readahead = 0
+        self._last_stop = None
+        self.max_blocks = max_blocks
+        self.full_fraction = full_fraction
+        self._blocks = collections.OrderedDict()
+        self._full = None
+        self._pos = 0
+        self._lock = threading.Lock()
+        self.bytes_fetched = 0
+        self.n_requests = 0
+
+    def __deepcopy__(self, memo):
+        ## hdf5tools deep copies its source files on selections, but this is read-only so it can be shared
+        return self
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence: {}".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+
+        return pos
+
+    def _get(self, start: int, end: int):
+        """
+        Fetch a byte range and account for it.
+        """
+        data = self._fetch(start, end)
+        self.bytes_fetched += len(data)
+        self.n_requests += 1
+
+        return data
+
+    def _fetch_full(self):
+        """
+        Fetch the rest of the object, with one request per run of blocks that are not in the block cache.
+        """
+        n_blocks = -(-self.size // self.block_size)
+        parts = []
+        b = 0
+        while b < n_blocks:
+            if b in self._blocks:
+                parts.append(self._blocks[b])
+                b += 1
+            else:
+                run_last = b
+                while (run_last + 1 < n_blocks) and (run_last + 1 not in self._blocks):
+                    run_last += 1
+                parts.append(
+                    self._get(
+                        b * self.block_size,
+                        min((run_last + 1) * self.block_size, self.size) - 1,
+                    )
+                )
+                b = run_last + 1
+
+        self._full = b"".join(parts)
+        self._blocks.clear()
+
+    def _read_range(self, start: int, stop: int):
+        """
+        The bytes from start to stop (exclusive) through the block cache.
+        """
+        if self._full is not None:
+            return self._full[start:stop]
+
+        first = start // self.block_size
+        last = (stop - 1) // self.block_size
+        missing = [b for b in range(first, last + 1) if b not in self._blocks]
+
+        ## Grow the readahead on sequential reads that need a request and reset it on other reads
+        sequential = (self._last_stop is not None) and (
+            0 <= (start - self._last_stop) < self.block_size
+        )
+        self._last_stop = stop
+        if not sequential:
+            self._readahead = 0
+        elif missing:
+            self._readahead = min(max(self._readahead * 2, 1), self.max_readahead)
+
+        if missing:
+            n_blocks = -(-self.size // self.block_size)
+            run_last = missing[-1]
+            while (
+                (run_last + 1 < n_blocks)
+                and (run_last - last < self._readahead)
+                and (run_last + 1 not in self._blocks)
+            ):
+                run_last += 1
+
+            new_bytes = (run_last - missing[0] + 1) * self.block_size
+            if (self.bytes_fetched + new_bytes) > (self.size * self.full_fraction):
+                self._fetch_full()
+                return self._full[start:stop]
+
+            ## One request for the run of missing blocks
+            data = self._get(
+                missing[0] * self.block_size,
+                min((run_last + 1) * self.block_size, self.size) - 1,
+            )
+            for b in range(missing[0], run_last + 1):
+                offset = (b - missing[0]) * self.block_size
+                self._blocks[b] = data[offset : offset + self.block_size]
+
+        parts = []
+        for b in range(first, last + 1):
+            self._blocks.move_to_end(b)
+            parts.append(self._blocks[b])
+        data = b"".join(parts)
+
+        while len(self._blocks) > max(self.max_blocks, last - first + 1):
+            self._blocks.popitem(last=False)
+
+        offset = first * self.block_size
+
+        return data[start - offset : stop - offset]
+
+    def readinto(self, b):
+        with self._lock:
+            start = self._pos
+            stop = min(start + len(b), self.size)
+            if start >= stop:
+                return 0
+            data = self._read_range(start, stop)
+            n = len(data)
+            b[:n] = data
+            self._pos = start + n
+
+        return n
+
+    def readall(self):
+        with self._lock:
+            data = (
+                self._read_range(self._pos, self.size) if self._pos < self.size else b""
+            )
+            self._pos += len(data)
+
+        return data
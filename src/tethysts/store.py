@@ -0,0 +1,428 @@
+"""
+A local store of the materialized results of stations that is kept up to date with incremental syncs.
+"""
+import contextlib
+import io
+import os
+import pathlib
+from typing import List, Union
+
+import orjson
+
+from tethysts import utils
+from tethysts.cache import write_bytes_atomic
+from tethysts.imports import lazy_import
+from tethysts.locks import FileLock, lock_path, temp_path
+
+h5py = lazy_import("h5py")
+hdf5tools = lazy_import("hdf5tools")
+np = lazy_import("numpy")
+xr = lazy_import("xarray")
+
+##############################################
+### Parameters
+
+results_name = "{ds_id}/{stn_id}.results.h5"
+manifest_name = "{ds_id}/{stn_id}.manifest.json"
+
+## The attributes of the hdf5 datasets that make up their encoding
+encoding_attrs = (
+    "dtype",
+    "dtype_decoded",
+    "scale_factor",
+    "add_offset",
+    "_FillValue",
+    "missing_value",
+    "units",
+    "calendar",
+)
+
+## The attributes of the hdf5 dimension scales, which are set by h5py
+dimension_attrs = (
+    "CLASS",
+    "NAME",
+    "REFERENCE_LIST",
+    "DIMENSION_LIST",
+    "DIMENSION_LABELS",
+)
+
+##############################################
+### Class
+
+
+class ResultsStore(object):
+    """
+    A local store of the full results of stations. There is one hdf5 file per dataset and station with all of the results of the station, and a manifest of the chunk_hash and modified_date of each results chunk (by chunk_id) that has been merged into it. A sync (see Tethys.sync_results) compares the results chunks of the remote with the manifest and only downloads the new and changed results chunks. Their values are written into the results file of the station in place (the time dimension of the results files can be extended), so a regular refresh costs the size of the changes rather than the whole record of the stations, and opening the stations reads a single file per station. The values of a changed results chunk take precedence over the stored values (like the later results chunks in get_results), but values that were removed from a changed results chunk stay in the store. If a results chunk has been removed from the remote, then the station is rebuilt from all of its results chunks, and if all of them have been removed, then the station is removed from the store.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        The base path of the store.
+
+    Returns
+    -------
+    ResultsStore
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path]):
+        """ """
+        self.path = pathlib.Path(path)
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self):
+        return "<ResultsStore {}>".format(self.path)
+
+    def results_path(self, dataset_id: str, station_id: str):
+        """
+        The path of the results file of a station.
+        """
+        return self.path.joinpath(
+            results_name.format(ds_id=dataset_id, stn_id=station_id)
+        )
+
+    def manifest_path(self, dataset_id: str, station_id: str):
+        """
+        The path of the manifest of a station.
+        """
+        return self.path.joinpath(
+            manifest_name.format(ds_id=dataset_id, stn_id=station_id)
+        )
+
+    def manifest(self, dataset_id: str, station_id: str):
+        """
+        The manifest of a station: a dict of the version_date of the last sync and the chunks (a dict of chunk_id to the chunk_hash and modified_date). None if the station is not in the store.
+        """
+        manifest_path = self.manifest_path(dataset_id, station_id)
+        if (not manifest_path.exists()) or (
+            not self.results_path(dataset_id, station_id).exists()
+        ):
+            return None
+
+        return orjson.loads(manifest_path.read_bytes())
+
+    def delta(self, dataset_id: str, station_id: str, chunks: List[dict]):
+        """
+        The results chunks of a station that are not in the store (or have changed) and whether the station must be rebuilt from all of its results chunks.
+
+        Returns
+        -------
+        tuple of (list of dict, bool)
+        """
+        manifest = self.manifest(dataset_id, station_id)
+        if manifest is None:
+            return list(chunks), True
+
+        stored = manifest["chunks"]
+        current = {chunk["chunk_id"] for chunk in chunks}
+        if not current.issuperset(stored):
+            return list(chunks), True
+
+        new_chunks = [
+            chunk
+            for chunk in chunks
+            if stored.get(chunk["chunk_id"]) != chunk_state(chunk)
+        ]
+
+        return new_chunks, False
+
+    def merge(
+        self,
+        dataset_id: str,
+        station_id: str,
+        version_date: str,
+        chunks: List[dict],
+        results_list: list,
+        rebuild: bool = False,
+    ):
+        """
+        Merge the downloaded results chunks (in modified_date order) into the results of a station and update its manifest while holding a lock on the station. The values of the results chunks are written into the results file in place (see update_results). If rebuild (or the results chunks can't be written in place), then a new results file is written to a temporary file and renamed into place.
+        """
+        results_path = self.results_path(dataset_id, station_id)
+        results_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with FileLock(lock_path(results_path)):
+            manifest = None if rebuild else self.manifest(dataset_id, station_id)
+            if manifest is None:
+                stored = {}
+                inputs = list(results_list)
+            else:
+                stored = manifest["chunks"]
+                if update_results(results_path, results_list):
+                    inputs = None
+                else:
+                    inputs = [results_path] + list(results_list)
+
+            if inputs is not None:
+                tmp_path = temp_path(results_path)
+                try:
+                    write_results(tmp_path, inputs)
+                    os.replace(tmp_path, results_path)
+                finally:
+                    tmp_path.unlink(missing_ok=True)
+
+            for chunk in chunks:
+                stored[chunk["chunk_id"]] = chunk_state(chunk)
+            manifest = {"version_date": str(version_date), "chunks": stored}
+            write_bytes_atomic(
+                self.manifest_path(dataset_id, station_id), orjson.dumps(manifest)
+            )
+
+    def remove(self, dataset_id: str, station_id: str):
+        """
+        Remove a station from the store.
+        """
+        results_path = self.results_path(dataset_id, station_id)
+        if not results_path.parent.exists():
+            return
+
+        with FileLock(lock_path(results_path)):
+            self.manifest_path(dataset_id, station_id).unlink(missing_ok=True)
+            results_path.unlink(missing_ok=True)
+
+    def station_ids(self, dataset_id: str):
+        """
+        The station_ids of a dataset in the store.
+        """
+        return sorted(
+            p.name[: -len(".results.h5")]
+            for p in self.path.joinpath(dataset_id).glob("*.results.h5")
+        )
+
+    def open(
+        self,
+        dataset_id: str,
+        station_ids: Union[str, List[str]] = None,
+        from_date=None,
+        to_date=None,
+    ):
+        """
+        Open the stored results of stations of a dataset as a single xr.Dataset (in memory). The results files are read while holding the locks of the stations, as the syncs update them in place.
+
+        Parameters
+        ----------
+        dataset_id : str
+            The dataset_id of the dataset.
+        station_ids : str, list of str, or None
+            The station_ids. None will open all of the stations of the dataset in the store.
+        from_date : str, Timestamp, datetime, or None
+            The start date of the selection.
+        to_date : str, Timestamp, datetime, or None
+            The end date of the selection.
+
+        Returns
+        -------
+        xr.Dataset
+        """
+        if station_ids is None:
+            station_ids = self.station_ids(dataset_id)
+        elif isinstance(station_ids, str):
+            station_ids = [station_ids]
+
+        paths = []
+        for station_id in station_ids:
+            results_path = self.results_path(dataset_id, station_id)
+            if not results_path.exists():
+                raise ValueError(
+                    "station_id {} of dataset_id {} is not in the store.".format(
+                        station_id, dataset_id
+                    )
+                )
+            paths.append(results_path)
+
+        if not paths:
+            return xr.Dataset()
+
+        ## The locks are taken in order, so that concurrent opens can't deadlock
+        with contextlib.ExitStack() as stack:
+            for results_path in sorted(set(paths)):
+                stack.enter_context(FileLock(lock_path(results_path)))
+            xr3 = utils.results_concat(paths, from_date=from_date, to_date=to_date)
+
+        return xr3
+
+
+##############################################
+### Functions
+
+
+def chunk_state(chunk: dict):
+    """
+    The chunk_hash and modified_date of a results chunk as stored in a manifest.
+    """
+    return {
+        "chunk_hash": chunk["chunk_hash"],
+        "modified_date": str(chunk.get("modified_date")),
+    }
+
+
+def filtered_results(inputs: list):
+    """
+    Combine results chunks (or results files) into an in-memory hdf5 file without the coordinates that get_results drops (see utils.result_filters).
+    """
+    buf = io.BytesIO()
+    utils.result_filters(hdf5tools.H5(inputs)).to_hdf5(buf, compression="zstd")
+
+    return buf
+
+
+def dims(ds):
+    """
+    The dimension names of an hdf5 dataset.
+    """
+    return [d.label for d in ds.dims]
+
+
+def is_scale(ds):
+    """
+    Is the hdf5 dataset a dimension scale (i.e. a coordinate)?
+    """
+    return ds.attrs.get("CLASS") == b"DIMENSION_SCALE"
+
+
+def write_results(output: Union[str, pathlib.Path], inputs: list):
+    """
+    Combine results chunks (or results files) into a results file of the store. The file is like the files of hdf5tools, but the time dimension of its datasets can be extended (see update_results).
+    """
+    compressor = hdf5tools.utils.get_compressor("zstd")
+
+    with h5py.File(filtered_results(inputs), "r") as src, h5py.File(
+        output, "w", track_order=True
+    ) as dst:
+        for name, ds in src.items():
+            ds_dims = dims(ds)
+            maxshape = tuple(
+                None if dim == "time" else n for dim, n in zip(ds_dims, ds.shape)
+            )
+            chunks = ds.chunks
+            if (chunks is None) and ("time" in ds_dims):
+                chunks = True
+            new_ds = dst.create_dataset(
+                name,
+                ds.shape,
+                dtype=ds.dtype,
+                maxshape=maxshape,
+                chunks=chunks,
+                fillvalue=ds.fillvalue,
+                track_order=True,
+                **compressor,
+            )
+            new_ds[()] = ds[()]
+            if is_scale(ds):
+                new_ds.make_scale(name)
+
+        for name, ds in src.items():
+            new_ds = dst[name]
+            for i, dim in enumerate(dims(ds)):
+                if not is_scale(ds):
+                    new_ds.dims[i].attach_scale(dst[dim])
+                new_ds.dims[i].label = dim
+            new_ds.attrs.update(
+                {k: v for k, v in ds.attrs.items() if k not in dimension_attrs}
+            )
+
+        dst.attrs.update(src.attrs)
+
+
+def same_encoding(ds1, ds2):
+    """
+    Do two hdf5 datasets have the same dimensions and encoding?
+    """
+    if (ds1.dtype != ds2.dtype) or (dims(ds1) != dims(ds2)):
+        return False
+
+    return all(
+        str(ds1.attrs.get(attr)) == str(ds2.attrs.get(attr)) for attr in encoding_attrs
+    )
+
+
+def contiguous(positions):
+    """
+    The positions as a slice if they are contiguous and increasing, otherwise None.
+    """
+    if (len(positions) == 0) or (positions.min() < 0):
+        return None
+    start = int(positions[0])
+    if not np.array_equal(positions, np.arange(start, start + len(positions))):
+        return None
+
+    return slice(start, start + len(positions))
+
+
+def update_results(results_path: pathlib.Path, results_list: list):
+    """
+    Write the values of results chunks (in modified_date order) into a results file of the store in place. The times of the results chunks that are after the last time of the file are appended to it. The file is left as is and False is returned if the results chunks can't be written in place: their variables, encodings, or coordinates (other than time) aren't in the file or their new times are before the last time of the file.
+    """
+    chunks = [filtered_results(data_obj) for data_obj in results_list]
+
+    with contextlib.ExitStack() as stack:
+        f = stack.enter_context(h5py.File(results_path, "r+"))
+        chunks = [stack.enter_context(h5py.File(buf, "r")) for buf in chunks]
+
+        if "time" not in f:
+            return False
+        times = f["time"][()]
+
+        ## Check the results chunks and collect their new times
+        new_times = set()
+        for c in chunks:
+            for name, ds in c.items():
+                if (name not in f) or (not same_encoding(ds, f[name])):
+                    return False
+            if "time" in c:
+                c_times = c["time"][()]
+                c_new = c_times[~np.isin(c_times, times)]
+                if len(c_new) and len(times) and (c_new.min() <= times[-1]):
+                    return False
+                new_times.update(c_new.tolist())
+
+        if new_times:
+            for name, ds in f.items():
+                ds_dims = dims(ds)
+                if ("time" in ds_dims) and (
+                    ds.maxshape[ds_dims.index("time")] is not None
+                ):
+                    return False
+        all_times = np.concatenate(
+            [times, np.array(sorted(new_times), dtype=times.dtype)]
+        )
+
+        ## The positions of the values of each results chunk in the file
+        coords = {
+            name: {v: i for i, v in enumerate(ds[()].tolist())}
+            for name, ds in f.items()
+            if is_scale(ds) and (name != "time")
+        }
+        writes = []
+        for c in chunks:
+            slices = {}
+            for name, ds in c.items():
+                if not is_scale(ds):
+                    continue
+                values = ds[()]
+                if name == "time":
+                    positions = np.searchsorted(all_times, values)
+                else:
+                    positions = np.array(
+                        [coords[name].get(v, -1) for v in values.tolist()]
+                    )
+                slices[name] = contiguous(positions)
+                if slices[name] is None:
+                    return False
+
+            for name, ds in c.items():
+                if not is_scale(ds):
+                    selection = tuple(slices[dim] for dim in dims(ds))
+                    writes.append((name, selection, ds[()]))
+
+        ## Extend the time dimension and write the values
+        if new_times:
+            for name, ds in f.items():
+                ds_dims = dims(ds)
+                if "time" in ds_dims:
+                    ds.resize(len(all_times), axis=ds_dims.index("time"))
+            f["time"][len(times) :] = all_times[len(times) :]
+
+        for name, selection, values in writes:
+            f[name][selection] = values
+
+    return True
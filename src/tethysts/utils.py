@@ -1,25 +1,40 @@
 """
 
 """
-import copy
+from __future__ import annotations
+
+import collections
+import hashlib
 import io
+import os
 import pathlib
 import pickle
+import shutil
+import tempfile
+import threading
 from datetime import datetime
-from typing import List, Optional, Union
+from typing import TYPE_CHECKING, List, Optional, Union
 
-import botocore
-import numpy as np
 import orjson
-import pandas as pd
-import s3tethys
-import xarray as xr
-import zstandard as zstd
-from hdf5tools import H5
-from pydantic import HttpUrl
-from scipy import spatial
-from shapely.geometry import Point, Polygon, shape
-from shapely.strtree import STRtree
+import requests
+
+from tethysts.buffers import BufferFile, BufferPool, decompress_into
+from tethysts.imports import imported_types, lazy_import
+from tethysts.indexes import GridIndex, ResultsChunkIndex, SpatialIndex, StationTable
+from tethysts.locks import FileLock, lock_path, temp_path
+from tethysts.metrics import phase
+from tethysts.ranges import RangeFile
+
+if TYPE_CHECKING:
+    from pydantic import HttpUrl
+
+hdf5tools = lazy_import("hdf5tools")
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+s3tethys = lazy_import("s3tethys")
+shapely = lazy_import("shapely")
+xr = lazy_import("xarray")
+zstd = lazy_import("zstandard")
 
 # pd.options.display.max_columns = 10
 
@@ -32,12 +47,22 @@ public_remote_key = (
     "https://b2.tethys-ts.xyz/file/tethysts/tethys/public_remotes_v4.json.zst"
 )
 
-local_results_name = (
-    "{ds_id}/{version_date}/{stn_id}/{chunk_id}.{chunk_hash}.results.h5"
-)
+## The cached results chunks are content addressed, so the versions of a dataset share their unchanged results chunks
+local_results_name = "{ds_id}/chunks/{hash_prefix}/{chunk_hash}.results.h5"
 
 s3_url_base = "s3://{bucket}/{key}"
 
+## The reusable buffers of the decompressed netcdf results chunks
+buffer_pool = BufferPool()
+
+## The minimum size of an hdf5 results chunk for it to be read with byte range requests
+range_read_min_size = 2**20
+
+## The GridIndexes of the recently queried grids of geometry blocks (by a hash of the geometries)
+grid_indexes = collections.OrderedDict()
+grid_indexes_max = 8
+grid_indexes_lock = threading.Lock()
+
 ##############################################
 ### Helper functions
 
@@ -126,57 +151,77 @@ def cartesian_product(*arrays):
     return arr.reshape(-1, la)
 
 
-def get_nearest_station(stns, geom_query):
+def get_nearest_station(stns, geom_query, index: Optional[SpatialIndex] = None):
     """ """
-    if isinstance(geom_query, dict):
-        geom_query = shape(geom_query)
-
-    geom1 = [shape(s["geometry"]) for i, s in stns.items()]
-    strtree = STRtree(geom1)
-    res_index = strtree.nearest(geom_query)
+    if index is None:
+        index = SpatialIndex(stns)
+        mask = None
+    elif len(stns) == len(index):
+        mask = None
+    else:
+        mask = index.mask(stns)
 
-    stn_ids_list = list(stns.keys())
-    stn_id = stn_ids_list[res_index]
+    stn_id = index.nearest(geom_query, mask)
 
     return stn_id
 
 
-def get_intersected_stations(stns, geom_query):
-    """ """
-    if isinstance(geom_query, dict):
-        geom_query = shape(geom_query)
+def get_nearest_stations(stns, lons, lats, index: Optional[SpatialIndex] = None):
+    """
+    The station_ids of the stations nearest to each of the points (in a single query).
+    """
+    if index is None:
+        index = SpatialIndex(stns)
+        mask = None
+    elif len(stns) == len(index):
+        mask = None
+    else:
+        mask = index.mask(stns)
 
-    stn_ids_list = list(stns.keys())
-    geom1 = [shape(s["geometry"]) for i, s in stns.items()]
-    strtree = STRtree(geom1)
-    res_index = strtree.query(geom_query)
+    stn_ids = index.nearest_points(lons, lats, mask)
 
-    stn_ids = [stn_ids_list[r] for r in res_index]
+    return stn_ids
+
+
+def get_intersected_stations(stns, geom_query, index: Optional[SpatialIndex] = None):
+    """ """
+    if index is None:
+        index = SpatialIndex(stns)
+        mask = None
+    elif len(stns) == len(index):
+        mask = None
+    else:
+        mask = index.mask(stns)
+
+    stn_ids = index.intersects(geom_query, mask)
 
     return stn_ids
 
 
 def spatial_query(
-    stns: dict,
+    stns: Union[StationTable, dict],
     query_geometry: Optional[dict] = None,
     lat: Optional[float] = None,
     lon: Optional[float] = None,
     distance: Optional[float] = None,
+    index: Optional[SpatialIndex] = None,
 ):
-    """ """
+    """
+    Run a nearest or intersection query on the stations. If a SpatialIndex of the stations (or a superset of the stations) is passed, then it will be reused rather than building a new one.
+    """
     if isinstance(lat, float) and isinstance(lon, float):
-        geom_query = Point(lon, lat)
+        geom_query = shapely.Point(lon, lat)
         if isinstance(distance, (int, float)):
             geom_query = geom_query.buffer(distance)
-            stn_ids = get_intersected_stations(stns, geom_query)
+            stn_ids = get_intersected_stations(stns, geom_query, index)
         else:
-            stn_ids = [get_nearest_station(stns, geom_query)]
+            stn_ids = [get_nearest_station(stns, geom_query, index)]
     elif isinstance(query_geometry, dict):
-        geom_query = shape(query_geometry)
+        geom_query = shapely.geometry.shape(query_geometry)
         if isinstance(geom_query, Point):
-            stn_ids = [get_nearest_station(stns, geom_query)]
-        elif isinstance(geom_query, Polygon):
-            stn_ids = get_intersected_stations(stns, geom_query)
+            stn_ids = [get_nearest_station(stns, geom_query, index)]
+        elif isinstance(geom_query, shapely.Polygon):
+            stn_ids = get_intersected_stations(stns, geom_query, index)
         else:
             raise ValueError("query_geometry must be a Point or Polygon dict.")
     else:
@@ -185,35 +230,101 @@ def spatial_query(
     return stn_ids
 
 
-def get_nearest_from_extent(
-    data,
+def query_points(
     query_geometry: Optional[dict] = None,
-    lat: Optional[float] = None,
-    lon: Optional[float] = None,
+    lat: Union[float, List[float], None] = None,
+    lon: Union[float, List[float], None] = None,
 ):
-    """ """
-    ## Prep the query point
-    if isinstance(lat, float) and isinstance(lon, float):
-        geom_query = Point(lon, lat)
+    """
+    The lons and lats (as arrays) of one or more query points from either lat and lon (floats or lists of floats) or a Point or MultiPoint geometry in GeoJSON format.
+    """
+    if (lat is not None) and (lon is not None):
+        lats = np.atleast_1d(np.asarray(lat, dtype=float))
+        lons = np.atleast_1d(np.asarray(lon, dtype=float))
+        if lats.shape != lons.shape:
+            raise ValueError("lat and lon must have the same length.")
     elif isinstance(query_geometry, dict):
-        geom_query = shape(query_geometry)
-        if not isinstance(geom_query, Point):
-            raise ValueError("query_geometry must be a Point.")
+        geom_query = shapely.geometry.shape(query_geometry)
+        if geom_query.geom_type not in ("Point", "MultiPoint"):
+            raise ValueError("query_geometry must be a Point or MultiPoint.")
+        xy = shapely.get_coordinates(geom_query)
+        lons = xy[:, 0]
+        lats = xy[:, 1]
     else:
         raise ValueError("query_geometry or lat/lon must be passed as a Point.")
 
-    ## Prep the input data
-    if "geometry" in data:
-        raise NotImplementedError("Need to implement geometry blocks nearest query.")
+    return lons, lats
+
+
+def grid_index(data):
+    """
+    The GridIndex of gridded results. The GridIndexes of grids of geometry blocks are kept (by a hash of the geometries), so the KD-tree of a grid is only built once.
+    """
+    if "geometry" not in data.coords:
+        return GridIndex(data)
+
+    h = hashlib.blake2b(digest_size=16)
+    for geo in data["geometry"].values:
+        h.update(geo if isinstance(geo, bytes) else str(geo).encode())
+        h.update(b"\0")
+    key = h.digest()
+
+    with grid_indexes_lock:
+        index = grid_indexes.get(key)
+        if index is not None:
+            grid_indexes.move_to_end(key)
+            return index
+
+    index = GridIndex(data)
+
+    with grid_indexes_lock:
+        grid_indexes[key] = index
+        while len(grid_indexes) > grid_indexes_max:
+            grid_indexes.popitem(last=False)
+
+    return index
+
+
+def get_nearest_from_extent(
+    data,
+    query_geometry: Optional[dict] = None,
+    lat: Union[float, List[float], None] = None,
+    lon: Union[float, List[float], None] = None,
+):
+    """
+    Select the nearest cells of gridded results to one or more points (see query_points). Grids with lon and lat coordinates return the lons and lats of the nearest cells (for several points, the grid of all of their lons and lats). Grids of geometry blocks return the nearest geometries. See GridIndex for the lookups.
+    """
+    lons, lats = query_points(query_geometry, lat, lon)
+    positions = grid_index(data).nearest(lons, lats)
+
+    data1 = data.isel({dim: np.unique(pos) for dim, pos in positions.items()})
+
+    return data1
+
+
+def select_points(data, lons, lats, station_ids=None):
+    """
+    Select the results of each of the points along a new point dimension. If station_ids (the station_id of each point) is passed, then the results of the station of each point are selected by the station_id variable of the results (the points of stations without results are all NaN). Otherwise the results are gridded and the nearest cell of each point is selected (see GridIndex). The lons and lats of the points are the point_lon and point_lat coordinates.
+    """
+    if station_ids is None:
+        positions = grid_index(data).nearest(lons, lats)
+        valid = None
     else:
-        lats = data["lat"].values
-        lons = data["lon"].values
-        xy = cartesian_product(lons, lats)
-        kdtree = spatial.cKDTree(xy)
-        dist, index = kdtree.query(geom_query.coords[0])
-        lon_n, lat_n = xy[index]
+        if "station_id" not in data:
+            raise ValueError("The results have no station_id to select the points by.")
+        pos = pd.Index(data["station_id"].values).get_indexer(station_ids)
+        valid = pos >= 0
+        positions = {"geometry": np.where(valid, pos, 0)}
+
+    data1 = data.isel(
+        {dim: xr.DataArray(pos, dims="point") for dim, pos in positions.items()}
+    )
+
+    if (valid is not None) and (not valid.all()):
+        data1 = data1.where(xr.DataArray(valid, dims="point"))
+        data1["station_id"] = ("point", np.asarray(station_ids))
 
-    data1 = data.sel(lon=[lon_n], lat=[lat_n])
+    data1 = data1.assign_coords(point_lon=("point", lons), point_lat=("point", lats))
 
     return data1
 
@@ -248,7 +359,7 @@ def read_json_zstd(obj):
 
 
 def chunk_filters(
-    results_chunks,
+    results_chunks: Union[ResultsChunkIndex, List[dict]],
     stn_ids,
     time_interval=None,
     from_date=None,
@@ -258,75 +369,24 @@ def chunk_filters(
     from_mod_date=None,
     to_mod_date=None,
 ):
-    """ """
-    ## Stations filter
-    rc2 = copy.deepcopy([rc for rc in results_chunks if rc["station_id"] in stn_ids])
-    first_one = rc2[0]
-
-    ## Temporal filters
-    if isinstance(from_date, (str, pd.Timestamp, datetime)) and (
-        "chunk_day" in first_one
-    ):
-        from_date1 = int(pd.Timestamp(from_date).timestamp() / 60 / 60 / 24)
-        rc2 = [rc for rc in rc2 if (rc["chunk_day"] + time_interval) >= from_date1]
-
-    if len(rc2) == 0:
-        return rc2
-
-    if isinstance(to_date, (str, pd.Timestamp, datetime)) and (
-        "chunk_day" in first_one
-    ):
-        to_date1 = int(pd.Timestamp(to_date).timestamp() / 60 / 60 / 24)
-        rc2 = [rc for rc in rc2 if rc["chunk_day"] <= to_date1]
-
-    if len(rc2) == 0:
-        return rc2
-
-    if isinstance(from_mod_date, (str, pd.Timestamp, datetime)) and (
-        "modified_date" in first_one
-    ):
-        from_mod_date1 = pd.Timestamp(from_mod_date)
-        rc2 = [rc for rc in rc2 if pd.Timestamp(rc["modified_date"]) >= from_mod_date1]
-
-    if len(rc2) == 0:
-        return rc2
-
-    if isinstance(to_mod_date, (str, pd.Timestamp, datetime)) and (
-        "modified_date" in first_one
-    ):
-        to_mod_date1 = pd.Timestamp(to_mod_date)
-        rc2 = [rc for rc in rc2 if pd.Timestamp(rc["modified_date"]) <= to_mod_date1]
-
-    if len(rc2) == 0:
-        return rc2
-
-    ## Heights and bands filter
-    if (heights is not None) and ("height" in first_one):
-        if isinstance(heights, (int, float)):
-            h1 = [int(heights * 1000)]
-        elif isinstance(heights, list):
-            h1 = [int(h * 1000) for h in heights]
-        else:
-            raise TypeError("heights must be an int, float, or list of int/float.")
-        rc2 = [rc for rc in rc2 if rc["height"] in h1]
-
-    if len(rc2) == 0:
-        return rc2
-
-    if (bands is not None) and ("band" in first_one):
-        if isinstance(bands, int):
-            b1 = [heights]
-        elif isinstance(bands, list):
-            b1 = [int(b) for b in bands]
-        else:
-            raise TypeError("bands must be an int or list of int.")
-        rc2 = [rc for rc in rc2 if rc["band"] in b1]
-
-    if len(rc2) == 0:
-        return rc2
+    """
+    Filter the results chunks by the stations, dates, heights, and bands. The results_chunks can be either the list of results chunk dicts or a ResultsChunkIndex of them. Passing a ResultsChunkIndex avoids rebuilding the index on every call.
+    """
+    if not isinstance(results_chunks, ResultsChunkIndex):
+        results_chunks = ResultsChunkIndex(results_chunks)
+
+    pos = results_chunks.select(
+        stn_ids,
+        time_interval,
+        from_date,
+        to_date,
+        heights,
+        bands,
+        from_mod_date,
+        to_mod_date,
+    )
 
-    ## Sort by mod date
-    rc2.sort(key=lambda d: d["modified_date"] if "modified_date" in d else "1900-01-01")
+    rc2 = results_chunks.take(pos)
 
     return rc2
 
@@ -351,81 +411,324 @@ def result_filters(h5, from_date=None, to_date=None):
     return h5
 
 
-def download_results(
+def local_results_path(cache: pathlib.Path, chunk: dict):
+    """
+    The path of a results chunk in the local cache. The path only depends on the dataset_id and the chunk_hash (the hash of the content of the results chunk), so a results chunk that is unchanged in a new version of the dataset is not downloaded or stored again. The results chunks index of each version (in the metadata cache) maps its stations and chunk_ids to the chunk_hashes.
+    """
+    chunk_hash = chunk["chunk_hash"]
+    results_file_name = local_results_name.format(
+        ds_id=chunk["dataset_id"],
+        hash_prefix=chunk_hash[:2],
+        chunk_hash=chunk_hash,
+    )
+    chunk_path = cache.joinpath(results_file_name)
+
+    return chunk_path
+
+
+def load_zst_results(file_obj):
+    """
+    Load a zstandard compressed netcdf3 results chunk from a file object (stream) as an xarray Dataset. The stream is decompressed directly into a pooled buffer that the netcdf parser reads from, so neither the compressed nor the decompressed object is copied as a whole. The variables are handed to the parser as memoryviews of the buffer, which it copies into its arrays when the file is opened, so the buffer goes back to the pool before the variables are decoded.
+    """
+    buffer = buffer_pool.acquire()
+    try:
+        n = decompress_into(file_obj, buffer)
+        with memoryview(buffer) as view, view[:n] as view1:
+            ds = xr.open_dataset(
+                BufferFile(view1, view_min_size=2**20), engine="scipy"
+            )
+    finally:
+        buffer_pool.release(buffer)
+
+    with ds:
+        data = ds.load()
+
+    return data
+
+
+def decode_results(
     chunk: dict,
-    bucket: str,
-    s3: botocore.client.BaseClient = None,
-    connection_config: dict = None,
-    public_url: HttpUrl = None,
+    file_obj,
     cache: Union[pathlib.Path] = None,
     from_date=None,
     to_date=None,
-    return_raw=False,
+    metrics=None,
 ):
-    """ """
-    file_obj = s3tethys.get_object_s3(
-        chunk["key"], bucket, s3, connection_config, public_url
-    )
+    """
+    Decode the file object of a results chunk. If cache is a path, then the results are saved to the local cache and the path is returned, otherwise an hdf5 BytesIO object is returned. The cached file is written to a temporary file first and renamed into place, so other readers never open a partially written file. If the file object is a RangeFile, then only the from_date to to_date selection is read (the cache is not used). If metrics (a CallMetrics) is passed, then the decompress and encode phases are recorded.
+    """
+    if isinstance(file_obj, RangeFile):
+        with phase(metrics, "encode"):
+            h1 = result_filters(hdf5tools.H5(file_obj), from_date, to_date)
+            data_obj = io.BytesIO()
+            h1.to_hdf5(data_obj, compression="zstd")
+        del h1
+
+        return data_obj
 
     if isinstance(cache, pathlib.Path):
-        chunk_hash = chunk["chunk_hash"]
-        version_date = pd.Timestamp(chunk["version_date"]).strftime("%Y%m%d%H%M%SZ")
-        results_file_name = local_results_name.format(
-            ds_id=chunk["dataset_id"],
-            stn_id=chunk["station_id"],
-            chunk_id=chunk["chunk_id"],
-            version_date=version_date,
-            chunk_hash=chunk_hash,
-        )
-        chunk_path = cache.joinpath(results_file_name)
+        chunk_path = local_results_path(cache, chunk)
 
         if not chunk_path.exists():
             chunk_path.parent.mkdir(parents=True, exist_ok=True)
-
-            if chunk["key"].endswith(".zst"):
-                data = xr.load_dataset(
-                    s3tethys.decompress_stream_to_object(
-                        io.BytesIO(file_obj.read()), "zstd"
-                    )
-                )
-                H5(data).sel(exclude_coords=["station_geometry", "chunk_date"]).to_hdf5(
-                    chunk_path, compression="zstd"
-                )
-                data.close()
-                del data
-            else:
-                s3tethys.stream_to_file(file_obj, chunk_path)
+            tmp_path = temp_path(chunk_path)
+
+            try:
+                if chunk["key"].endswith(".zst"):
+                    with phase(metrics, "decompress"):
+                        data = load_zst_results(file_obj)
+                    with phase(metrics, "encode"):
+                        hdf5tools.H5(data).sel(
+                            exclude_coords=["station_geometry", "chunk_date"]
+                        ).to_hdf5(tmp_path, compression="zstd")
+                    data.close()
+                    del data
+                else:
+                    s3tethys.stream_to_file(file_obj, tmp_path)
+
+                os.replace(tmp_path, chunk_path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
 
         data_obj = chunk_path
 
     else:
-        if return_raw:
-            return file_obj
-
         if chunk["key"].endswith(".zst"):
-            file_obj = s3tethys.decompress_stream_to_object(
-                io.BytesIO(file_obj.read()), "zstd"
-            )
-            data = xr.load_dataset(file_obj.read(), engine="scipy")
+            with phase(metrics, "decompress"):
+                data = load_zst_results(file_obj)
         else:
             data = io.BytesIO(file_obj.read())
 
-        h1 = H5(data)
-        data_obj = io.BytesIO()
-        h1 = result_filters(h1)
-        h1.to_hdf5(data_obj, compression="zstd")
+        with phase(metrics, "encode"):
+            h1 = hdf5tools.H5(data)
+            data_obj = io.BytesIO()
+            h1 = result_filters(h1)
+            h1.to_hdf5(data_obj, compression="zstd")
 
         if isinstance(data, xr.Dataset):
             data.close()
         del data
         del h1
 
+    return data_obj
+
+
+def decode_results_file(
+    chunk: dict,
+    raw_path: pathlib.Path,
+    cache: Union[pathlib.Path] = None,
+    output_path: pathlib.Path = None,
+):
+    """
+    decode_results of a results chunk that was saved to the raw_path, for decoding in another process. If cache is a path, then the results are saved to the local cache and the path is returned, otherwise the hdf5 results are written to the output_path, which is returned.
+    """
+    with open(raw_path, "rb") as file_obj:
+        data_obj = decode_results(chunk, file_obj, cache)
+
+    if isinstance(data_obj, io.BytesIO):
+        with open(output_path, "wb") as f:
+            f.write(data_obj.getbuffer())
+        data_obj = output_path
+
+    return data_obj
+
+
+def decode_in_process(
+    executor,
+    chunk: dict,
+    file_obj,
+    cache: Union[pathlib.Path] = None,
+    metrics=None,
+):
+    """
+    Decode the file object of a results chunk in a process of the executor (a process pool). The file object is read in the current thread into a temporary file that the process decodes (see decode_results_file), so neither the raw object nor the decoded results are pickled between the processes. Without a cache, the decoded results are read back from a temporary file into an hdf5 BytesIO object.
+    """
+    if isinstance(cache, pathlib.Path):
+        chunk_path = local_results_path(cache, chunk)
+        chunk_path.parent.mkdir(parents=True, exist_ok=True)
+        raw_path = temp_path(chunk_path).with_suffix(".raw")
+        output_path = None
+    else:
+        fd, raw_path = tempfile.mkstemp(suffix=".raw")
+        os.close(fd)
+        raw_path = pathlib.Path(raw_path)
+        output_path = raw_path.with_suffix(".h5")
+
+    try:
+        with open(raw_path, "wb") as f:
+            shutil.copyfileobj(file_obj, f, 2**20)
+
+        with phase(metrics, "decode"):
+            data_obj = executor.submit(
+                decode_results_file, chunk, raw_path, cache, output_path
+            ).result()
+
+        if output_path is not None:
+            with open(output_path, "rb") as f:
+                data_obj = io.BytesIO(f.read())
+    finally:
+        raw_path.unlink(missing_ok=True)
+        if output_path is not None:
+            output_path.unlink(missing_ok=True)
+
+    return data_obj
+
+
+def get_object(
+    obj_key: str,
+    bucket: str,
+    s3: "botocore.client.BaseClient" = None,
+    connection_config: dict = None,
+    public_url: HttpUrl = None,
+    session: requests.Session = None,
+    connect_timeout: int = 10,
+    read_timeout: int = 120,
+    range_start: int = None,
+    range_end: int = None,
+):
+    """
+    Get the file object of an object in a remote like s3tethys.get_object_s3, but public urls are requested with the session if one is passed so that its connections are reused and the errors of the request are raised rather than returning None. The object is streamed and the connection is returned to the pool once it has been read. Raises a FileNotFoundError if the object does not exist. range_start and range_end (inclusive) request a byte range of the object.
+    """
+    if (range_start is not None) or (range_end is not None):
+        range1 = "bytes={}-{}".format(
+            "" if range_start is None else range_start,
+            "" if range_end is None else range_end,
+        )
+    else:
+        range1 = None
+
+    if (public_url is not None) and (session is not None):
+        url = create_public_s3_url(str(public_url), bucket, obj_key)
+        headers = {"Range": range1} if range1 is not None else None
+        resp = session.get(
+            url,
+            headers=headers,
+            stream=True,
+            timeout=(connect_timeout, read_timeout),
+        )
+        if resp.status_code == 404:
+            resp.close()
+            raise FileNotFoundError(url)
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        file_obj = resp.raw
+
+    elif (public_url is None) and (s3 is not None):
+        kwargs = {"Range": range1} if range1 is not None else {}
+        try:
+            resp = s3.get_object(Bucket=bucket, Key=obj_key, **kwargs)
+        except imported_types("botocore.exceptions", "ClientError") as err:
+            code = err.response.get("Error", {}).get("Code")
+            if code in ("NoSuchKey", "404"):
+                raise FileNotFoundError(s3_url_base.format(bucket=bucket, key=obj_key))
+            raise
+        file_obj = resp["Body"]
+
+    else:
+        file_obj = s3tethys.get_object_s3(
+            obj_key,
+            bucket,
+            s3,
+            connection_config,
+            public_url,
+            range_start=range_start,
+            range_end=range_end,
+            read_timeout=read_timeout,
+        )
+        if file_obj is None:
+            raise FileNotFoundError(s3_url_base.format(bucket=bucket, key=obj_key))
+
+    return file_obj
+
+
+def range_file(chunk: dict, getter):
+    """
+    A RangeFile of a results chunk, where getter is a function of (obj_key, range_start, range_end) that returns a file object.
+    """
+    size = chunk["content_length"]
+
+    def fetch(start, end):
+        data = getter(chunk["key"], range_start=start, range_end=end).read()
+        ## In case the server ignored the range
+        if len(data) > (end - start + 1):
+            data = data[start : end + 1]
+        return data
+
+    return RangeFile(fetch, size)
+
+
+def download_results(
+    chunk: dict,
+    bucket: str,
+    s3: "botocore.client.BaseClient" = None,
+    connection_config: dict = None,
+    public_url: HttpUrl = None,
+    session: requests.Session = None,
+    cache: Union[pathlib.Path] = None,
+    from_date=None,
+    to_date=None,
+    return_raw=False,
+    getter=None,
+    metrics=None,
+    executor=None,
+):
+    """
+    Download a results chunk. If cache is a path, then the chunk is only downloaded if it is not already in the cache. The download holds a lock on the chunk in the cache, so concurrent processes (and threads) that need the same chunk wait for the first download rather than downloading it again. If getter is passed, then it's called with the object key (and optionally range_start and range_end) to get the file object instead of get_object.
+
+    Without a cache, hdf5 results chunks of at least range_read_min_size bytes are read with byte range requests when from_date or to_date is passed, so that only the selected time slice is downloaded.
+
+    If metrics (a CallMetrics) is passed, then the transfer, decompress, and encode phases are recorded.
+
+    If executor (a process pool) is passed, then the CPU bound decoding runs in its processes rather than the current thread (see decode_in_process): the decompression and re-encoding of the zstandard compressed chunks, and without a cache the filtering and re-encoding of the hdf5 chunks. The requests stay in the current thread. Chunks that are read with byte range requests are always decoded in the current thread.
+    """
+    if getter is None:
+        getter = lambda obj_key, **kwargs: get_object(
+            obj_key, bucket, s3, connection_config, public_url, session, **kwargs
+        )
+    if metrics is not None:
+        getter = metrics.metered_getter(getter)
+
+    if isinstance(cache, pathlib.Path):
+        chunk_path = local_results_path(cache, chunk)
+        if chunk_path.exists():
+            return chunk_path
+
+        with FileLock(lock_path(chunk_path)):
+            if chunk_path.exists():
+                return chunk_path
+
+            file_obj = getter(chunk["key"])
+            if (executor is not None) and chunk["key"].endswith(".zst"):
+                data_obj = decode_in_process(executor, chunk, file_obj, cache, metrics)
+            else:
+                data_obj = decode_results(chunk, file_obj, cache, metrics=metrics)
+
+        return data_obj
+
+    if (
+        (not return_raw)
+        and ((from_date is not None) or (to_date is not None))
+        and (not chunk["key"].endswith(".zst"))
+        and (chunk.get("content_length", 0) >= range_read_min_size)
+    ):
+        file_obj = range_file(chunk, getter)
+    else:
+        file_obj = getter(chunk["key"])
+
+    if return_raw and not isinstance(cache, pathlib.Path):
+        return file_obj
+
+    if (executor is not None) and (not isinstance(file_obj, RangeFile)):
+        data_obj = decode_in_process(executor, chunk, file_obj, None, metrics)
+    else:
+        data_obj = decode_results(chunk, file_obj, cache, from_date, to_date, metrics)
+
     del file_obj
 
     return data_obj
 
 
-def xr_concat(datasets: List[xr.Dataset]):
+def xr_concat(datasets: List["xr.Dataset"]):
     """
     A much more efficient concat/combine of xarray datasets. It's also much safer on memory.
     """
@@ -549,7 +852,7 @@ def results_concat(
         output_path = io.BytesIO()
         compression = "zstd"
 
-    h1 = H5(results_list)
+    h1 = hdf5tools.H5(results_list)
     h1 = result_filters(h1, from_date, to_date)
     h1.to_hdf5(output_path, compression=compression)
 
@@ -0,0 +1,24 @@
+import pytest
+
+from benchmarks.synthetic import make_remote, serve_remote
+
+
+@pytest.fixture(scope="session")
+def remote_path(tmp_path_factory):
+    root = tmp_path_factory.mktemp("remote")
+    make_remote(root)
+    return root
+
+
+@pytest.fixture(scope="session")
+def server(remote_path):
+    with serve_remote(remote_path) as server:
+        yield server
+
+
+@pytest.fixture()
+def local_remote(server):
+    server.requests.clear()
+    server.failures.clear()
+    server.delays.clear()
+    return {"bucket": "tethysts", "public_url": server.public_url, "version": 4}
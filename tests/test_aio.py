@@ -0,0 +1,128 @@
+import asyncio
+import concurrent.futures
+
+import pytest
+
+from benchmarks.synthetic import make_remote, serve_remote
+from tethysts import AsyncTethys, RetryPolicy, Tethys
+
+aiohttp = pytest.importorskip("aiohttp")
+
+
+def test_async_get_results(local_remote):
+    t1 = Tethys([local_remote])
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stns = t1.get_stations(dataset_id)
+    station_ids = [s["station_id"] for s in stns[:3]]
+    r1 = t1.get_results(dataset_id, station_ids, from_date="2020-01-15")
+
+    async def run():
+        async with AsyncTethys([local_remote], max_connections=4) as t2:
+            stns2 = await t2.get_stations(dataset_id)
+            r2, r3 = await asyncio.gather(
+                t2.get_results(dataset_id, station_ids, from_date="2020-01-15"),
+                t2.get_results(dataset_id, lat=-43.0, lon=172.0),
+            )
+        return stns2, r2, r3
+
+    stns2, r2, r3 = asyncio.run(run())
+
+    assert stns2 == stns
+    assert r1.equals(r2)
+    assert r3.sizes["geometry"] == 1
+
+
+def test_async_shared_cache(local_remote, server, tmp_path):
+    t1 = Tethys([local_remote])
+    dataset_id = t1.datasets[0]["dataset_id"]
+    station_ids = [s["station_id"] for s in t1.get_stations(dataset_id)[:3]]
+    r1 = t1.get_results(dataset_id, station_ids)
+    server.requests.clear()
+
+    ## Concurrent calls that need the same chunks with a single decoding thread
+    async def run():
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        async with AsyncTethys(
+            [local_remote], cache=tmp_path, max_connections=4, executor=executor
+        ) as t2:
+            results = await asyncio.wait_for(
+                asyncio.gather(
+                    *[t2.get_results(dataset_id, station_ids) for i in range(8)]
+                ),
+                60,
+            )
+        executor.shutdown()
+        return results
+
+    results = asyncio.run(run())
+
+    assert all(r1.equals(r2) for r2 in results)
+    chunk_requests = [r[1] for r in server.requests if r[1].endswith(".results.h5")]
+    assert len(chunk_requests) == len(set(chunk_requests)) == 9
+
+
+def test_async_retries(local_remote, server):
+    t1 = Tethys([local_remote])
+    dataset_id = t1.datasets[0]["dataset_id"]
+    station_ids = [s["station_id"] for s in t1.get_stations(dataset_id)[:2]]
+    r1 = t1.get_results(dataset_id, station_ids)
+    rc_index = t1._get_results_chunks(dataset_id, t1._get_version_date(dataset_id))
+    chunks = rc_index.take(rc_index.station_positions(station_ids))
+    paths = ["/{}/{}".format(local_remote["bucket"], c["key"]) for c in chunks]
+
+    ## Transient errors and stalled requests are retried
+    server.failures[paths[0]] = 2
+    server.delays[paths[1]] = [5]
+    policy = RetryPolicy(base_delay=0.01, read_timeout=0.5)
+
+    async def run():
+        async with AsyncTethys([local_remote], retry_policy=policy) as t2:
+            return await asyncio.wait_for(t2.get_results(dataset_id, station_ids), 4)
+
+    r2 = asyncio.run(run())
+    assert r1.equals(r2)
+    assert len([r for r in server.requests if r[1] == paths[0]]) == 4
+
+
+def test_async_single_flight(local_remote, server):
+    t1 = Tethys([local_remote])
+    dataset_id = t1.datasets[0]["dataset_id"]
+    station_ids = [s["station_id"] for s in t1.get_stations(dataset_id)[:2]]
+    server.requests.clear()
+
+    ## Concurrent calls share the downloads of the metadata
+    async def run():
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        async with AsyncTethys([local_remote], executor=executor) as t2:
+            results = await asyncio.gather(
+                *[t2.get_stations(dataset_id) for i in range(4)],
+                *[t2.get_results(dataset_id, station_ids) for i in range(4)],
+            )
+        executor.shutdown()
+        return results
+
+    _ = asyncio.run(run())
+
+    paths = [r[1] for r in server.requests if not r[1].endswith(".results.h5")]
+    assert len(paths) == len(set(paths))
+
+
+def test_async_missing_stations(tmp_path):
+    root = tmp_path.joinpath("remote")
+    make_remote(root, n_stations=1, n_chunks=1)
+    for path in root.rglob("*.stations.json.zst"):
+        path.unlink()
+
+    async def run():
+        with serve_remote(root) as server:
+            remote = {
+                "bucket": "tethysts",
+                "public_url": server.public_url,
+                "version": 4,
+            }
+            async with AsyncTethys([remote]) as t2:
+                dataset_id = t2.datasets[0]["dataset_id"]
+                with pytest.warns(UserWarning, match="No stations"):
+                    return await t2.get_stations(dataset_id)
+
+    assert asyncio.run(run()) is None
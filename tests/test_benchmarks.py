@@ -0,0 +1,25 @@
+from benchmarks import startup, suite
+
+
+def test_suite():
+    summary = suite.run(n_stations=4, n_chunks=2, repeat=1)
+
+    for prefix in ("cold_", "warm_"):
+        for phase in ("init", "get_stations", "download_results", "get_results"):
+            assert summary[prefix + phase]["n"] == 1
+
+    ## The warm runs don't download the results chunks again
+    assert summary["cold_download_results"]["chunk_requests"] == 4
+    assert summary["warm_download_results"]["chunk_requests"] == 0
+    assert summary["warm_get_results"]["chunk_requests"] == 0
+
+    baseline = {"cold_init": {"median": summary["cold_init"]["median"] / 10}}
+    assert list(suite.compare(summary, baseline, min_delta=0)) == ["cold_init"]
+    assert suite.compare(summary, summary) == {}
+
+
+def test_startup():
+    summary = startup.run(n_remotes=2, n_stations=2, repeat=1)
+
+    for phase in ("import", "eager_init", "deferred_init", "deferred_first_query"):
+        assert summary[phase]["n"] == 1
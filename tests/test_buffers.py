@@ -0,0 +1,79 @@
+import io
+
+import pytest
+import zstandard as zstd
+
+from benchmarks.synthetic import make_remote, serve_remote
+from tethysts import Tethys
+from tethysts.buffers import BufferFile, BufferPool, decompress_into
+
+
+@pytest.fixture(scope="module")
+def zst_server(tmp_path_factory):
+    root = tmp_path_factory.mktemp("zst_remote")
+    make_remote(root, n_stations=3, compressed=True)
+    with serve_remote(root) as server:
+        yield server
+
+
+def test_decompress_into():
+    data = bytes(range(256)) * 10000
+    pool = BufferPool(max_size=2**23)
+
+    ## With and without the content size in the frame header
+    compressed = zstd.ZstdCompressor().compress(data)
+    b1 = io.BytesIO()
+    with zstd.ZstdCompressor().stream_writer(b1, closefd=False) as writer:
+        writer.write(data)
+
+    for obj in (compressed, b1.getvalue()):
+        buffer = pool.acquire()
+        n = decompress_into(io.BytesIO(obj), buffer, read_size=2**12)
+        assert buffer[:n] == data
+        pool.release(buffer)
+
+    assert len(pool._buffers) == 1
+
+    f1 = BufferFile(memoryview(data), view_min_size=100)
+    f1.seek(10)
+    assert f1.read(5) == data[10:15]
+    assert isinstance(f1.read(100), memoryview)
+    assert f1.tell() == 115
+
+
+def test_zst_results(local_remote, zst_server, tmp_path):
+    t1 = Tethys([local_remote])
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)[:3]]
+    r1 = t1.get_results(dataset_id, stn_ids)
+
+    remote = {"bucket": "tethysts", "public_url": zst_server.public_url, "version": 4}
+    t2 = Tethys([remote])
+    r2 = t2.get_results(dataset_id, stn_ids)
+    assert r1.equals(r2)
+
+    t3 = Tethys([remote], cache=tmp_path)
+    r3 = t3.get_results(dataset_id, stn_ids)
+    assert r1.equals(r3)
+
+
+def test_decode_processes(local_remote, zst_server, tmp_path):
+    t1 = Tethys([local_remote])
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)[:3]]
+    r1 = t1.get_results(dataset_id, stn_ids)
+
+    zst_remote = {
+        "bucket": "tethysts",
+        "public_url": zst_server.public_url,
+        "version": 4,
+    }
+    for i, remote in enumerate((local_remote, zst_remote)):
+        for cache in (None, tmp_path.joinpath(str(i))):
+            t2 = Tethys([remote], cache=cache, decode_processes=2)
+            r2 = t2.get_results(dataset_id, stn_ids)
+            assert t2._decode_pool is not None
+            t2.close()
+            assert r1.equals(r2)
+            if cache is not None:
+                assert len(list(cache.rglob("*.raw"))) == 0
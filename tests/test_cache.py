@@ -0,0 +1,235 @@
+import concurrent.futures
+import multiprocessing
+
+import pytest
+import requests
+
+from benchmarks.synthetic import add_version, make_remote, serve_remote, write_object
+from tethysts import RetryPolicy, Tethys
+from tethysts.cache import CacheManager, MetadataCache
+
+
+def get_results_worker(remote, cache, station_ids):
+    t1 = Tethys([remote], cache=cache)
+    dataset_id = t1.datasets[0]["dataset_id"]
+    r1 = t1.get_results(dataset_id, station_ids, threads=4)
+    return r1.sizes["geometry"]
+
+
+def test_metadata_cache(local_remote, server, tmp_path):
+    t1 = Tethys([local_remote], cache=tmp_path)
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stns1 = t1.get_stations(dataset_id)
+    assert all(r[2].get("If-None-Match") is None for r in server.requests)
+
+    ## Revalidation with conditional requests
+    server.requests.clear()
+    t2 = Tethys([local_remote], cache=tmp_path)
+    stns2 = t2.get_stations(dataset_id)
+    assert stns1 == stns2
+    assert len(server.requests) == 3
+    assert all(r[2].get("If-None-Match") is not None for r in server.requests)
+
+    ## Served locally within the ttl
+    server.requests.clear()
+    t3 = Tethys([local_remote], cache=tmp_path, metadata_ttl=3600)
+    stns3 = t3.get_stations(dataset_id)
+    assert stns1 == stns3
+    assert len(server.requests) == 0
+
+
+def test_cache_manager(local_remote, tmp_path):
+    t1 = Tethys([local_remote], cache=tmp_path)
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)]
+
+    r1 = t1.get_results(dataset_id, stn_ids[:2])
+    _ = t1.get_results(dataset_id, stn_ids[2:4])
+    manager = t1._cache_manager
+    files = sorted(tmp_path.rglob("*.results.h5"))
+    assert len(manager) == len(files) == 12
+    assert manager.total_size == sum(f.stat().st_size for f in files)
+
+    ## The manifest is reloaded by a new object and the first station is used again
+    t2 = Tethys([local_remote], cache=tmp_path)
+    assert t2._cache_manager.total_size == manager.total_size
+    r2 = t2.get_results(dataset_id, stn_ids[:2])
+    assert r1.equals(r2)
+
+    ## The least recently used files are evicted first
+    t2.clear_cache(max_size=t2._cache_manager.total_size * 0.5 / 1000000, max_age=7)
+    remaining = list(tmp_path.rglob("*.results.h5"))
+    assert len(remaining) == 6
+    rc_index = t2._get_results_chunks(dataset_id, t2._get_version_date(dataset_id))
+    hashes = {
+        c["chunk_hash"] for c in rc_index.take(rc_index.station_positions(stn_ids[:2]))
+    }
+    assert {f.name.split(".")[0] for f in remaining} == hashes
+
+    t2.clear_cache(max_size=1000, max_age=0)
+    assert len(list(tmp_path.rglob("*.results.h5"))) == 0
+    assert t2._cache_manager.total_size == 0
+
+
+def test_shared_cache(local_remote, server, tmp_path):
+    t1 = Tethys([local_remote])
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)]
+    server.requests.clear()
+
+    ## Several processes query overlapping stations with one cache
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(4, mp_context=ctx) as executor:
+        futures = [
+            executor.submit(get_results_worker, local_remote, tmp_path, stn_ids[:6])
+            for i in range(4)
+        ]
+        sizes = [f.result() for f in futures]
+
+    assert sizes == [6] * 4
+
+    ## Each chunk was downloaded exactly once
+    chunk_requests = [r[1] for r in server.requests if r[1].endswith(".results.h5")]
+    assert len(chunk_requests) == len(set(chunk_requests)) == 18
+    assert len(list(tmp_path.rglob("*.results.h5"))) == 18
+    assert len(list(tmp_path.rglob("*.lock"))) == 0
+    assert len(list(tmp_path.rglob("*.tmp"))) == 0
+
+
+def test_versions_share_chunks(tmp_path):
+    root = tmp_path.joinpath("remote")
+    make_remote(root, n_stations=2)
+    cache = tmp_path.joinpath("cache")
+
+    with serve_remote(root) as server:
+        remote = {"bucket": "tethysts", "public_url": server.public_url, "version": 4}
+        t1 = Tethys([remote], cache=cache)
+        dataset_id = t1.datasets[0]["dataset_id"]
+        stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)]
+        r1 = t1.get_results(dataset_id, stn_ids)
+        n_files = len(list(cache.rglob("*.results.h5")))
+
+        ## A new version with the same results chunks is served from the cache
+        add_version(root, "2022-02-01T00:00:00")
+        server.requests.clear()
+        t2 = Tethys([remote], cache=cache)
+        versions = t2.get_versions(dataset_id)
+        assert len(versions) == 2
+        r2 = t2.get_results(dataset_id, stn_ids)
+        r3 = t2.get_results(
+            dataset_id, stn_ids, version_date=versions[0]["version_date"]
+        )
+
+        assert not [r for r in server.requests if r[1].endswith(".results.h5")]
+        assert len(list(cache.rglob("*.results.h5"))) == n_files
+        assert r2.attrs["version_date"] != r1.attrs["version_date"]
+        assert r1.equals(r2)
+        assert r1.identical(r3)
+
+
+def test_metadata_cache_errors(tmp_path):
+    root = tmp_path.joinpath("remote")
+    write_object(root, "meta.json", b"1")
+    cache = MetadataCache(tmp_path.joinpath("cache"))
+
+    with serve_remote(root) as server:
+        url = server.public_url + "/tethysts/meta.json"
+        assert cache.get_url(url) == b"1"
+
+        ## Transient errors fall back to the local copy
+        server.failures["/tethysts/meta.json"] = 1
+        assert cache.get_url(url) == b"1"
+
+        ## A deleted object is not served from the local copy
+        root.joinpath("tethysts", "meta.json").unlink()
+        with pytest.raises(requests.HTTPError):
+            cache.get_url(url)
+        with pytest.raises(requests.HTTPError):
+            cache.get_url(url)
+
+
+def test_release_on_error(local_remote, server, tmp_path):
+    t1 = Tethys(
+        [local_remote], cache=tmp_path, retry_policy=RetryPolicy(base_delay=0.01)
+    )
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)[:2]]
+    rc_index = t1._get_results_chunks(dataset_id, t1._get_version_date(dataset_id))
+    chunk = rc_index.take(rc_index.station_positions(stn_ids[:1]))[0]
+    server.failures["/{}/{}".format(local_remote["bucket"], chunk["key"])] = 10
+
+    ## The chunks that were downloaded are not pinned after a failed query
+    with pytest.raises(requests.HTTPError):
+        t1.get_results(dataset_id, stn_ids)
+    assert len(t1._cache_manager) > 0
+    assert not t1._cache_manager._pinned
+
+    with pytest.raises(requests.HTTPError):
+        list(t1.iter_results(dataset_id, stn_ids))
+    assert not t1._cache_manager._pinned
+
+
+def test_shared_manifest(tmp_path):
+    paths = []
+    for name in ("a", "b", "c"):
+        path = tmp_path.joinpath("ds", "chunks", name, name + ".results.h5")
+        path.parent.mkdir(parents=True)
+        path.write_bytes(b"0" * 10)
+        paths.append(path)
+    m1 = CacheManager(tmp_path)
+    m2 = CacheManager(tmp_path)
+    assert len(m1) == len(m2) == 3
+
+    ## The accesses of the other process are applied on a flush
+    m2.touch(paths[0])
+    m2.flush()
+    m1.touch(paths[1])
+    m1.flush()
+    assert list(m1._entries)[-2:] == [
+        "ds/chunks/a/a.results.h5",
+        "ds/chunks/b/b.results.h5",
+    ]
+
+    ## The evictions and compactions of one process are seen by the other
+    assert m1.evict(max_size=0.00002) == ["ds/chunks/c/c.results.h5"]
+    m1.compact()
+    m2.flush()
+    assert len(m2) == 2
+    assert m2.total_size == 20
+    assert len(CacheManager(tmp_path)) == 2
+
+
+def test_metadata_cache_endpoints(tmp_path):
+    cache = MetadataCache(tmp_path.joinpath("cache"), ttl=3600)
+    roots = [tmp_path.joinpath(name) for name in ("remote1", "remote2")]
+    for i, root in enumerate(roots):
+        write_object(root, "meta.json", str(i).encode())
+
+    ## The same bucket and key on different endpoints are cached separately
+    with serve_remote(roots[0]) as server1, serve_remote(roots[1]) as server2:
+        for i, server in enumerate((server1, server2)):
+            obj = cache.get_object(
+                "meta.json", "tethysts", public_url=server.public_url
+            )
+            assert obj == str(i).encode()
+
+
+def test_evicted_by_other_process(local_remote, server, tmp_path, monkeypatch):
+    t1 = Tethys([local_remote], cache=tmp_path)
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)[:2]]
+    r1 = t1.get_results(dataset_id, stn_ids)
+
+    ## The cached chunks are removed by another process before they are combined
+    download_chunks = t1._download_chunks
+
+    def evict_after_download(*args, **kwargs):
+        results_list = download_chunks(*args, **kwargs)
+        assert CacheManager(tmp_path).evict(max_size=0)
+        return results_list
+
+    monkeypatch.setattr(t1, "_download_chunks", evict_after_download)
+    server.requests.clear()
+    assert t1.get_results(dataset_id, stn_ids).equals(r1)
+    assert [r for r in server.requests if r[1].endswith(".results.h5")]
+    assert not t1._cached_chunks
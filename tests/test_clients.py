@@ -0,0 +1,269 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import pytest
+import requests
+import tethys_data_models as tdm
+
+from benchmarks.synthetic import serve_remote, write_object
+from tethysts import AsyncTethys, Tethys
+from tethysts.clients import (
+    AdaptiveConcurrency,
+    ClientPool,
+    RetryPolicy,
+    classify_error,
+    hedge_read_size,
+    is_throttled,
+)
+from tethysts.locks import FileLock, lock_path
+from tethysts.utils import local_results_path
+
+
+def run(limiter, n, **kwargs):
+    """
+    Run n downloads from more threads than the limit.
+    """
+
+    def download():
+        limiter.acquire()
+        time.sleep(0.001)
+        limiter.release(**kwargs)
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        _ = list(executor.map(lambda i: download(), range(n)))
+
+
+def test_adaptive_concurrency():
+    limiter = AdaptiveConcurrency(max_limit=4, initial=1)
+
+    ## Increases while the limit is used and the latency is stable
+    run(limiter, 50, latency=0.1, nbytes=1000)
+    assert limiter.limit == 4
+
+    ## Halved by throttling
+    limiter._last_decrease = 0
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 2
+    assert limiter.stats()["n_throttled"] == 1
+
+    ## Reduced when the latency rises
+    limiter._last_decrease = 0
+    run(limiter, 5, latency=2.0)
+    assert limiter.limit < 2
+
+
+def test_is_throttled():
+    resp = requests.Response()
+    resp.status_code = 503
+    assert is_throttled(requests.HTTPError(response=resp))
+    resp.status_code = 404
+    assert not is_throttled(requests.HTTPError(response=resp))
+    assert is_throttled(requests.ReadTimeout())
+    assert not is_throttled(ValueError())
+
+
+def test_get_concurrency(local_remote):
+    t1 = Tethys([local_remote], max_pool_connections=10)
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)]
+    _ = t1.get_results(dataset_id, stn_ids)
+
+    stats = list(t1.get_concurrency().values())
+    assert len(stats) == 1
+    assert stats[0]["max_limit"] == 10
+    assert 1 <= stats[0]["limit"] <= 10
+    assert stats[0]["n_requests"] == 30
+
+
+def test_limiter_latency(local_remote, tmp_path, monkeypatch):
+    t1 = Tethys([local_remote], cache=str(tmp_path))
+
+    ## Without metrics no CallMetrics are created for the downloads
+    monkeypatch.setattr("tethysts.main.CallMetrics", None)
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)[:1]]
+    rc_index = t1._get_results_chunks(dataset_id, t1._get_version_date(dataset_id))
+    chunk = rc_index.take(rc_index.station_positions(stn_ids))[0]
+    chunk_path = local_results_path(t1.cache, chunk)
+
+    ## The wait for the cache lock of a chunk is not part of the download latency
+    lock = FileLock(lock_path(chunk_path))
+    lock.acquire()
+    timer = threading.Timer(1, lock.release)
+    timer.start()
+    try:
+        r1 = t1.get_results(dataset_id, stn_ids)
+    finally:
+        timer.join()
+    assert r1.sizes["geometry"] == 1
+
+    limiter = list(t1._clients._limiters.values())[0]
+    assert len(limiter._samples) == 3
+    assert max(limiter._samples) < 1
+
+
+def test_retries(local_remote, server):
+    t1 = Tethys(
+        [local_remote], retry_policy=RetryPolicy(base_delay=0.01, negative_ttl=60)
+    )
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)[:2]]
+    rc_index = t1._get_results_chunks(dataset_id, t1._get_version_date(dataset_id))
+    chunk = rc_index.take(rc_index.station_positions(stn_ids[:1]))[0]
+    path = "/{}/{}".format(local_remote["bucket"], chunk["key"])
+
+    ## Transient errors are retried
+    server.failures[path] = 2
+    r1 = t1.get_results(dataset_id, stn_ids)
+    assert r1.sizes["geometry"] == 2
+    assert len([r for r in server.requests if r[1] == path]) == 3
+
+    ## Errors are raised once the attempts run out
+    server.failures[path] = 4
+    with pytest.raises(requests.HTTPError):
+        t1.get_results(dataset_id, stn_ids)
+
+    ## Missing objects are not retried and are remembered
+    server.requests.clear()
+    remote = t1._remotes[dataset_id]
+    for i in range(2):
+        with pytest.raises(FileNotFoundError):
+            t1._clients.get_object(remote, "missing.json.zst")
+    assert len(server.requests) == 1
+
+
+def test_hedged_requests(local_remote, server):
+    policy = RetryPolicy(hedge_percentile=90)
+    t1 = Tethys([local_remote], retry_policy=policy)
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)]
+    r1 = t1.get_results(dataset_id, stn_ids)
+
+    ## A slow request is hedged by a second request
+    rc_index = t1._get_results_chunks(dataset_id, t1._get_version_date(dataset_id))
+    chunk = rc_index.take(rc_index.station_positions(stn_ids[:1]))[0]
+    server.delays["/{}/{}".format(local_remote["bucket"], chunk["key"])] = [5]
+
+    start = time.monotonic()
+    r2 = t1.get_results(dataset_id, stn_ids)
+    assert time.monotonic() - start < 4
+    assert r1.equals(r2)
+    assert list(t1.get_concurrency().values())[0]["n_hedged"] >= 1
+
+
+class SlowStream(object):
+    def __init__(self, delay, n_reads=10):
+        self.delay = delay
+        self.n_reads = n_reads
+        self.reads = 0
+        self.closed = False
+
+    def read(self, n):
+        time.sleep(self.delay)
+        self.reads += 1
+        return b"x" * n if self.reads <= self.n_reads else b""
+
+    def close(self):
+        self.closed = True
+
+
+def test_hedged_cancel(local_remote):
+    clients = ClientPool(policy=RetryPolicy(hedge_percentile=50))
+    limiter = AdaptiveConcurrency()
+    run(limiter, 20, latency=0.05)
+
+    ## The first request is slow, so the hedged request wins
+    streams = []
+    delays = [0.5, 0]
+
+    def get_object(remote, obj_key, *args):
+        streams.append(SlowStream(delays[len(streams)]))
+        return streams[-1]
+
+    clients.get_object = get_object
+    file_obj = clients.get_object_hedged(local_remote, "key", limiter=limiter)
+    assert len(file_obj.read()) == 10 * hedge_read_size
+    assert limiter.n_hedged == 1
+    assert streams[1].closed
+
+    ## The losing request stops reading and its response is closed
+    time.sleep(1)
+    assert streams[0].closed
+    assert streams[0].reads < 3
+    assert limiter.stats()["in_flight"] == 0
+
+    ## The hedged request waits for a free download slot
+    streams.clear()
+    delays[0] = 0.02
+    limiter1 = AdaptiveConcurrency(max_limit=1, initial=1)
+    run(limiter1, 20, latency=0.05)
+    limiter1.acquire()
+    file_obj = clients.get_object_hedged(local_remote, "key", limiter=limiter1)
+    assert len(file_obj.read()) == 10 * hedge_read_size
+    assert len(streams) == 1
+    assert limiter1.n_hedged == 0
+    clients.close()
+
+
+def test_classify_error():
+    resp = requests.Response()
+    for status, kind in [(404, "missing"), (503, "transient"), (403, "fatal")]:
+        resp.status_code = status
+        assert classify_error(requests.HTTPError(response=resp)) == kind
+    assert classify_error(FileNotFoundError()) == "missing"
+    assert classify_error(requests.ConnectionError()) == "transient"
+    assert classify_error(ValueError()) == "fatal"
+
+
+def test_remote_datasets_errors(local_remote, server):
+    path = "/{}/{}".format(
+        local_remote["bucket"], tdm.utils.key_patterns[4]["datasets"]
+    )
+    policy = RetryPolicy(base_delay=0.01)
+
+    ## Transient errors of the datasets are warned about
+    server.failures[path] = 10
+    with pytest.warns(RuntimeWarning, match="could not be loaded"):
+        t1 = Tethys([local_remote], retry_policy=policy)
+    assert t1.datasets == []
+
+    aiohttp = pytest.importorskip("aiohttp")
+
+    async def run():
+        async with AsyncTethys([local_remote]) as t2:
+            return t2.datasets
+
+    server.failures[path] = 10
+    with pytest.warns(RuntimeWarning, match="could not be loaded"):
+        assert asyncio.run(run()) == []
+
+
+def test_remote_datasets_fatal(local_remote, tmp_path):
+    root = tmp_path.joinpath("broken")
+    write_object(root, tdm.utils.key_patterns[4]["datasets"], b"not zstandard")
+
+    with serve_remote(root) as broken_server:
+        broken_remote = dict(local_remote, public_url=broken_server.public_url)
+
+        ## A broken remote is skipped and the other remotes are loaded
+        with pytest.warns(RuntimeWarning, match="could not be loaded"):
+            t1 = Tethys([broken_remote, local_remote])
+        assert len(t1.datasets) == 1
+
+        ## The error is raised if no remote could be loaded
+        with pytest.raises(Exception):
+            Tethys([broken_remote])
+
+        aiohttp = pytest.importorskip("aiohttp")
+
+        async def run(remotes):
+            async with AsyncTethys(remotes) as t2:
+                return t2.datasets
+
+        with pytest.warns(RuntimeWarning, match="could not be loaded"):
+            assert len(asyncio.run(run([broken_remote, local_remote]))) == 1
+        with pytest.raises(Exception):
+            asyncio.run(run([broken_remote]))
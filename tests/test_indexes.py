@@ -0,0 +1,204 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from scipy import spatial
+from shapely.geometry import Point, box
+
+from tethysts import utils
+from tethysts.indexes import GridIndex, ResultsChunkIndex, SpatialIndex, StationTable
+
+
+@pytest.fixture()
+def stns():
+    rng = np.random.default_rng(1)
+    lons = 170 + rng.random(200) * 5
+    lats = -45 + rng.random(200) * 5
+    return {
+        f"stn{i:03d}": {
+            "station_id": f"stn{i:03d}",
+            "geometry": {"type": "Point", "coordinates": [float(lon), float(lat)]},
+        }
+        for i, (lon, lat) in enumerate(zip(lons, lats))
+    }
+
+
+def test_spatial_index(stns):
+    sindex = SpatialIndex(stns)
+    query = Point(172.3, -43.1)
+
+    dist = {
+        s: query.distance(Point(*v["geometry"]["coordinates"])) for s, v in stns.items()
+    }
+    assert sindex.nearest(query) == min(dist, key=dist.get)
+
+    subset = {s: v for i, (s, v) in enumerate(stns.items()) if i % 2}
+    dist1 = {s: dist[s] for s in subset}
+    assert utils.get_nearest_station(subset, query, sindex) == min(dist1, key=dist1.get)
+
+    poly = box(171, -44, 173, -42)
+    inside = {
+        s
+        for s, v in subset.items()
+        if poly.intersects(Point(*v["geometry"]["coordinates"]))
+    }
+    assert set(utils.get_intersected_stations(subset, poly, sindex)) == inside
+
+
+def test_station_table(stns):
+    stn_list = list(stns.values())
+    for i, s in enumerate(stn_list):
+        s["time_range"] = {
+            "from_date": f"2000-01-{(i % 28) + 1:02d}T00:00:00",
+            "to_date": f"2020-01-{(i % 28) + 1:02d}T00:00:00",
+        }
+
+    table = StationTable.from_list(stn_list)
+    assert len(table) == len(stn_list)
+    assert table.to_list() == stn_list
+
+    mask = table.mask(from_date="2000-01-10", to_date="2020-01-20")
+    expected = [
+        s["station_id"]
+        for s in stn_list
+        if ("2000-01-10" <= s["time_range"]["from_date"])
+        and (s["time_range"]["to_date"] <= "2020-01-20T00:00:00")
+    ]
+    assert table[mask].station_id.tolist() == expected
+
+    mask = table.mask(bbox=(171, -44, 173, -42))
+    expected = [
+        s["station_id"]
+        for s in stn_list
+        if (171 <= s["geometry"]["coordinates"][0] <= 173)
+        and (-44 <= s["geometry"]["coordinates"][1] <= -42)
+    ]
+    assert table[mask].station_id.tolist() == expected
+
+    assert table.sel(["stn005", "stn001"]).to_list() == [stn_list[5], stn_list[1]]
+
+
+@pytest.fixture()
+def results_chunks():
+    rng = np.random.default_rng(2)
+    rc_list = []
+    for i in range(2000):
+        rc_list.append(
+            {
+                "station_id": f"stn{rng.integers(50):03d}",
+                "chunk_id": f"{i:06d}",
+                "chunk_day": int(rng.integers(18000, 19000)),
+                "height": int(rng.choice([0, 10000])),
+                "band": int(rng.choice([1, 2])),
+                "modified_date": f"2022-{rng.integers(1, 13):02d}-01T00:00:00",
+            }
+        )
+    return rc_list
+
+
+def test_chunk_filters(results_chunks):
+    stn_ids = ["stn001", "stn007", "stn049", "missing"]
+    chunks = utils.chunk_filters(
+        ResultsChunkIndex(results_chunks),
+        stn_ids,
+        time_interval=30,
+        from_date="2020-01-01",
+        to_date="2021-06-01",
+        heights=10,
+        bands=2,
+        from_mod_date="2022-03-01",
+        to_mod_date="2022-10-01",
+    )
+
+    from_day = int(pd.Timestamp("2020-01-01").timestamp() / 60 / 60 / 24)
+    to_day = int(pd.Timestamp("2021-06-01").timestamp() / 60 / 60 / 24)
+    expected = [
+        rc
+        for rc in results_chunks
+        if (rc["station_id"] in stn_ids)
+        and ((rc["chunk_day"] + 30) >= from_day)
+        and (rc["chunk_day"] <= to_day)
+        and (rc["height"] == 10000)
+        and (rc["band"] == 2)
+        and ("2022-03-01" <= rc["modified_date"] <= "2022-10-01")
+    ]
+    expected.sort(key=lambda d: d["modified_date"])
+
+    assert len(chunks) > 0
+    assert chunks == expected
+    assert utils.chunk_filters(results_chunks, ["missing"]) == []
+
+
+def test_grid_index():
+    rng = np.random.default_rng(0)
+    query_lons = rng.uniform(169, 176, 50)
+    query_lats = rng.uniform(-46, -39, 50)
+
+    ## Regular, descending, and irregular axes give the same cells as a KD-tree of all cells
+    axes = [
+        (np.linspace(170, 175, 51), np.linspace(-45, -40, 26)),
+        (np.linspace(170, 175, 51), np.linspace(-40, -45, 26)),
+        (np.sort(rng.uniform(170, 175, 40)), rng.uniform(-45, -40, 30)),
+    ]
+    for lons, lats in axes:
+        data = xr.Dataset(coords={"lon": lons, "lat": lats})
+        xy = utils.cartesian_product(lons, lats)
+        _, pos = spatial.cKDTree(xy).query(np.column_stack([query_lons, query_lats]))
+
+        nearest = GridIndex(data).nearest(query_lons, query_lats)
+        assert np.allclose(lons[nearest["lon"]], xy[pos, 0])
+        assert np.allclose(lats[nearest["lat"]], xy[pos, 1])
+
+        data1 = utils.get_nearest_from_extent(data, lat=-42.1, lon=172.3)
+        assert data1.sizes == {"lon": 1, "lat": 1}
+        data2 = utils.get_nearest_from_extent(
+            data,
+            {
+                "type": "MultiPoint",
+                "coordinates": [[172.3, -42.1], [172.3, -42.1], [174, -44]],
+            },
+        )
+        assert data2.sizes == {"lon": 2, "lat": 2}
+
+    ## Geometry blocks
+    points = [Point(lon, lat) for lon, lat in zip(query_lons[:20], query_lats[:20])]
+    geometry = [p.wkb_hex for p in points]
+    data = xr.Dataset(
+        {"precipitation": (("geometry",), np.arange(20.0))},
+        coords={"geometry": geometry},
+    )
+    index = utils.grid_index(data)
+    assert utils.grid_index(data) is index
+    assert index.nearest(query_lons[:20], query_lats[:20])["geometry"].tolist() == list(
+        range(20)
+    )
+
+    data1 = utils.get_nearest_from_extent(
+        data, {"type": "Point", "coordinates": [query_lons[3] + 0.001, query_lats[3]]}
+    )
+    assert data1["precipitation"].values.tolist() == [3.0]
+
+
+def test_select_points():
+    lons = np.linspace(170, 175, 6)
+    lats = np.linspace(-45, -40, 6)
+    data = xr.Dataset(
+        {"temperature": (("lon", "lat"), np.arange(36.0).reshape(6, 6))},
+        coords={"lon": lons, "lat": lats},
+    )
+    r1 = utils.select_points(data, [171.1, 174.4, 171.1], [-44.2, -40.3, -44.2])
+    assert r1["temperature"].values.tolist() == [7.0, 29.0, 7.0]
+    assert r1["point_lat"].values.tolist() == [-44.2, -40.3, -44.2]
+
+    ## The points of stations without results are NaN
+    data = xr.Dataset(
+        {
+            "precipitation": (("geometry", "time"), [[1.0, 2.0], [3.0, 4.0]]),
+            "station_id": (("geometry",), ["a", "b"]),
+        },
+        coords={"geometry": ["g1", "g2"], "time": [0, 1]},
+    )
+    r2 = utils.select_points(data, [1, 2, 3], [1, 2, 3], ["b", "c", "a"])
+    assert r2["station_id"].values.tolist() == ["b", "c", "a"]
+    assert np.isnan(r2["precipitation"].values[1]).all()
+    assert r2["precipitation"].values[[0, 2]].tolist() == [[3.0, 4.0], [1.0, 2.0]]
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from tethysts import Tethys
+
+dask = pytest.importorskip("dask")
+
+
+@pytest.fixture()
+def t1(local_remote):
+    return Tethys([local_remote])
+
+
+@pytest.fixture()
+def dataset_id(t1):
+    return t1.datasets[0]["dataset_id"]
+
+
+@pytest.fixture()
+def station_ids(t1, dataset_id):
+    return [s["station_id"] for s in t1.get_stations(dataset_id)[:4]]
+
+
+def by_station(results):
+    return results.set_coords("station_id").swap_dims(geometry="station_id")
+
+
+def test_lazy_results(t1, dataset_id, station_ids, server):
+    r1 = by_station(t1.get_results(dataset_id, station_ids))
+
+    ## Only the template chunk is downloaded until the values are computed
+    server.requests.clear()
+    r2 = t1.get_results(dataset_id, station_ids, lazy=True)
+    r2 = r2.swap_dims(geometry="station_id")
+    assert len(server.requests) == 1
+    assert r2["precipitation"].chunks is not None
+
+    server.requests.clear()
+    with dask.config.set(scheduler="threads"):
+        r3 = r2.compute()
+    assert len(server.requests) == len(station_ids) * 3
+
+    r3 = r3.sel(station_id=r1["station_id"].values)
+    assert np.allclose(
+        r1["precipitation"].values,
+        r3["precipitation"].values,
+        equal_nan=True,
+    )
+
+    ## A selection only downloads the chunks that it needs
+    server.requests.clear()
+    r4 = r2.sel(station_id=station_ids[1], time="2020-02-15").compute(scheduler="sync")
+    assert len(server.requests) == 1
+    assert (
+        r4["precipitation"].squeeze("height").item()
+        == r1["precipitation"]
+        .sel(station_id=station_ids[1], time="2020-02-15")
+        .squeeze("height")
+        .item()
+    )
+
+
+def test_lazy_time_filters(t1, dataset_id, station_ids):
+    r1 = by_station(
+        t1.get_results(
+            dataset_id, station_ids, from_date="2020-01-20", to_date="2020-02-10"
+        )
+    )
+    r2 = t1.get_results(
+        dataset_id,
+        station_ids,
+        from_date="2020-01-20",
+        to_date="2020-02-10",
+        lazy=True,
+    ).swap_dims(geometry="station_id")
+
+    assert (r1["time"].values == r2["time"].values).all()
+    r2 = r2.sel(station_id=r1["station_id"].values).compute(scheduler="sync")
+    assert np.allclose(r1["precipitation"].values, r2["precipitation"].values)
@@ -0,0 +1,65 @@
+import concurrent.futures
+import threading
+
+import pytest
+
+from tethysts.locks import FileLock, SingleFlight
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def load(key):
+        calls.append(key)
+        started.set()
+        release.wait()
+        return [key]
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        leader = executor.submit(flight.do, "a", load, "a")
+        started.wait()
+        followers = [executor.submit(flight.do, "a", load, "a") for i in range(3)]
+        other = executor.submit(flight.do, "b", load, "b")
+        release.set()
+
+        assert leader.result() == (["a"], False)
+        assert all(f.result() == (["a"], True) for f in followers)
+        assert leader.result()[0] is followers[0].result()[0]
+        assert other.result() == (["b"], False)
+
+    assert sorted(calls) == ["a", "b"]
+
+    ## Nothing is kept after the call
+    assert flight.do("a", load, "a") == (["a"], False)
+
+    ## Exceptions are shared with the waiting callers too
+    def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        flight.do("c", fail)
+
+
+def test_file_lock(tmp_path):
+    path = tmp_path.joinpath("chunk.lock")
+    order = []
+
+    lock1 = FileLock(path)
+    lock1.acquire()
+
+    def wait_for_lock():
+        with FileLock(path):
+            order.append("second")
+
+    thread = threading.Thread(target=wait_for_lock)
+    thread.start()
+    thread.join(0.2)
+    order.append("first")
+    lock1.release()
+    thread.join()
+
+    assert order == ["first", "second"]
+    assert not path.exists()
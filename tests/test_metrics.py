@@ -0,0 +1,56 @@
+from tethysts import Metrics, Tethys, RetryPolicy
+
+
+def test_metrics(local_remote, server, tmp_path):
+    calls = []
+    metrics = Metrics(callbacks=[calls.append])
+    t1 = Tethys(
+        [local_remote],
+        cache=tmp_path,
+        retry_policy=RetryPolicy(base_delay=0.01),
+        metrics=metrics,
+    )
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)[:2]]
+    rc_index = t1._get_results_chunks(dataset_id, t1._get_version_date(dataset_id))
+    chunk = rc_index.take(rc_index.station_positions(stn_ids[:1]))[0]
+    server.failures["/{}/{}".format(local_remote["bucket"], chunk["key"])] = 1
+
+    ## A cold cache
+    r1 = t1.get_results(dataset_id, stn_ids)
+    assert len(calls) == 1
+    m1 = calls[0].as_dict()
+    n_chunks = m1["counters"]["chunks"]
+    assert n_chunks > 0
+    assert m1["counters"]["cache_misses"] == n_chunks
+    assert m1["counters"]["retries"] == 1
+    assert m1["counters"]["bytes"] > 0
+    assert m1["phases"]["transfer"]["count"] == n_chunks + 1
+    for name in ("version", "results_chunks", "chunk_filters", "concat"):
+        assert m1["phases"][name]["seconds"] >= 0
+    assert m1["duration"] > 0
+
+    ## A warm cache
+    r2 = t1.get_results(dataset_id, stn_ids)
+    assert r1.equals(r2)
+    m2 = calls[1].as_dict()
+    assert m2["counters"]["cache_hits"] == n_chunks
+    assert "transfer" not in m2["phases"]
+
+    ## iter_results
+    _ = list(t1.iter_results(dataset_id, stn_ids))
+    assert calls[2].name == "iter_results"
+    assert calls[2].counters["chunks"] == n_chunks
+
+    summary = metrics.summary()
+    assert summary["calls"] == 3
+    assert summary["counters"]["chunks"] == n_chunks * 3
+
+
+def test_no_metrics(local_remote):
+    t1 = Tethys([local_remote])
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)[:2]]
+    r1 = t1.get_results(dataset_id, stn_ids, from_date="2020-01-05")
+    assert t1.metrics is None
+    assert r1.sizes["geometry"] == 2
@@ -0,0 +1,72 @@
+import io
+
+import pytest
+
+from benchmarks.synthetic import make_remote, serve_remote
+from tethysts import Tethys, utils
+from tethysts.ranges import RangeFile
+
+
+@pytest.fixture(scope="module")
+def range_server(tmp_path_factory):
+    root = tmp_path_factory.mktemp("range_remote")
+    make_remote(
+        root, n_stations=2, n_chunks=1, chunk_len=20000, time_chunk=1000, n_heights=10
+    )
+    with serve_remote(root) as server:
+        yield server
+
+
+def test_range_file():
+    data = bytes(range(256)) * 1000
+    ranges = []
+
+    def fetch(start, end):
+        ranges.append((start, end))
+        return data[start : end + 1]
+
+    f1 = RangeFile(fetch, len(data))
+    f1.seek(100000)
+    assert f1.read(10) == data[100000:100010]
+    assert f1.read(10) == data[100010:100020]
+    assert len(ranges) == 1
+    assert f1.bytes_fetched < len(data) * 0.1
+
+    f1.seek(-5, io.SEEK_END)
+    assert f1.read() == data[-5:]
+
+    ## Most of the object is fetched at once
+    f1.seek(0)
+    assert f1.read() == data
+    assert len(ranges) <= 4
+
+
+def test_range_results(range_server, monkeypatch):
+    remote = {"bucket": "tethysts", "public_url": range_server.public_url, "version": 4}
+    t1 = Tethys([remote])
+    dataset_id = t1.datasets[0]["dataset_id"]
+    stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)]
+    chunks = t1._get_results_chunks(
+        dataset_id, t1.get_versions(dataset_id)[0]["version_date"]
+    )
+    full_size = sum(c["content_length"] for c in chunks.records)
+
+    r1 = t1.get_results(
+        dataset_id, stn_ids, from_date="2020-01-05", to_date="2020-01-25"
+    )
+
+    ## Only part of the chunks is downloaded with range requests
+    monkeypatch.setattr(utils, "range_read_min_size", 0)
+    range_server.requests.clear()
+    r2 = t1.get_results(
+        dataset_id, stn_ids, from_date="2020-01-05", to_date="2020-01-25"
+    )
+
+    assert r1.equals(r2)
+    assert r2.sizes["time"] == 20
+    assert all(r[2].get("Range") is not None for r in range_server.requests)
+    range_size = 0
+    for r in range_server.requests:
+        start, end = r[2]["Range"].replace("bytes=", "").split("-")
+        range_size += int(end) - int(start) + 1
+    assert range_size < full_size * 0.5
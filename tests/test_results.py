@@ -0,0 +1,156 @@
+import gc
+
+import pytest
+import xarray as xr
+
+from benchmarks.synthetic import make_remote, serve_remote
+from tethysts import Tethys
+
+
+@pytest.fixture()
+def t1(local_remote):
+    return Tethys([local_remote])
+
+
+@pytest.fixture()
+def dataset_id(t1):
+    return t1.datasets[0]["dataset_id"]
+
+
+@pytest.fixture()
+def station_ids(t1, dataset_id):
+    return [s["station_id"] for s in t1.get_stations(dataset_id)[:4]]
+
+
+def test_iter_results(t1, dataset_id, station_ids):
+    r1 = t1.get_results(dataset_id, station_ids, from_date="2020-01-15")
+
+    results = list(
+        t1.iter_results(dataset_id, station_ids, from_date="2020-01-15", threads=2)
+    )
+
+    assert len(results) == len(station_ids)
+    for r2 in results:
+        assert r2.sizes["geometry"] == 1
+        geometry = r2["geometry"].values[0]
+        assert r1.sel(geometry=[geometry]).equals(r2)
+
+
+def test_memory_budget(t1, dataset_id, station_ids, tmp_path, monkeypatch):
+    monkeypatch.setattr("tempfile.tempdir", str(tmp_path))
+    r1 = t1.get_results(dataset_id, station_ids)
+
+    r2 = t1.get_results(dataset_id, station_ids, memory_budget=0.01)
+    assert r1.equals(r2)
+    assert len(list(tmp_path.rglob("*.results.h5"))) == 0
+    assert len(list(tmp_path.rglob("results.h5"))) == 1
+
+    r2.close()
+    assert len(list(tmp_path.rglob("*.h5"))) == 0
+
+    ## Datasets derived from the results keep the spilled file
+    r3 = t1.get_results(dataset_id, station_ids, memory_budget=0.01).isel(geometry=[0])
+    gc.collect()
+    assert len(list(tmp_path.rglob("results.h5"))) == 1
+    assert r1.isel(geometry=[0]).equals(r3.load())
+    del r3
+    gc.collect()
+    assert len(list(tmp_path.rglob("*.h5"))) == 0
+
+    ## The temporary files are removed if the results fail after the spill
+    monkeypatch.setattr(xr.Dataset, "squeeze", lambda *args, **kwargs: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        t1.get_results(dataset_id, station_ids, memory_budget=0.01, squeeze_dims=True)
+    assert len(list(tmp_path.rglob("*.h5"))) == 0
+
+
+def test_pooled_connections(local_remote, server, dataset_id, station_ids):
+    t2 = Tethys([local_remote], max_pool_connections=2)
+    for i in range(2):
+        _ = t2.get_results(dataset_id, station_ids, threads=2)
+    t2.close()
+
+    ## All of the requests reuse the pooled connections
+    clients = {r[3] for r in server.requests}
+    assert len(server.requests) > 20
+    assert len(clients) <= 3
+
+
+@pytest.fixture(scope="module")
+def other_server(tmp_path_factory):
+    root = tmp_path_factory.mktemp("other_remote")
+    make_remote(root, dataset_id="b1c2d3e4f5a6b7c8d9e0f1a2", n_stations=3, seed=1)
+    with serve_remote(root) as server:
+        yield server
+
+
+def test_get_results_batch(local_remote, other_server, dataset_id, station_ids):
+    other_remote = dict(local_remote, public_url=other_server.public_url)
+    t2 = Tethys([local_remote, other_remote])
+    other_id = "b1c2d3e4f5a6b7c8d9e0f1a2"
+    other_stn_id = t2.get_stations(other_id)[0]["station_id"]
+
+    queries = [
+        {"dataset_id": dataset_id, "station_ids": station_ids},
+        {"dataset_id": other_id, "station_ids": other_stn_id, "to_date": "2020-02-01"},
+        {
+            "key": "window",
+            "dataset_id": dataset_id,
+            "station_ids": station_ids[:2],
+            "from_date": "2020-01-15",
+            "squeeze_dims": True,
+        },
+    ]
+    results = t2.get_results_batch(queries, threads=4)
+
+    assert list(results) == [dataset_id, other_id, "window"]
+    assert results[dataset_id].equals(t2.get_results(dataset_id, station_ids))
+    assert results[other_id].equals(
+        t2.get_results(other_id, other_stn_id, to_date="2020-02-01")
+    )
+    assert results["window"].equals(
+        t2.get_results(
+            dataset_id, station_ids[:2], from_date="2020-01-15", squeeze_dims=True
+        )
+    )
+
+    with pytest.raises(ValueError):
+        t2.get_results_batch([queries[0], queries[0]])
+    with pytest.raises(ValueError):
+        t2.get_results_batch([dict(queries[0], stations=station_ids)])
+
+
+def test_get_results_points(t1, server, dataset_id):
+    stns = t1.get_stations(dataset_id)
+    coords = [s["geometry"]["coordinates"] for s in stns]
+
+    ## Points near the first three stations, several per station
+    lons = [c[0] + 0.0001 * i for i in range(3) for c in coords[:3]]
+    lats = [c[1] for i in range(3) for c in coords[:3]]
+
+    server.requests.clear()
+    r1 = t1.get_results_points(dataset_id, lats, lons, from_date="2020-01-15")
+    chunk_requests = [r for r in server.requests if r[1].endswith(".results.h5")]
+    assert len(chunk_requests) == len({r[1] for r in chunk_requests})
+
+    assert r1.sizes["point"] == 9
+    assert r1["point_lon"].values.tolist() == lons
+    stn_ids = [s["station_id"] for s in stns[:3]]
+    assert r1["station_id"].values.tolist() == stn_ids * 3
+
+    r2 = t1.get_results(dataset_id, stn_ids, from_date="2020-01-15")
+    for i in range(9):
+        r3 = r2.sel(geometry=r1["geometry"].values[i])
+        assert (
+            r1.isel(point=i)["precipitation"].values == r3["precipitation"].values
+        ).all()
+
+    ## A MultiPoint geometry
+    r4 = t1.get_results_points(
+        dataset_id,
+        geometry={"type": "MultiPoint", "coordinates": [coords[4], coords[0]]},
+    )
+    assert r4["station_id"].values.tolist() == [
+        stns[4]["station_id"],
+        stns[0]["station_id"],
+    ]
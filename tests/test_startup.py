@@ -0,0 +1,80 @@
+import os
+import subprocess
+import sys
+
+import pytest
+import tethys_data_models as tdm
+
+from benchmarks.synthetic import make_remote, serve_remote
+from tethysts import RetryPolicy, Tethys
+
+other_id = "b1c2d3e4f5a6b7c8d9e0f1a2"
+
+
+@pytest.fixture(scope="module")
+def other_server(tmp_path_factory):
+    root = tmp_path_factory.mktemp("other_remote")
+    make_remote(root, dataset_id=other_id, n_stations=3, seed=1)
+    with serve_remote(root) as server:
+        yield server
+
+
+def test_lazy_imports():
+    code = (
+        "import sys; from tethysts import Tethys; "
+        "mods = ['xarray', 'hdf5tools', 's3tethys', 'scipy', 'dask', 'aiohttp', "
+        "'pandas', 'numpy', 'shapely', 'botocore', 'tethys_data_models', 'pydantic']; "
+        "print([m for m in mods if type(sys.modules.get(m)).__name__ == 'module'])"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    assert out.stdout.strip() == "[]"
+
+
+def test_deferred(local_remote, server, other_server):
+    other_remote = dict(local_remote, public_url=other_server.public_url)
+    other_server.requests.clear()
+    t1 = Tethys([other_remote, local_remote], deferred=True)
+    assert not server.requests
+    assert not other_server.requests
+
+    ## Only the first remote is loaded for its dataset
+    stns = t1.get_stations(other_id)
+    assert len(stns) == 3
+    assert not server.requests
+
+    with pytest.raises(KeyError):
+        t1.get_versions("000000000000000000000000")
+    assert len([r for r in server.requests if "datasets" in r[1]]) == 1
+
+    ## Nothing is left to load
+    n_requests = len(server.requests)
+    assert {d["dataset_id"] for d in t1.datasets} == {
+        other_id,
+        "a7b0c5d2e8f1a3b4c6d9e0f2",
+    }
+    assert len(server.requests) == n_requests
+
+
+def test_deferred_retry(local_remote, other_server):
+    other_remote = dict(local_remote, public_url=other_server.public_url)
+    path = "/{}/{}".format(
+        other_remote["bucket"], tdm.utils.key_patterns[4]["datasets"]
+    )
+    t1 = Tethys(
+        [other_remote], deferred=True, retry_policy=RetryPolicy(base_delay=0.01)
+    )
+
+    ## A remote that failed with a transient error is loaded on the next access
+    other_server.failures[path] = 10
+    with pytest.warns(RuntimeWarning, match="could not be loaded"):
+        with pytest.raises(KeyError):
+            t1.get_versions(other_id)
+    other_server.failures.clear()
+    assert t1.get_versions(other_id)
+    assert len(t1.datasets) == 1
@@ -0,0 +1,87 @@
+import pytest
+
+from benchmarks.synthetic import make_remote, serve_remote
+from tethysts import ResultsStore, Tethys
+
+
+def test_sync_results(tmp_path):
+    root = tmp_path.joinpath("remote")
+    make_remote(root, n_stations=1, n_chunks=2)
+    store = ResultsStore(tmp_path.joinpath("store"))
+
+    with serve_remote(root) as server:
+        remote = {"bucket": "tethysts", "public_url": server.public_url, "version": 4}
+        t1 = Tethys([remote])
+        dataset_id = t1.datasets[0]["dataset_id"]
+        stn_id = t1.get_stations(dataset_id)[0]["station_id"]
+
+        assert t1.sync_results(dataset_id, stn_id, store) == {stn_id: 2}
+        assert store.open(dataset_id).equals(t1.get_results(dataset_id, stn_id))
+        inode = store.results_path(dataset_id, stn_id).stat().st_ino
+
+        ## Nothing has changed
+        server.requests.clear()
+        assert t1.sync_results(dataset_id, stn_id, store.path) == {stn_id: 0}
+        assert not [r for r in server.requests if r[1].endswith(".results.h5")]
+
+        ## A new results chunk is the only download
+        make_remote(root, n_stations=1, n_chunks=3)
+        server.requests.clear()
+        t2 = Tethys([remote])
+        assert t2.sync_results(dataset_id, stn_id, store) == {stn_id: 1}
+        assert len([r for r in server.requests if r[1].endswith(".results.h5")]) == 1
+        r2 = t2.get_results(dataset_id, stn_id)
+        assert store.open(dataset_id, stn_id).equals(r2)
+        assert store.manifest(dataset_id, stn_id)["chunks"].keys() == {
+            "00000000",
+            "00000001",
+            "00000002",
+        }
+
+        ## The station file is updated in place
+        results_path = store.results_path(dataset_id, stn_id)
+        assert results_path.stat().st_ino == inode
+
+        ## Changed results chunks overwrite the stored values in place
+        make_remote(root, n_stations=1, n_chunks=3, values_seed=1)
+        t3 = Tethys([remote])
+        assert t3.sync_results(dataset_id, stn_id, store) == {stn_id: 3}
+        assert results_path.stat().st_ino == inode
+        assert store.open(dataset_id).equals(t3.get_results(dataset_id, stn_id))
+
+        ## A removed results chunk rebuilds the station
+        make_remote(root, n_stations=1, n_chunks=2, values_seed=1)
+        t4 = Tethys([remote])
+        assert t4.sync_results(dataset_id, stn_id, store) == {stn_id: 2}
+        assert store.open(dataset_id).equals(t4.get_results(dataset_id, stn_id))
+
+        assert t4.sync_results(dataset_id, stn_id, store, rebuild=True) == {stn_id: 2}
+
+
+def test_sync_removed_station(tmp_path):
+    root = tmp_path.joinpath("remote")
+    make_remote(root, n_stations=2, n_chunks=2)
+    store = ResultsStore(tmp_path.joinpath("store"))
+
+    with serve_remote(root) as server:
+        remote = {"bucket": "tethysts", "public_url": server.public_url, "version": 4}
+        t1 = Tethys([remote])
+        dataset_id = t1.datasets[0]["dataset_id"]
+        stn_ids = [s["station_id"] for s in t1.get_stations(dataset_id)]
+        assert t1.sync_results(dataset_id, stn_ids, store) == {
+            stn_id: 2 for stn_id in stn_ids
+        }
+
+        ## A station whose results chunks were all removed is removed from the store
+        make_remote(root, n_stations=1, n_chunks=2)
+        t2 = Tethys([remote])
+        removed_id = (
+            set(stn_ids) - {s["station_id"] for s in t2.get_stations(dataset_id)}
+        ).pop()
+        assert t2.sync_results(dataset_id, stn_ids, store) == {
+            stn_id: 0 for stn_id in stn_ids
+        }
+        assert removed_id not in store.station_ids(dataset_id)
+        assert not store.results_path(dataset_id, removed_id).exists()
+        with pytest.raises(ValueError):
+            store.open(dataset_id, removed_id)